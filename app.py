@@ -1,25 +1,338 @@
+import calendar
+import collections
+import concurrent.futures
+import ctypes
+import json
 import os
+import re
+import selectors
+import shutil
+import sqlite3
 import subprocess
 import time
 import signal
+import struct
+import sys
+import tempfile
 import argparse
-from datetime import datetime, timedelta
+import html
+import http.server
+import threading
+from datetime import datetime, timedelta, timezone
+
+try:
+    import numpy
+except ImportError:  # Optional; activity scoring falls back to pure Python
+    numpy = None
 
 # --- Configuration ---
 RTSP_URL = os.environ.get("RTSP_URL")
+# Multiple cameras: a JSON file with [{"name": ..., "rtsp_url": ...}] and/or
+# CAMERA_1_NAME/CAMERA_1_RTSP_URL, CAMERA_2_NAME/... environment variables.
+# Each camera records into ARCHIVE_PATH/<name>.
+CAMERAS_FILE = os.environ.get("CAMERAS_FILE")
 ARCHIVE_PATH = os.environ.get("ARCHIVE_PATH", "/archive")
 RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", 90))
 SEGMENT_TIME_SECONDS = 10
-CONSOLIDATION_CHECK_INTERVAL_SECONDS = 60  # Check every minute for hourly rollover
-CLEANUP_INTERVAL_SECONDS = 3600  # 1 hour
+SUPERVISOR_MAX_WAIT_SECONDS = 300  # Safety net; the supervisor is woken by events and timers
+CAPTURE_STABLE_SECONDS = 30  # A capture that ran this long is not retried with backoff
+CAPTURE_RESTART_MAX_DELAY_SECONDS = 60
+CAPTURE_STOP_TIMEOUT_SECONDS = 30  # Time a capture gets to exit after SIGTERM before it is killed
+# Restart a capture that has not written a segment for this many segment
+# durations, e.g. ffmpeg hanging on a dropped RTSP stream (0 = disabled)
+CAPTURE_STALL_SEGMENTS = float(os.environ.get("CAPTURE_STALL_SEGMENTS", 3))
+CLEANUP_INTERVAL_SECONDS = int(os.environ.get("CLEANUP_INTERVAL_SECONDS", 3600))  # 1 hour
+# Optional size-based retention on top of RETENTION_DAYS: keep the archive
+# below RETENTION_MAX_BYTES and/or at least RETENTION_MIN_FREE_BYTES free on
+# its filesystem by deleting the oldest MP4s first (0 = disabled)
+RETENTION_MAX_BYTES = int(os.environ.get("RETENTION_MAX_BYTES", 0))
+RETENTION_MIN_FREE_BYTES = int(os.environ.get("RETENTION_MIN_FREE_BYTES", 0))
+# Spread deletions out so they do not stall capture writes (0 = unlimited)
+CLEANUP_MAX_BYTES_PER_SECOND = int(os.environ.get("CLEANUP_MAX_BYTES_PER_SECOND", 0))
+CLEANUP_MAX_FILES_PER_SECOND = float(os.environ.get("CLEANUP_MAX_FILES_PER_SECOND", 0))
+# Tiered retention before RETENTION_DAYS (0 = disabled): hours older than
+# RETENTION_DOWNSAMPLE_DAYS are re-encoded to DOWNSAMPLE_HEIGHT in the
+# background, within the compaction CPU budget; hours older than
+# RETENTION_ACTIVE_DAYS are deleted unless their activity timeline (see
+# ACTIVITY_INTERVAL_SECONDS) reaches RETENTION_MIN_ACTIVITY percent
+RETENTION_DOWNSAMPLE_DAYS = int(os.environ.get("RETENTION_DOWNSAMPLE_DAYS", 0))  # e.g. 7
+DOWNSAMPLE_HEIGHT = int(os.environ.get("DOWNSAMPLE_HEIGHT", 480))
+DOWNSAMPLE_CRF = int(os.environ.get("DOWNSAMPLE_CRF", 32))
+RETENTION_ACTIVE_DAYS = int(os.environ.get("RETENTION_ACTIVE_DAYS", 0))  # e.g. 30
+RETENTION_MIN_ACTIVITY = int(os.environ.get("RETENTION_MIN_ACTIVITY", 5))
+DOWNSAMPLE_DONE_DIR = ".downsampled"  # Inside each camera directory; one empty file per downsampled hour
+# Daily rollup (0 = disabled): once a day is DAILY_ROLLUP_DAYS days old (and
+# past both retention tiers), its hourly MP4s are joined losslessly into one
+# daily_<YYYY-MM-DD>.mp4 with a daily_<YYYY-MM-DD>.json sidecar holding the
+# offset of each hour
+DAILY_ROLLUP_DAYS = int(os.environ.get("DAILY_ROLLUP_DAYS", 0))  # e.g. 2
 BYTES_PER_MB = 1024 * 1024  # For file size conversions
+MP4_EPOCH_OFFSET = 2082844800  # Seconds from 1904-01-01, the MP4 epoch, to the Unix epoch
+
+# Capture mode:
+#   "restart"    - one ffmpeg per hour, restarted at every hour change (default)
+#   "continuous" - one long-lived ffmpeg; segments are named by wall-clock hour
+#                  and hourly playlists are written from the files on disk
+CAPTURE_MODE = os.environ.get("CAPTURE_MODE", "restart")
+# Segment container of hourly capture: "mpegts" (default) or "fmp4"
+# (fragmented MP4: an init segment plus .m4s fragments, which
+# CONSOLIDATION_MODE=copy joins into the hourly MP4 without ffmpeg).
+# Continuous capture always records MPEG-TS.
+SEGMENT_FORMAT = os.environ.get("SEGMENT_FORMAT", "mpegts")
+LIVE_PLAYLIST_NAME = "live.m3u8"
+# Keep roughly two hours of segments in the rolling live playlist
+LIVE_PLAYLIST_SIZE = 2 * 3600 // SEGMENT_TIME_SECONDS
+# Optional staging directory on local storage, e.g. a tmpfs emptyDir. Captures
+# write their HLS output there and closed segments are moved to the archive
+# volume in batches every STAGING_FLUSH_SECONDS, or as soon as more than
+# STAGING_MAX_BYTES are staged ("" = capture straight into ARCHIVE_PATH)
+STAGING_PATH = os.environ.get("STAGING_PATH", "")
+STAGING_FLUSH_SECONDS = int(os.environ.get("STAGING_FLUSH_SECONDS", 60))
+STAGING_MAX_BYTES = int(os.environ.get("STAGING_MAX_BYTES", 256 * 1024 * 1024))
+# How long to wait past the end of an hour for its last segment before
+# consolidating it anyway (e.g. when the camera is down)
+ROLLOVER_GRACE_SECONDS = 6 * SEGMENT_TIME_SECONDS
+
+# Consolidation scheduler
+MAX_CONSOLIDATION_JOBS = int(os.environ.get("MAX_CONSOLIDATION_JOBS") or os.cpu_count() or 1)
+CONSOLIDATION_PRESET = os.environ.get("CONSOLIDATION_PRESET", "medium")
+# Once this many hours are waiting, new jobs use the cheaper backlog preset
+CONSOLIDATION_BACKLOG_THRESHOLD = int(os.environ.get("CONSOLIDATION_BACKLOG_THRESHOLD", 2))
+CONSOLIDATION_BACKLOG_PRESET = os.environ.get("CONSOLIDATION_BACKLOG_PRESET", "veryfast")
+# Adaptive encoder tuning (0 = disabled): each camera's hours are encoded with
+# the slowest preset and fewest x265 threads expected to finish within this
+# many seconds of the hour being queued, judged by the realtime factors
+# measured on this node so far
+CONSOLIDATION_LATENCY_BUDGET_SECONDS = int(os.environ.get("CONSOLIDATION_LATENCY_BUDGET_SECONDS", 0))  # e.g. 3000
+# Presets to choose from, fastest first
+CONSOLIDATION_ADAPTIVE_PRESETS = os.environ.get(
+    "CONSOLIDATION_ADAPTIVE_PRESETS", "ultrafast,superfast,veryfast,faster,fast,medium,slow"
+).split(",")
+# Every x265 preset, fastest first; places CONSOLIDATION_PRESET among the adaptive presets
+X265_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow", "placebo"]
+ENCODER_MODEL_FILE = ".encoder_model.json"  # Inside each camera directory
+ENCODER_MODEL_WEIGHT = 0.3  # Weight of the newest measurement in the moving average
+ENCODER_PRESET_SLOWDOWN = 1.5  # Assumed slowdown of each step to a slower preset not measured yet
+# Split each hour into this many keyframe-aligned chunks encoded in parallel (1 = single pass)
+CONSOLIDATION_CHUNKS = int(os.environ.get("CONSOLIDATION_CHUNKS", 1))
+CONSOLIDATION_NICE = int(os.environ.get("CONSOLIDATION_NICE", 10))
+# ionice scheduling class for encoders: "" (unchanged), "2" (best-effort) or "3" (idle)
+CONSOLIDATION_IONICE_CLASS = os.environ.get("CONSOLIDATION_IONICE_CLASS", "")
+# Extra outputs of hourly H.265 encodes, produced from the same decode:
+# a low-resolution proxy_<hour>.mp4 and a thumbs_<hour>.jpg sprite sheet
+# (0 = disabled). They follow the retention of the hour's archive MP4.
+PROXY_HEIGHT = int(os.environ.get("PROXY_HEIGHT", 0))  # e.g. 360
+PROXY_BITRATE = os.environ.get("PROXY_BITRATE", "400k")
+THUMBNAIL_INTERVAL_SECONDS = int(os.environ.get("THUMBNAIL_INTERVAL_SECONDS", 0))  # e.g. 60
+THUMBNAIL_WIDTH = 160
+THUMBNAIL_COLUMNS = 10
+# Activity index: after an hour is consolidated its keyframes are decoded at a
+# tiny resolution and scored by frame differencing, one score per interval,
+# into activity_<hour>.bin for `app.py search` (0 = disabled)
+ACTIVITY_INTERVAL_SECONDS = int(os.environ.get("ACTIVITY_INTERVAL_SECONDS", 0))  # e.g. 10
+ACTIVITY_FRAME_WIDTH = 32
+ACTIVITY_FRAME_HEIGHT = 18
+ACTIVITY_PIXEL_THRESHOLD = 16  # Gray levels a pixel must change by to count as activity
+ACTIVITY_HEADER = struct.Struct(">HH")  # Interval seconds, offset of the first interval in the hour
+# Probe every segment of a finished hour with this many threads before it is
+# consolidated (0 = disabled). Damaged segments are repaired with a remux or
+# dropped, and the hour's segments, gaps and PTS jumps are recorded in
+# manifest_<hour>.json
+SEGMENT_PROBE_WORKERS = int(os.environ.get("SEGMENT_PROBE_WORKERS", 0))  # e.g. 4
+SEGMENT_GAP_TOLERANCE_SECONDS = 1.0
+# Last encoder log lines kept per job for failure reports
+CONSOLIDATION_LOG_LINES = 50
+# Durable job queue shared with `app.py worker` processes, e.g. /archive/.jobs
+# ("" = consolidate in this process). When set, the recorder only enqueues
+# finished hours as files in <queue>/queued; workers claim them by renaming
+# them into <queue>/claimed and keep touching their claims while encoding.
+# A claim not touched for JOB_LEASE_SECONDS is returned to the queue.
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", "")
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 120))
+JOB_POLL_SECONDS = 10
+# Hours queued for consolidation are journaled here (inside each camera
+# directory, one file per hour holding the attempt count) until their MP4 is
+# in place, so a restart can pick them up again
+CONSOLIDATION_JOURNAL_DIR = ".consolidation"
+CONSOLIDATION_MAX_ATTEMPTS = int(os.environ.get("CONSOLIDATION_MAX_ATTEMPTS", 3))
+
+# Consolidation mode:
+#   "transcode" - re-encode each hour to H.265 right away (default)
+#   "copy"      - remux each hour into an MP4 without re-encoding; the H.265
+#                 compaction runs later, inside COMPACTION_WINDOW or while the
+#                 load average is below COMPACTION_MAX_LOAD
+CONSOLIDATION_MODE = os.environ.get("CONSOLIDATION_MODE", "transcode")
+COMPACTION_WINDOW = os.environ.get("COMPACTION_WINDOW", "0-6")  # UTC hours, e.g. "1-5"
+COMPACTION_MAX_LOAD = (
+    float(os.environ["COMPACTION_MAX_LOAD"]) if os.environ.get("COMPACTION_MAX_LOAD") else None
+)
+COMPACTION_MARKER_DIR = ".compaction"  # Inside each camera directory; one empty file per pending hour
+
+# Archive layout:
+#   "flat"  - every file of a camera in one directory (default)
+#   "dated" - hour files in <camera>/YYYY/MM/DD/ so a day expires with one
+#             directory removal; move an existing archive with `app.py migrate-layout`
+ARCHIVE_LAYOUT = os.environ.get("ARCHIVE_LAYOUT", "flat")
+
+# Optional SQLite index of every segment and MP4 (e.g. /archive/.index.sqlite3).
+# When set, retention, purge and per-hour lookups query the index instead of
+# listing the archive directories. Rebuild it with `app.py reindex`.
+ARCHIVE_INDEX_PATH = os.environ.get("ARCHIVE_INDEX_PATH", "")
+
+# Serve Prometheus metrics on http://<host>:METRICS_PORT/metrics (0 = disabled)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+# Port of the playback server started by `app.py serve`
+SERVE_PORT = int(os.environ.get("SERVE_PORT", 8080))
 
-ffmpeg_process = None
-current_process_hour_identifier = None  # YYYY-MM-DD-HH
 last_cleanup_time = time.time()
+# Files chosen by the last cleanup pass, oldest first, deleted at the configured rate
+pending_deletions = []  # [(path, size in bytes or None)]
+next_deletion_time = 0
+# Hours due for downsampling as of the last cleanup pass, oldest first
+pending_downsamples = []  # [(camera, hour identifier)]
+# Days due for a daily rollup as of the last cleanup pass, oldest first
+pending_rollups = []  # [(camera, YYYY-MM-DD)]
+cleanup_stats = {
+    "deleted_files": 0,
+    "bytes_freed": 0,
+    "archive_bytes": {},  # Bytes per file kind, as of the last cleanup pass
+}
+
+# Event loop state (see install_event_wakeup)
+event_selector = None
+wakeup_read_fd = None
+wakeup_write_fd = None
+# Capture watchdog state (see install_capture_watchdog)
+inotify_fd = None
+inotify_libc = None
+inotify_watches = {}  # Watch descriptor -> camera
 
 # Store PIDs for consolidation tasks, if any
 consolidation_processes = {}
+# Scheduler state: jobs waiting for a slot, metadata of running jobs and totals
+consolidation_queue = []
+consolidation_jobs = {}
+# Hours being encoded as parallel chunks: outputs, chunks still running, failure flag
+chunked_hours = {}
+# Hours whose segments are being probed before they are queued, by job key
+segment_prechecks = {}
+segment_probe_cache = {}  # Segment path -> ((size, mtime), probe result or None)
+probe_executor = None
+# Days whose hourly MP4s are being probed before a rollup, by job key (see start_rollup)
+rollup_probes = {}
+
+# Prefixes of the temporary files of consolidation jobs, which workers write in worker mode
+CONSOLIDATION_TEMP_PREFIXES = (".consolidating_", ".chunk_", ".activity_", ".repairing_")
+# Worker mode state (see run_worker): hours claimed from JOB_QUEUE_PATH
+worker_id = None
+claimed_jobs = {}  # Job key -> (claim path, last lease renewal)
+consolidation_stats = {
+    "completed": 0,
+    "total_wait_seconds": 0.0,
+    "total_run_seconds": 0.0,
+    "max_run_seconds": 0.0,
+    "last_run_seconds": 0.0,
+    "last_speed": None,  # Realtime factor reported by ffmpeg for the last finished job
+}
+# Realtime factor per encoder thread of each preset, by camera name (see choose_encoder_settings)
+encoder_models = {}
+
+# Running H.265 compactions of remuxed archives, downsampling encodes and
+# daily rollups ("compaction", "downsampling" or "rollup"), keyed by job key.
+# Their ffmpeg log goes to an unnamed temporary file (see start_background_encode).
+compaction_processes = {}  # Key -> (camera, hour identifier or day, process, task, log file)
+
+# Open connection to the archive index (see get_archive_index)
+archive_index = None
+
+
+class Camera:
+    """A capture source and the supervisor state of its ffmpeg process.
+
+    The default camera (no name) records RTSP_URL straight into ARCHIVE_PATH,
+    exactly like a single-camera archiver. Named cameras record into
+    ARCHIVE_PATH/<name>.
+    """
+
+    def __init__(self, name=None, rtsp_url=None):
+        self.name = name
+        self._rtsp_url = rtsp_url
+        self.process = None
+        self.hour_identifier = None  # YYYY-MM-DD-HH
+        self.started_at = 0
+        self.stop_requested_at = 0  # When the capture was sent SIGTERM (see signal_ffmpeg_process)
+        self.restart_count = 0
+        # How long the last hourly restart left the camera without a capture process. The
+        # footage lost is longer: ffmpeg still has to connect and write its first segment.
+        self.rollover_restart_seconds = 0.0
+        # Capture watchdog: last segment seen through inotify, stalls and footage lost to them
+        self.watch_descriptor = None
+        self.last_segment_at = 0
+        self.stall_count = 0
+        self.stalled_seconds = 0.0
+        self.restart_delay = 0
+        self.restart_not_before = 0
+        # Finished hours waiting for their last segment (continuous capture mode)
+        self.pending_rollover_hours = []
+        self.last_flush_at = 0  # Last move of staged segments to the archive volume
+
+    @property
+    def rtsp_url(self):
+        return RTSP_URL if self.name is None else self._rtsp_url
+
+    @property
+    def archive_path(self):
+        return ARCHIVE_PATH if self.name is None else os.path.join(ARCHIVE_PATH, self.name)
+
+    @property
+    def staging_path(self):
+        return STAGING_PATH if self.name is None else os.path.join(STAGING_PATH, self.name)
+
+    def job_key(self, hour_identifier):
+        """Returns the key identifying this camera's jobs for an hour."""
+        return hour_identifier if self.name is None else f"{self.name}/{hour_identifier}"
+
+    def __str__(self):
+        return self.name or "default"
+
+
+DEFAULT_CAMERA = Camera()
+cameras = []  # Populated by get_cameras()
+
+
+def load_cameras():
+    """Returns the cameras configured through CAMERAS_FILE and CAMERA_<N>_* variables.
+
+    Without any camera configuration this is just the default camera.
+    """
+    configured = []
+    if CAMERAS_FILE:
+        with open(CAMERAS_FILE) as f:
+            for entry in json.load(f):
+                configured.append((entry["name"], entry["rtsp_url"]))
+    index = 1
+    while os.environ.get(f"CAMERA_{index}_NAME"):
+        configured.append(
+            (os.environ[f"CAMERA_{index}_NAME"], os.environ.get(f"CAMERA_{index}_RTSP_URL"))
+        )
+        index += 1
+
+    if not configured:
+        return [DEFAULT_CAMERA]
+
+    names = [name for name, _ in configured]
+    for name in names:
+        if not re.fullmatch(r"[A-Za-z0-9][A-Za-z0-9_.-]*", name) or names.count(name) > 1:
+            print(f"Error: Invalid or duplicate camera name {name!r}. Exiting.")
+            exit(1)
+    return [Camera(name, rtsp_url) for name, rtsp_url in configured]
+
+
+def get_cameras():
+    """Returns the cameras handled by this archiver, loading them on first use."""
+    if not cameras:
+        cameras.extend(load_cameras())
+    return cameras
 
 
 def get_current_hour_identifier():
@@ -27,23 +340,140 @@ def get_current_hour_identifier():
     return datetime.utcnow().strftime("%Y-%m-%d-%H")
 
 
-def start_ffmpeg_process(hour_identifier):
+def parse_hour_identifier(hour_identifier):
+    """Returns the datetime for the start of a YYYY-MM-DD-HH identifier."""
+    return datetime.strptime(hour_identifier, "%Y-%m-%d-%H")
+
+
+def hour_start_timestamp(hour_identifier):
+    """Returns the Unix time of the start of a YYYY-MM-DD-HH identifier (UTC)."""
+    return calendar.timegm(time.strptime(hour_identifier, "%Y-%m-%d-%H"))
+
+
+def dated_directory(hour_identifier, camera=None):
+    """Returns the <camera>/YYYY/MM/DD directory of an hour in the dated layout."""
+    camera = camera or DEFAULT_CAMERA
+    year, month, day = hour_identifier.split("-")[:3]
+    return os.path.join(camera.archive_path, year, month, day)
+
+
+def hour_directory(hour_identifier, camera=None):
+    """Returns the directory holding the segments, playlist and MP4 of an hour."""
+    camera = camera or DEFAULT_CAMERA
+    if ARCHIVE_LAYOUT == "dated":
+        return dated_directory(hour_identifier, camera)
+    return camera.archive_path
+
+
+def iter_day_directories(camera):
+    """Yields (YYYY-MM-DD, path) for each dated directory of a camera, oldest first."""
+    def numbered_subdirectories(path):
+        try:
+            with os.scandir(path) as entries:
+                return sorted(
+                    (entry.name, entry.path)
+                    for entry in entries
+                    if entry.name.isdigit() and entry.is_dir(follow_symlinks=False)
+                )
+        except FileNotFoundError:
+            return []
+
+    for year, year_path in numbered_subdirectories(camera.archive_path):
+        for month, month_path in numbered_subdirectories(year_path):
+            for day, day_path in numbered_subdirectories(month_path):
+                yield f"{year}-{month}-{day}", day_path
+
+
+def iter_archive_directories(camera):
+    """Yields every directory that may hold hour files of a camera.
+
+    The camera directory itself is always included so files that have not
+    been migrated to the dated layout yet are still found.
+    """
+    yield camera.archive_path
+    for _, day_path in iter_day_directories(camera):
+        yield day_path
+
+
+def capture_directory(hour_identifier, camera=None):
+    """Returns the directory a camera's capture writes its segments and playlist to."""
+    camera = camera or DEFAULT_CAMERA
+    if STAGING_PATH:
+        return camera.staging_path
+    if CAPTURE_MODE == "continuous":
+        return camera.archive_path
+    return hour_directory(hour_identifier, camera)
+
+
+def live_playlist_path(camera=None):
+    """Returns the path of the rolling playlist written by continuous capture."""
+    camera = camera or DEFAULT_CAMERA
+    return os.path.join(camera.staging_path if STAGING_PATH else camera.archive_path, LIVE_PLAYLIST_NAME)
+
+
+def uses_fmp4_segments():
+    """Returns True if captures write fragmented MP4 segments."""
+    return SEGMENT_FORMAT == "fmp4" and CAPTURE_MODE != "continuous"
+
+
+def start_ffmpeg_process(hour_identifier, camera=None):
     """Starts a new ffmpeg process for the given hour identifier."""
-    global ffmpeg_process, current_process_hour_identifier
+    camera = camera or DEFAULT_CAMERA
 
-    if not RTSP_URL:
-        print("Error: RTSP_URL environment variable is not set. Exiting.")
+    if not camera.rtsp_url:
+        if camera.name is None:
+            print("Error: RTSP_URL environment variable is not set. Exiting.")
+        else:
+            print(f"Error: No RTSP URL configured for camera {camera}. Exiting.")
         exit(1)
 
-    os.makedirs(ARCHIVE_PATH, exist_ok=True)
+    directory = capture_directory(hour_identifier, camera)
+    os.makedirs(directory, exist_ok=True)
+
+    if CAPTURE_MODE == "continuous":
+        command = build_continuous_capture_command(camera)
+        # ffmpeg expands strftime patterns in local time; archive names are UTC
+        env = dict(os.environ, TZ="UTC")
+    else:
+        command = build_hourly_capture_command(hour_identifier, camera)
+        env = None
+
+    print(f"DEBUG: FFMPEG command being executed for HLS: {command}")
+    print(f"Starting ffmpeg for camera {camera}, hour {hour_identifier}...")
+    camera.process = subprocess.Popen(command, start_new_session=True, env=env)
+    camera.hour_identifier = hour_identifier
+    camera.started_at = time.time()
+    watch_capture_directory(camera, directory)
+
+
+def next_segment_number(hour_identifier, camera=None):
+    """Returns the number after the highest numbered segment already captured for an hour (0 if none)."""
+    pattern = re.compile(rf"{re.escape(hour_identifier)}_segment_(\d+)\.(?:ts|m4s)$")
+    try:
+        names = os.listdir(capture_directory(hour_identifier, camera))
+    except FileNotFoundError:
+        return 0
+    return max((int(match.group(1)) + 1 for name in names if (match := pattern.match(name))), default=0)
+
+
+def build_hourly_capture_command(hour_identifier, camera=None):
+    """Returns the ffmpeg command that records a single hour into its own playlist.
 
-    playlist_path = os.path.join(ARCHIVE_PATH, f"playlist_{hour_identifier}.m3u8")
-    segment_filename = os.path.join(ARCHIVE_PATH, f"{hour_identifier}_segment_%05d.ts")
+    A capture restarted within its hour (after a crash or stall) appends to
+    the hour's playlist, marked as a discontinuity, and numbers its segments
+    on from the last one on disk, so nothing recorded earlier is overwritten.
+    """
+    camera = camera or DEFAULT_CAMERA
+    directory = capture_directory(hour_identifier, camera)
+    playlist_path = os.path.join(directory, f"playlist_{hour_identifier}.m3u8")
+    extension = "m4s" if uses_fmp4_segments() else "ts"
+    segment_filename = os.path.join(directory, f"{hour_identifier}_segment_%05d.{extension}")
+    start_number = next_segment_number(hour_identifier, camera)
 
     command = [
         "ffmpeg",
         "-i",
-        RTSP_URL,
+        camera.rtsp_url,
         "-c",
         "copy",
         "-map",
@@ -58,134 +488,2739 @@ def start_ffmpeg_process(hour_identifier):
         segment_filename,
         playlist_path,
     ]
+    if uses_fmp4_segments():
+        # The init segment is written next to the playlist and named like a segment of the hour
+        command[-1:-1] = [
+            "-hls_segment_type", "fmp4",
+            "-hls_fmp4_init_filename", f"{hour_identifier}_segment_init.mp4",
+        ]
+    if start_number:
+        command[-1:-1] = ["-hls_flags", "append_list+discont_start", "-start_number", str(start_number)]
+    return command
 
-    print(f"DEBUG: FFMPEG command being executed for HLS: {command}")
-    print(f"Starting ffmpeg for hour {hour_identifier}...")
-    ffmpeg_process = subprocess.Popen(command, preexec_fn=os.setsid)
-    current_process_hour_identifier = hour_identifier
 
+def build_continuous_capture_command(camera=None):
+    """Returns the ffmpeg command for a capture process that runs across hours.
 
-def stop_ffmpeg_process():
-    """Gracefully stops the current ffmpeg process."""
-    global ffmpeg_process
-    if ffmpeg_process and ffmpeg_process.poll() is None:
+    Segments are named after the UTC hour and minute/second they start in, so
+    the files for a finished hour can be found on disk without restarting
+    ffmpeg. A rolling live playlist provides the segment durations. In the
+    dated layout ffmpeg creates the day directories itself; staged segments
+    are sorted into them when they are flushed.
+    """
+    camera = camera or DEFAULT_CAMERA
+    segment_directory = camera.staging_path if STAGING_PATH else camera.archive_path
+    dated = ARCHIVE_LAYOUT == "dated" and not STAGING_PATH
+    if dated:
+        segment_directory = os.path.join(camera.archive_path, "%Y", "%m", "%d")
+    segment_filename = os.path.join(segment_directory, "%Y-%m-%d-%H_segment_%M%S.ts")
+
+    command = [
+        "ffmpeg",
+        "-i",
+        camera.rtsp_url,
+        "-c",
+        "copy",
+        "-map",
+        "0",
+        "-f",
+        "hls",
+        "-hls_time",
+        str(SEGMENT_TIME_SECONDS),
+        "-hls_list_size",
+        str(LIVE_PLAYLIST_SIZE),
+        "-strftime",
+        "1",
+        "-hls_segment_filename",
+        segment_filename,
+        live_playlist_path(camera),
+    ]
+    if dated:
+        command[-1:-1] = ["-strftime_mkdir", "1"]
+    return command
+
+
+def signal_ffmpeg_process(camera=None):
+    """Asks the camera's current ffmpeg process to stop, without waiting for it.
+
+    Lets several captures shut down at once; stop_ffmpeg_process then waits
+    for each within the time left since it was signalled.
+    """
+    camera = camera or DEFAULT_CAMERA
+    ffmpeg_process = camera.process
+    if ffmpeg_process and ffmpeg_process.poll() is None and not camera.stop_requested_at:
         print(f"Gracefully stopping ffmpeg process (PID: {ffmpeg_process.pid})...")
         os.killpg(os.getpgid(ffmpeg_process.pid), signal.SIGTERM)
+        camera.stop_requested_at = time.time()
+
+
+def stop_ffmpeg_process(camera=None):
+    """Gracefully stops the camera's current ffmpeg process."""
+    camera = camera or DEFAULT_CAMERA
+    ffmpeg_process = camera.process
+    if ffmpeg_process and ffmpeg_process.poll() is None:
+        if camera.stop_requested_at:
+            timeout = max(0, camera.stop_requested_at + CAPTURE_STOP_TIMEOUT_SECONDS - time.time())
+        else:
+            signal_ffmpeg_process(camera)
+            timeout = CAPTURE_STOP_TIMEOUT_SECONDS
         try:
-            ffmpeg_process.wait(timeout=30)
+            ffmpeg_process.wait(timeout=timeout)
             print("ffmpeg process stopped.")
         except subprocess.TimeoutExpired:
             print("ffmpeg process did not stop gracefully, killing.")
             os.killpg(os.getpgid(ffmpeg_process.pid), signal.SIGKILL)
-    ffmpeg_process = None
+    camera.process = None
+    camera.stop_requested_at = 0
+
+
+def read_playlist_entries(playlist_path):
+    """Returns the [(segment filename, duration)] entries of an HLS playlist, in order."""
+    entries = []
+    with open(playlist_path) as f:
+        duration = None
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",")[0])
+            elif line and not line.startswith("#"):
+                entries.append((os.path.basename(line), duration))
+                duration = None
+    return entries
+
+
+def read_playlist_map(playlist_path):
+    """Returns the init segment filename (#EXT-X-MAP) of an fMP4 playlist, or None."""
+    with open(playlist_path) as f:
+        for line in f:
+            match = re.match(r'#EXT-X-MAP:URI="([^"]+)"', line.strip())
+            if match:
+                return os.path.basename(match.group(1))
+    return None
+
 
+def write_playlist(playlist_path, entries, init_segment=None):
+    """Atomically writes a complete (VOD) HLS playlist for [(segment filename, duration)].
 
-def consolidate_hourly_archive(prev_hour_identifier):
+    init_segment is the init segment of fMP4 segments.
     """
-    Consolidates the HLS segments from the previous hour into a single MP4 file.
-    Deletes the original HLS files after successful conversion.
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7" if init_segment else "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{int(max(d for _, d in entries) + 0.999)}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    if init_segment:
+        lines.append(f'#EXT-X-MAP:URI="{init_segment}"')
+    for segment, duration in entries:
+        lines.append(f"#EXTINF:{duration:.6f},")
+        lines.append(segment)
+    lines.append("#EXT-X-ENDLIST")
+
+    tmp_path = playlist_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, playlist_path)
+
+
+def read_live_playlist(camera=None):
+    """Returns a {segment filename: duration} mapping from the camera's live playlist."""
+    path = live_playlist_path(camera)
+    try:
+        return dict(read_playlist_entries(path))
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read live playlist {path}: {e}")
+        return {}
+
+
+def is_hour_complete(hour_identifier, live_durations):
+    """Returns True once every segment of a finished hour has been written.
+
+    ffmpeg only lists a segment in the live playlist after closing it, so a
+    listed segment from a later hour means the hour's last segment is final.
+    If no later segment shows up (e.g. the camera is down), the hour is
+    considered complete after ROLLOVER_GRACE_SECONDS.
     """
-    print(f"Starting consolidation for hour: {prev_hour_identifier}")
-    hourly_playlist = os.path.join(
-        ARCHIVE_PATH, f"playlist_{prev_hour_identifier}.m3u8"
-    )
-    output_mp4 = os.path.join(ARCHIVE_PATH, f"archive_{prev_hour_identifier}.mp4")
+    if any(name.split("_segment_")[0] > hour_identifier for name in live_durations):
+        return True
+    hour_end = parse_hour_identifier(hour_identifier) + timedelta(hours=1)
+    return datetime.utcnow() >= hour_end + timedelta(seconds=ROLLOVER_GRACE_SECONDS)
 
-    if not os.path.exists(hourly_playlist):
-        print(
-            f"Warning: Playlist {hourly_playlist} not found for consolidation. Skipping."
-        )
+
+def write_hour_playlist(hour_identifier, live_durations, camera=None):
+    """Writes playlist_<hour>.m3u8 for a finished hour from its segments on disk.
+
+    Returns the number of segments in the playlist.
+    """
+    camera = camera or DEFAULT_CAMERA
+    directory = hour_directory(hour_identifier, camera)
+    prefix = f"{hour_identifier}_segment_"
+    try:
+        filenames = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    segments = sorted(f for f in filenames if f.startswith(prefix) and f.endswith(".ts"))
+    if not segments:
+        return 0
+
+    entries = [(f, live_durations.get(f) or SEGMENT_TIME_SECONDS) for f in segments]
+    write_playlist(os.path.join(directory, f"playlist_{hour_identifier}.m3u8"), entries)
+    return len(segments)
+
+
+def finalize_pending_hours(camera=None):
+    """Consolidates finished hours from continuous capture once they are complete on disk."""
+    camera = camera or DEFAULT_CAMERA
+    if not camera.pending_rollover_hours:
         return
 
-    command = [
+    live_durations = read_live_playlist(camera)
+    for hour_identifier in list(camera.pending_rollover_hours):
+        if not is_hour_complete(hour_identifier, live_durations):
+            continue
+        camera.pending_rollover_hours.remove(hour_identifier)
+        if STAGING_PATH:
+            flush_staged_segments(camera, hour_identifier)
+        try:
+            segment_count = write_hour_playlist(hour_identifier, live_durations, camera)
+        except OSError as e:
+            print(f"Error writing playlist for {hour_identifier}: {e}")
+            continue
+        if segment_count == 0:
+            print(f"Warning: No segments found for hour {hour_identifier}. Skipping.")
+            continue
+        print(f"Hour {hour_identifier} of camera {camera} complete with {segment_count} segment(s).")
+        consolidate_hourly_archive(hour_identifier, camera)
+
+
+def staged_bytes(camera):
+    """Returns the size of the files waiting in a camera's staging directory."""
+    total = 0
+    try:
+        with os.scandir(camera.staging_path) as entries:
+            for entry in entries:
+                try:
+                    total += entry.stat().st_size if entry.is_file() else 0
+                except OSError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return total
+
+
+def is_flush_due(camera):
+    """Returns True when a camera's staged segments should be moved to the archive volume."""
+    if time.time() - camera.last_flush_at >= STAGING_FLUSH_SECONDS:
+        return True
+    return staged_bytes(camera) > STAGING_MAX_BYTES
+
+
+def flush_staged_segments(camera, finished_hour=None, everything=False):
+    """Moves closed segments from the staging directory to the archive volume in one batch.
+
+    ffmpeg lists a segment in its playlist only once it is closed, so only
+    listed segments are moved while the capture runs. All files of the
+    finished_hour, including its hourly playlist, are moved, and with
+    everything (no capture running) every staged file. A move interrupted by
+    a kill leaves the staged file in place and is simply repeated. Returns
+    the number of files moved.
+    """
+    camera.last_flush_at = time.time()
+    try:
+        filenames = sorted(os.listdir(camera.staging_path))
+    except FileNotFoundError:
+        return 0
+    closed = set()
+    for filename in filenames:
+        if filename.endswith(".m3u8"):
+            try:
+                closed.update(name for name, _ in read_playlist_entries(os.path.join(camera.staging_path, filename)))
+            except (OSError, ValueError):
+                continue
+
+    moved = 0
+    for filename in filenames:
+        classified = classify_archive_file(filename)
+        if not classified or classified[0] not in ("segment", "playlist"):
+            continue
+        kind, hour_identifier = classified
+        if not (everything or hour_identifier == finished_hour or (kind == "segment" and filename in closed)):
+            continue
+        destination = os.path.join(hour_directory(hour_identifier, camera), filename)
+        try:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.move(os.path.join(camera.staging_path, filename), destination)
+            moved += 1
+        except OSError as e:
+            print(f"Warning: Could not move staged {filename} to the archive: {e}")
+    return moved
+
+
+def build_transcode_command(input_path, output_path, preset=None):
+    """Returns the ffmpeg command that re-encodes input_path to H.265."""
+    return [
         "ffmpeg",
         "-y",  # Automatically overwrite output files without prompting
         "-i",
-        hourly_playlist,
+        input_path,
         "-c:v",
         "libx265",  # Use H.265 video codec
         "-preset",
-        "medium",  # Medium speed/compression balance
+        preset or CONSOLIDATION_PRESET,  # Speed/compression balance
         "-crf",
         "26",  # Constant Rate Factor for quality (23-28 is common)
         "-c:a",
         "copy",  # Copy audio stream without re-encoding
-        output_mp4,
+        output_path,
     ]
-    print(f"DEBUG: FFMPEG command being executed for MP4 consolidation: {command}")
-    try:
-        # Use a separate Popen call, don't block the main loop
-        consolidation_proc = subprocess.Popen(
-            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+
+
+def build_downsample_command(input_path, output_path):
+    """Returns the ffmpeg command that re-encodes an aged archive at DOWNSAMPLE_HEIGHT and DOWNSAMPLE_CRF."""
+    command = build_transcode_command(input_path, output_path)
+    command[command.index("-crf") + 1] = str(DOWNSAMPLE_CRF)
+    command[-1:-1] = ["-vf", f"scale=-2:'min({DOWNSAMPLE_HEIGHT},ih)'"]
+    return command
+
+
+def build_multi_output_command(input_path, output_path, preset=None, proxy_path=None, thumbnails_path=None):
+    """Returns the ffmpeg command that decodes input_path once and encodes several outputs.
+
+    The decoded video is split in a filter graph into the H.265 archive, an
+    optional low-resolution H.264 proxy and an optional thumbnail sprite sheet.
+    """
+    branches = ["archive"] + (["proxy"] if proxy_path else []) + (["thumbs"] if thumbnails_path else [])
+    filter_graph = f"[0:v]split={len(branches)}" + "".join(f"[{branch}]" for branch in branches)
+    if proxy_path:
+        filter_graph += f";[proxy]scale=-2:{PROXY_HEIGHT}[proxy_out]"
+    if thumbnails_path:
+        rows = -(-3600 // THUMBNAIL_INTERVAL_SECONDS // THUMBNAIL_COLUMNS)
+        filter_graph += (
+            f";[thumbs]fps=1/{THUMBNAIL_INTERVAL_SECONDS},scale={THUMBNAIL_WIDTH}:-2,"
+            f"tile={THUMBNAIL_COLUMNS}x{rows}[thumbs_out]"
         )
-        consolidation_processes[prev_hour_identifier] = consolidation_proc
+
+    command = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        input_path,
+        "-filter_complex",
+        filter_graph,
+        "-map", "[archive]", "-map", "0:a?",
+        "-c:v", "libx265", "-preset", preset or CONSOLIDATION_PRESET, "-crf", "26",
+        "-c:a", "copy",
+        output_path,
+    ]
+    if proxy_path:
+        command += [
+            "-map", "[proxy_out]", "-map", "0:a?",
+            "-c:v", "libx264", "-preset", "veryfast", "-b:v", PROXY_BITRATE,
+            "-c:a", "aac", "-b:a", "64k",
+            "-movflags", "+faststart",
+            proxy_path,
+        ]
+    if thumbnails_path:
+        command += ["-map", "[thumbs_out]", "-frames:v", "1", "-update", "1", "-q:v", "5", thumbnails_path]
+    return command
+
+
+def build_activity_command(input_path, output_path):
+    """Returns the ffmpeg command decoding an MP4's keyframes into tiny raw grayscale frames, one per second."""
+    return [
+        "ffmpeg",
+        "-y",
+        "-skip_frame", "nokey",  # Only keyframes are decoded
+        "-i", input_path,
+        "-an",
+        "-vf", f"fps=1,scale={ACTIVITY_FRAME_WIDTH}:{ACTIVITY_FRAME_HEIGHT},format=gray",
+        "-f", "rawvideo",
+        output_path,
+    ]
+
+
+def build_concat_command(concat_list_path, output_path):
+    """Returns the ffmpeg command that losslessly joins the files of a concat list."""
+    return [
+        "ffmpeg",
+        "-y",
+        "-f",
+        "concat",
+        "-safe",
+        "0",  # The list contains absolute paths
+        "-i",
+        concat_list_path,
+        "-c",
+        "copy",
+        "-movflags",
+        "+faststart",
+        output_path,
+    ]
+
+
+def build_remux_command(input_path, output_path):
+    """Returns the ffmpeg command that remuxes input_path into an MP4 without re-encoding."""
+    return [
+        "ffmpeg",
+        "-y",
+        "-i",
+        input_path,
+        "-c",
+        "copy",  # Stream copy: I/O bound, finishes in seconds
+        "-movflags",
+        "+faststart",
+        output_path,
+    ]
+
+
+def build_append_command(playlist_path, output_path, started_at=None):
+    """Returns the command that joins an fMP4 playlist's init segment and fragments into one MP4.
+
+    Runs this script's `append-fragments` command in a child process, so the
+    scheduler treats it like any other job. started_at (a Unix timestamp)
+    becomes the MP4's creation_time.
+    """
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "append-fragments",
+        "--input",
+        playlist_path,
+        "--output",
+        output_path,
+    ]
+    if started_at is not None:
+        command += ["--creation-time", f"{started_at:.3f}"]
+    return command
+
+
+def copy_file_contents(source, destination):
+    """Appends an open file to another, in the kernel with copy_file_range where possible."""
+    try:
+        while os.copy_file_range(source.fileno(), destination.fileno(), 64 * BYTES_PER_MB):
+            pass
+        return
+    except (AttributeError, OSError):
+        pass  # Not supported here (e.g. across filesystems); copy what is left in large blocks
+    shutil.copyfileobj(source, destination, 8 * BYTES_PER_MB)
+
+
+def stamp_init_segment(data, started_at):
+    """Returns an fMP4 init segment with its movie header (mvhd) dated started_at.
+
+    ffprobe reports the mvhd creation time as the file's creation_time, to
+    the second. Init segments without a movie header are returned as is.
+    """
+    mp4_time = int(started_at) + MP4_EPOCH_OFFSET
+    data = bytearray(data)
+
+    def find_box(box_type, start, end):
+        while start + 8 <= end:
+            size, found_type = struct.unpack_from(">I4s", data, start)
+            header = 8
+            if size == 1:
+                size = struct.unpack_from(">Q", data, start + 8)[0]
+                header = 16
+            elif size == 0:
+                size = end - start
+            if size < header:
+                return None
+            if found_type == box_type:
+                return start + header, start + size
+            start += size
+        return None
+
+    moov = find_box(b"moov", 0, len(data))
+    mvhd = moov and find_box(b"mvhd", *moov)
+    if not mvhd:
+        print("Warning: The init segment has no movie header; its creation_time is left unset.", file=sys.stderr)
+        return bytes(data)
+    if data[mvhd[0]] == 1:
+        struct.pack_into(">QQ", data, mvhd[0] + 4, mp4_time, mp4_time)
+    else:
+        struct.pack_into(">II", data, mvhd[0] + 4, mp4_time, mp4_time)
+    return bytes(data)
+
+
+def append_fragments(playlist_path, output_path, started_at=None):
+    """Writes the init segment and fragments of an fMP4 playlist into one MP4 (the `append-fragments` command).
+
+    An fMP4 stream is its init segment followed by its fragments, so the
+    hourly MP4 is built with large sequential copies and no demuxing. With
+    started_at the init segment's movie header is dated to when the footage
+    starts (see stamp_init_segment). Returns the process exit code.
+    """
+    try:
+        init_segment = read_playlist_map(playlist_path)
+        entries = read_playlist_entries(playlist_path)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not read {playlist_path}: {e}", file=sys.stderr)
+        return 1
+    if not init_segment:
+        print(f"Error: {playlist_path} has no init segment (#EXT-X-MAP).", file=sys.stderr)
+        return 1
+
+    directory = os.path.dirname(playlist_path)
+    try:
+        with open(output_path, "wb", buffering=0) as output:
+            if started_at is not None:
+                with open(os.path.join(directory, init_segment), "rb") as source:
+                    output.write(stamp_init_segment(source.read(), started_at))
+            else:
+                entries.insert(0, (init_segment, None))
+            for filename in [name for name, _ in entries]:
+                with open(os.path.join(directory, filename), "rb", buffering=0) as source:
+                    copy_file_contents(source, output)
+    except OSError as e:
+        print(f"Error: Could not append fragments to {output_path}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def consolidate_hourly_archive(prev_hour_identifier, camera=None):
+    """
+    Queues consolidation of the HLS segments from the previous hour into a single MP4 file.
+    Deletes the original HLS files after successful conversion.
+
+    Jobs of all cameras share one queue and are started oldest hour first, at
+    most MAX_CONSOLIDATION_JOBS at a time (see dispatch_consolidation_jobs).
+    With CONSOLIDATION_CHUNKS > 1 the hour is encoded as several chunks in
+    parallel and stitched together afterwards.
+    """
+    camera = camera or DEFAULT_CAMERA
+    key = camera.job_key(prev_hour_identifier)
+    print(f"Starting consolidation for hour: {key}")
+    hourly_playlist = os.path.join(
+        hour_directory(prev_hour_identifier, camera), f"playlist_{prev_hour_identifier}.m3u8"
+    )
+
+    if not os.path.exists(hourly_playlist):
         print(
-            f"Consolidation process for {prev_hour_identifier} started (PID: {consolidation_proc.pid})."
+            f"Warning: Playlist {hourly_playlist} not found for consolidation. Skipping."
         )
-    except Exception as e:
-        print(f"Error starting consolidation for {prev_hour_identifier}: {e}")
+        return
 
+    if is_consolidation_scheduled(key):
+        print(f"Consolidation for {key} is already scheduled. Skipping.")
+        return
+
+    if JOB_QUEUE_PATH and worker_id is None:
+        enqueue_hour(prev_hour_identifier, camera)
+        return
+
+    attempts = read_journal_entry(prev_hour_identifier, camera)
+    if attempts >= CONSOLIDATION_MAX_ATTEMPTS:
+        print(f"Consolidation for {key} already failed {attempts} time(s). Skipping.")
+        return
+    write_journal_entry(prev_hour_identifier, camera, attempts + 1)
+
+    index_hour_segments(prev_hour_identifier, camera)
+
+    if SEGMENT_PROBE_WORKERS and start_segment_precheck(prev_hour_identifier, hourly_playlist, camera):
+        return  # Queued once its segments are checked (see collect_segment_prechecks)
+    queue_consolidation_jobs(prev_hour_identifier, hourly_playlist, camera)
+
+
+def queue_consolidation_jobs(hour_identifier, playlist, camera=None):
+    """Queues the consolidation jobs of an hour that encode the segments listed in playlist."""
+    camera = camera or DEFAULT_CAMERA
+    key = camera.job_key(hour_identifier)
+    jobs = None
+    if CONSOLIDATION_CHUNKS > 1 and CONSOLIDATION_MODE != "copy":
+        jobs = plan_chunk_jobs(hour_identifier, playlist, camera)
+    if not jobs:
+        jobs = [{"key": key, "hour": hour_identifier, "camera": camera, "kind": "hour", "input": playlist}]
+
+    for job in jobs:
+        job["queued_at"] = time.time()
+        consolidation_queue.append(job)
+    consolidation_queue.sort(key=lambda job: (job["hour"], job["key"]))  # Oldest hour first
+    dispatch_consolidation_jobs()
+
+
+def start_segment_precheck(hour_identifier, hourly_playlist, camera=None):
+    """Starts probing every segment of an hour on the probe thread pool.
+
+    Returns False if the playlist cannot be read; the hour is then queued
+    unchecked.
+    """
+    camera = camera or DEFAULT_CAMERA
+    try:
+        entries = read_playlist_entries(hourly_playlist)
+        init_segment = read_playlist_map(hourly_playlist)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read {hourly_playlist} for the segment check: {e}")
+        return False
+
+    directory = os.path.dirname(hourly_playlist)
+    init_path = os.path.join(directory, init_segment) if init_segment else None
+    executor = get_probe_executor()
+    checks = [
+        (name, executor.submit(check_segment, os.path.join(directory, name), init_path))
+        for name, _ in entries
+    ]
+    futures = [future for _, future in checks]
+    for future in futures:
+        # Wake the supervisor once the whole hour is checked
+        future.add_done_callback(lambda _: all(f.done() for f in futures) and wake_supervisor())
+    segment_prechecks[camera.job_key(hour_identifier)] = {
+        "hour": hour_identifier, "camera": camera, "checks": checks, "init_segment": init_segment,
+    }
+    print(f"Checking {len(checks)} segment(s) of {camera.job_key(hour_identifier)}.")
+    return True
+
+
+def get_probe_executor():
+    """Returns the thread pool that runs ffprobe off the supervisor loop, created on first use.
+
+    It has SEGMENT_PROBE_WORKERS threads, or one for the rollup probes when
+    segment checks are disabled.
+    """
+    global probe_executor
+    if probe_executor is None:
+        probe_executor = concurrent.futures.ThreadPoolExecutor(
+            max(1, SEGMENT_PROBE_WORKERS), thread_name_prefix="probe"
+        )
+    return probe_executor
+
+
+def probe_segment(path, init_path=None):
+    """Returns {"size", "start", "duration"} of a segment, or None if it is unreadable or damaged.
+
+    An fMP4 fragment is probed behind its init segment (init_path). Results
+    are cached by size and modification time, so a retried hour never
+    probes a segment twice.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    cached = segment_probe_cache.get(path)
+    if cached and cached[0] == (stat.st_size, stat.st_mtime_ns):
+        return cached[1]
+
+    result = None
+    try:
+        proc = subprocess.run(
+            [
+                "ffprobe", "-v", "error", "-show_entries", "format=start_time,duration", "-of", "json",
+                f"concat:{init_path}|{path}" if init_path else path,
+            ],
+            capture_output=True,
+            timeout=30,
+        )
+        probed = json.loads(proc.stdout or b"{}").get("format", {})
+        # Any decoder error (e.g. a truncated last packet) counts as damage
+        if proc.returncode == 0 and not proc.stderr.strip() and "duration" in probed:
+            result = {
+                "size": stat.st_size,
+                "start": float(probed.get("start_time", 0)),
+                "duration": float(probed["duration"]),
+            }
+    except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+        print(f"Warning: Could not probe {path}: {e}")
+    segment_probe_cache[path] = ((stat.st_size, stat.st_mtime_ns), result)
+    return result
+
+
+def check_segment(path, init_path=None):
+    """Probes a segment and tries to repair a damaged one with a stream-copy remux.
+
+    Runs on the probe thread pool. Returns (probe result or None, repaired).
+    fMP4 fragments cannot be remuxed on their own and are only probed.
+    """
+    result = probe_segment(path, init_path)
+    if result is not None:
+        return result, False
+    if init_path or not os.path.exists(path):
+        return None, False
+
+    repaired_path = os.path.join(os.path.dirname(path), f".repairing_{worker_tag()}{os.path.basename(path)}")
+    try:
+        proc = subprocess.run(
+            ["ffmpeg", "-y", "-v", "error", "-err_detect", "ignore_err", "-i", path,
+             "-c", "copy", "-map", "0", "-f", "mpegts", repaired_path],
+            capture_output=True,
+            timeout=60,
+        )
+        if proc.returncode == 0 and probe_segment(repaired_path) is not None:
+            os.replace(repaired_path, path)
+            segment_probe_cache[path] = segment_probe_cache.pop(repaired_path)
+            return segment_probe_cache[path][1], True
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"Warning: Could not repair {path}: {e}")
+    segment_probe_cache.pop(repaired_path, None)
+    try:
+        os.remove(repaired_path)
+    except OSError:
+        pass
+    return None, False
+
+
+def collect_segment_prechecks():
+    """Queues the hours whose segment checks have finished."""
+    for key, precheck in list(segment_prechecks.items()):
+        if all(future.done() for _, future in precheck["checks"]):
+            del segment_prechecks[key]
+            finish_segment_precheck(precheck)
+
+
+def finish_segment_precheck(precheck):
+    """Writes an hour's manifest and clean playlist, then queues its consolidation.
+
+    Damaged segments that could not be repaired are left out of the clean
+    playlist. Gaps between segments and PTS jumps (e.g. across a capture
+    restart) are recorded in the manifest.
+    """
+    hour_identifier = precheck["hour"]
+    camera = precheck["camera"]
+    key = camera.job_key(hour_identifier)
+    manifest = {"hour": hour_identifier, "segments": [], "dropped": [], "repaired": [], "gaps": [], "discontinuities": []}
+    previous = None
+    for name, future in precheck["checks"]:
+        try:
+            result, repaired = future.result()
+        except Exception as e:
+            print(f"Warning: Segment check of {name} failed: {e}")
+            result, repaired = None, False
+        if result is None:
+            manifest["dropped"].append(name)
+            continue
+        if repaired:
+            manifest["repaired"].append(name)
+        if previous is not None:
+            jump = result["start"] - (previous["start"] + previous["duration"])
+            if jump > SEGMENT_GAP_TOLERANCE_SECONDS:
+                manifest["gaps"].append({"after": previous["name"], "seconds": round(jump, 3)})
+            elif jump < -SEGMENT_GAP_TOLERANCE_SECONDS:
+                manifest["discontinuities"].append({"before": name, "pts_jump": round(jump, 3)})
+        previous = dict(result, name=name)
+        manifest["segments"].append(previous)
+
+    directory = hour_directory(hour_identifier, camera)
+    manifest_path = os.path.join(directory, f"manifest_{hour_identifier}.json")
+    try:
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        index_file(manifest_path, camera, "complete")
+    except OSError as e:
+        print(f"Warning: Could not write {manifest_path}: {e}")
+    if manifest["dropped"] or manifest["repaired"] or manifest["gaps"] or manifest["discontinuities"]:
+        print(
+            f"Segment check of {key}: {len(manifest['dropped'])} dropped, {len(manifest['repaired'])} repaired, "
+            f"{len(manifest['gaps'])} gap(s), {len(manifest['discontinuities'])} discontinuity(ies)."
+        )
+    if not manifest["segments"]:
+        print(f"Error: No usable segments in {key}. Leaving it as HLS.")
+        return
+
+    clean_playlist = clean_playlist_path(hour_identifier, camera)
+    write_playlist(
+        clean_playlist,
+        [(segment["name"], segment["duration"]) for segment in manifest["segments"]],
+        precheck.get("init_segment"),
+    )
+    queue_consolidation_jobs(hour_identifier, clean_playlist, camera)
+
+
+def clean_playlist_path(hour_identifier, camera=None):
+    """Returns the path of the playlist of an hour's checked segments."""
+    camera = camera or DEFAULT_CAMERA
+    return os.path.join(hour_directory(hour_identifier, camera), f".consolidating_{worker_tag()}{hour_identifier}.m3u8")
+
+
+def job_file_name(hour_identifier, camera=None):
+    """Returns the name of an hour's job file in JOB_QUEUE_PATH; names sort oldest hour first."""
+    camera = camera or DEFAULT_CAMERA
+    return f"{hour_identifier}.json" if camera.name is None else f"{hour_identifier}@{camera.name}.json"
+
+
+def enqueue_hour(hour_identifier, camera=None):
+    """Hands a finished hour to the workers through the job queue, unless it is queued or claimed already."""
+    camera = camera or DEFAULT_CAMERA
+    name = job_file_name(hour_identifier, camera)
+    queued_path = os.path.join(JOB_QUEUE_PATH, "queued", name)
+    if os.path.exists(queued_path) or os.path.exists(os.path.join(JOB_QUEUE_PATH, "claimed", name)):
+        print(f"{camera.job_key(hour_identifier)} is already in the job queue. Skipping.")
+        return
+    try:
+        for subdirectory in ("queued", "claimed"):
+            os.makedirs(os.path.join(JOB_QUEUE_PATH, subdirectory), exist_ok=True)
+        with open(queued_path + ".tmp", "w") as f:
+            json.dump({"hour": hour_identifier, "camera": camera.name, "queued_at": time.time()}, f)
+        os.replace(queued_path + ".tmp", queued_path)
+        print(f"Queued {camera.job_key(hour_identifier)} for the workers.")
+    except OSError as e:
+        print(f"Error queueing {camera.job_key(hour_identifier)} for the workers: {e}")
+
+
+def remove_stale_temp_files(hour_identifier, camera=None):
+    """Deletes temporary files other workers left behind for an hour this worker just claimed.
+
+    Only the claim holder works on an hour, so any such file belongs to a
+    worker that died or lost its lease.
+    """
+    camera = camera or DEFAULT_CAMERA
+    directory = hour_directory(hour_identifier, camera)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith(CONSOLIDATION_TEMP_PREFIXES) and hour_identifier in name and worker_tag() not in name:
+            print(f"Deleting incomplete output {name} of another worker")
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+def worker_tag():
+    """Returns "<worker id>." in worker mode, or "" otherwise.
+
+    It goes into the names of temporary files, so workers that take over
+    an hour from each other never write to the same file.
+    """
+    return f"{worker_id}." if worker_id else ""
+
+
+def claim_next_job():
+    """Claims the oldest queued hour and returns (camera, hour identifier), or None.
+
+    The rename into claimed/ is atomic, so of several workers racing for
+    the same job exactly one succeeds. The winner then writes its worker ID
+    into the claim.
+    """
+    queued_dir = os.path.join(JOB_QUEUE_PATH, "queued")
+    try:
+        names = sorted(name for name in os.listdir(queued_dir) if name.endswith(".json"))
+    except FileNotFoundError:
+        return None
+    for name in names:
+        claim_path = os.path.join(JOB_QUEUE_PATH, "claimed", name)
+        try:
+            # The rename keeps the mtime from enqueueing, which other workers
+            # would read as an expired lease
+            os.utime(os.path.join(queued_dir, name))
+            os.rename(os.path.join(queued_dir, name), claim_path)
+        except FileNotFoundError:
+            continue  # Claimed by another worker
+        try:
+            with open(claim_path) as f:
+                job = json.load(f)
+            job["worker"] = worker_id
+            # Rewriting the claim also renews its mtime, which is the lease
+            with open(claim_path + f".{worker_id}.tmp", "w") as f:
+                json.dump(job, f)
+            os.replace(claim_path + f".{worker_id}.tmp", claim_path)
+        except FileNotFoundError:
+            continue  # Reclaimed by another worker meanwhile
+        except (OSError, ValueError) as e:
+            print(f"Error reading claimed job {name}: {e}")
+            try:
+                os.remove(claim_path)
+            except FileNotFoundError:
+                pass
+            continue
+        camera = DEFAULT_CAMERA if job["camera"] is None else find_camera(job["camera"]) or Camera(job["camera"])
+        claimed_jobs[camera.job_key(job["hour"])] = (claim_path, time.time())
+        remove_stale_temp_files(job["hour"], camera)
+        print(f"Worker {worker_id} claimed {camera.job_key(job['hour'])}.")
+        return camera, job["hour"]
+    return None
+
+
+def owns_claim(claim_path):
+    """Returns True if the claim exists and names this worker."""
+    try:
+        with open(claim_path) as f:
+            return json.load(f).get("worker") == worker_id
+    except (OSError, ValueError):
+        return False
+
+
+def renew_job_leases():
+    """Touches the claims of running jobs so other workers do not take them over.
+
+    A job whose claim is gone or names another worker lost its lease: it is
+    stopped here, since another worker may be encoding the hour already.
+    """
+    for key, (claim_path, renewed_at) in list(claimed_jobs.items()):
+        if time.time() - renewed_at < JOB_LEASE_SECONDS / 3:
+            continue
+        if not owns_claim(claim_path):
+            print(f"Warning: The lease on {key} expired and was taken over by another worker. Stopping it.")
+            del claimed_jobs[key]
+            abandon_consolidation(key)
+            continue
+        try:
+            os.utime(claim_path)
+            claimed_jobs[key] = (claim_path, time.time())
+        except FileNotFoundError:
+            pass  # Reclaimed just now; noticed on the next renewal
+
+
+def abandon_consolidation(hour_key):
+    """Drops the queued and running jobs of an hour and deletes their temporary files."""
+    consolidation_queue[:] = [job for job in consolidation_queue if job["camera"].job_key(job["hour"]) != hour_key]
+    segment_prechecks.pop(hour_key, None)  # Probes still running are ignored
+    for identifier, proc in list(consolidation_processes.items()):
+        job = consolidation_jobs.get(identifier)
+        if job is None or job["camera"].job_key(job["hour"]) != hour_key:
+            continue
+        print(f"Stopping consolidation process {identifier} (PID: {proc.pid})...")
+        try:
+            os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+        finish_job_output(job, proc)
+        del consolidation_processes[identifier]
+        del consolidation_jobs[identifier]
+        temp_paths = [consolidation_temp_path(job["hour"], job["camera"]), clean_playlist_path(job["hour"], job["camera"])]
+        temp_paths += [temp for temp, _ in consolidation_extra_outputs(job).values()]
+        if job["kind"] == "activity":
+            temp_paths.append(job["output"])
+        for temp_path in temp_paths:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+        remove_chunk_files(job["hour"], job["camera"])
+
+
+def reclaim_expired_jobs():
+    """Returns claims whose lease ran out, e.g. of a worker that died, to the queue."""
+    claimed_dir = os.path.join(JOB_QUEUE_PATH, "claimed")
+    try:
+        names = [name for name in os.listdir(claimed_dir) if name.endswith(".json")]
+    except FileNotFoundError:
+        return
+    for name in names:
+        claim_path = os.path.join(claimed_dir, name)
+        try:
+            if time.time() - os.stat(claim_path).st_mtime < JOB_LEASE_SECONDS:
+                continue
+            os.rename(claim_path, os.path.join(JOB_QUEUE_PATH, "queued", name))
+            print(f"Lease on {name} expired. Returned it to the job queue.")
+        except FileNotFoundError:
+            continue  # Finished or reclaimed by another worker meanwhile
+
+
+def release_finished_jobs():
+    """Removes the claims of hours that are no longer queued, checked or encoding in this worker."""
+    for key, (claim_path, _) in list(claimed_jobs.items()):
+        if is_consolidation_scheduled(key):
+            continue
+        del claimed_jobs[key]
+        if not owns_claim(claim_path):
+            print(f"Warning: {key} finished after another worker took it over. Leaving its claim alone.")
+            continue
+        try:
+            os.remove(claim_path)
+        except FileNotFoundError:
+            pass
+        print(f"Worker {worker_id} finished {key}.")
+
+
+def return_claimed_jobs():
+    """Puts the claims of a stopping worker back into the queue for another worker."""
+    for key, (claim_path, _) in list(claimed_jobs.items()):
+        if not owns_claim(claim_path):
+            continue
+        try:
+            os.rename(claim_path, os.path.join(JOB_QUEUE_PATH, "queued", os.path.basename(claim_path)))
+            print(f"Returned {key} to the job queue.")
+        except OSError:
+            pass
+    claimed_jobs.clear()
+
+
+def run_worker():
+    """Claims queued hours from JOB_QUEUE_PATH and consolidates them (the `worker` command).
+
+    Each worker runs up to MAX_CONSOLIDATION_JOBS hours at a time with the
+    same scheduler as the recorder, so several workers on other nodes can
+    drain the queue in parallel.
+    """
+    global worker_id
+    if not JOB_QUEUE_PATH:
+        print("Error: JOB_QUEUE_PATH is not set. Nothing to work on.")
+        exit(1)
+    worker_id = f"{os.uname().nodename}-{os.getpid()}"
+    for subdirectory in ("queued", "claimed"):
+        os.makedirs(os.path.join(JOB_QUEUE_PATH, subdirectory), exist_ok=True)
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    install_event_wakeup()
+    print(f"Worker {worker_id} waiting for jobs in {JOB_QUEUE_PATH}.")
+
+    while True:
+        reclaim_expired_jobs()
+        renew_job_leases()
+        check_consolidation_status()
+        release_finished_jobs()
+        while len(claimed_jobs) < MAX_CONSOLIDATION_JOBS:
+            claimed = claim_next_job()
+            if claimed is None:
+                break
+            camera, hour_identifier = claimed
+            consolidate_hourly_archive(hour_identifier, camera)
+        wait_for_events(min(JOB_POLL_SECONDS, JOB_LEASE_SECONDS / 3))
+
+
+def journal_entry_path(hour_identifier, camera=None):
+    """Returns the path of an hour's consolidation journal entry."""
+    camera = camera or DEFAULT_CAMERA
+    return os.path.join(camera.archive_path, CONSOLIDATION_JOURNAL_DIR, hour_identifier)
+
+
+def read_journal_entry(hour_identifier, camera=None):
+    """Returns how often consolidation of an hour was started without finishing (0 if never)."""
+    try:
+        with open(journal_entry_path(hour_identifier, camera)) as f:
+            return int(f.readline().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def write_journal_entry(hour_identifier, camera=None, attempts=1, encoder_settings=None):
+    """Journals an hour as queued for consolidation.
+
+    The first line is the attempt count; encoder_settings, the (preset,
+    threads) chosen by choose_encoder_settings, go on a second line.
+    """
+    path = journal_entry_path(hour_identifier, camera)
+    try:
+        try:
+            os.mkdir(os.path.dirname(path))
+        except FileExistsError:
+            pass
+        with open(path + ".tmp", "w") as f:
+            f.write(f"{attempts}\n")
+            if encoder_settings:
+                f.write(f"{encoder_settings[0]} {encoder_settings[1]}\n")
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Warning: Could not journal consolidation of {hour_identifier}: {e}")
+
+
+def remove_journal_entry(hour_identifier, camera=None):
+    """Removes an hour from the consolidation journal once its MP4 is in place."""
+    try:
+        os.remove(journal_entry_path(hour_identifier, camera))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Warning: Could not remove journal entry of {hour_identifier}: {e}")
+
+
+def consolidation_extra_outputs(job):
+    """Returns {"proxy"/"thumbnails": (temporary path, final path)} produced by a job's encode.
+
+    Only single-pass H.265 hour jobs decode the footage, so only they produce
+    extra outputs.
+    """
+    if job["kind"] != "hour" or CONSOLIDATION_MODE == "copy":
+        return {}
+    hour_identifier = job["hour"]
+    directory = hour_directory(hour_identifier, job["camera"])
+    temp_prefix = os.path.join(directory, f".consolidating_{worker_tag()}{hour_identifier}")
+    outputs = {}
+    if PROXY_HEIGHT:
+        outputs["proxy"] = (temp_prefix + ".proxy.mp4", os.path.join(directory, f"proxy_{hour_identifier}.mp4"))
+    if THUMBNAIL_INTERVAL_SECONDS:
+        outputs["thumbnails"] = (
+            temp_prefix + ".thumbs.jpg", os.path.join(directory, f"thumbs_{hour_identifier}.jpg")
+        )
+    return outputs
+
+
+def consolidation_temp_path(hour_identifier, camera=None):
+    """Returns the temporary output path of a consolidation; it is renamed once complete."""
+    camera = camera or DEFAULT_CAMERA
+    return os.path.join(hour_directory(hour_identifier, camera), f".consolidating_{worker_tag()}{hour_identifier}.mp4")
+
+
+def is_consolidation_scheduled(hour_key):
+    """Returns True if any job for the camera's hour is queued or running."""
+    return any(
+        job["camera"].job_key(job["hour"]) == hour_key
+        for job in consolidation_queue + list(consolidation_jobs.values())
+    ) or hour_key in consolidation_processes or hour_key in segment_prechecks
+
+
+def plan_chunk_jobs(hour_identifier, hourly_playlist, camera=None):
+    """Splits an hour's playlist into CONSOLIDATION_CHUNKS contiguous chunk jobs.
+
+    HLS segments always start on a keyframe, so cutting between segments keeps
+    every chunk keyframe-aligned and the chunks can be joined losslessly.
+    Returns None if the hour is too short to be worth splitting.
+    """
+    camera = camera or DEFAULT_CAMERA
+    try:
+        entries = read_playlist_entries(hourly_playlist)
+        init_segment = read_playlist_map(hourly_playlist)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read {hourly_playlist} for chunking: {e}")
+        return None
+    chunk_count = min(CONSOLIDATION_CHUNKS, len(entries))
+    if chunk_count < 2:
+        return None
+
+    key = camera.job_key(hour_identifier)
+    jobs = []
+    for index in range(chunk_count):
+        chunk_entries = entries[
+            index * len(entries) // chunk_count:(index + 1) * len(entries) // chunk_count
+        ]
+        chunk_playlist = chunk_path(hour_identifier, f"{index:03d}.m3u8", camera)
+        write_playlist(chunk_playlist, chunk_entries, init_segment)
+        jobs.append({
+            "key": f"{key}.chunk{index:03d}",
+            "hour": hour_identifier,
+            "camera": camera,
+            "kind": "chunk",
+            "input": chunk_playlist,
+            "output": chunk_path(hour_identifier, f"{index:03d}.mp4", camera),
+        })
+    chunked_hours[key] = {
+        "outputs": [job["output"] for job in jobs],
+        "remaining": chunk_count,
+        "failed": False,
+    }
+    print(f"Split {key} into {chunk_count} chunk(s) of ~{len(entries) // chunk_count} segment(s).")
+    return jobs
+
+
+def chunk_path(hour_identifier, suffix, camera=None):
+    """Returns the path of a temporary chunk file for an hour."""
+    camera = camera or DEFAULT_CAMERA
+    return os.path.join(hour_directory(hour_identifier, camera), f".chunk_{worker_tag()}{hour_identifier}_{suffix}")
+
+
+def dispatch_consolidation_jobs():
+    """Starts queued consolidation jobs while there is a free job slot."""
+    while consolidation_queue and len(consolidation_processes) < MAX_CONSOLIDATION_JOBS:
+        job = consolidation_queue.pop(0)
+        # Backpressure: trade compression for speed while the backlog is long
+        backlog_hours = {
+            queued["camera"].job_key(queued["hour"])
+            for queued in consolidation_queue
+            if queued["kind"] != "activity"
+        } - {job["camera"].job_key(job["hour"])}
+        if len(backlog_hours) >= CONSOLIDATION_BACKLOG_THRESHOLD:
+            job["preset"] = CONSOLIDATION_BACKLOG_PRESET
+        elif CONSOLIDATION_LATENCY_BUDGET_SECONDS and job["kind"] == "hour" and CONSOLIDATION_MODE != "copy":
+            # Time already spent waiting in the queue counts against the budget
+            budget = CONSOLIDATION_LATENCY_BUDGET_SECONDS - (time.time() - job["queued_at"])
+            job["footage_seconds"] = job_footage_seconds(job)
+            job["preset"], job["threads"] = choose_encoder_settings(job["camera"], job["footage_seconds"], budget)
+            print(
+                f"Encoding {job['key']} with preset {job['preset']} on {job['threads']} thread(s) "
+                f"({budget:.0f}s latency budget left)."
+            )
+            write_journal_entry(
+                job["hour"], job["camera"], read_journal_entry(job["hour"], job["camera"]) or 1,
+                (job["preset"], job["threads"]),
+            )
+        else:
+            job["preset"] = CONSOLIDATION_PRESET
+        start_consolidation_job(job)
+
+
+def job_footage_seconds(job):
+    """Returns the seconds of footage of an hour job, from the index or its playlist."""
+    duration = indexed_hour_duration(job["hour"], job["camera"])
+    if duration:
+        return duration
+    playlist = job.get("input") or os.path.join(
+        hour_directory(job["hour"], job["camera"]), f"playlist_{job['hour']}.m3u8"
+    )
+    try:
+        return sum(d or SEGMENT_TIME_SECONDS for _, d in read_playlist_entries(playlist)) or 3600.0
+    except (OSError, ValueError):
+        return 3600.0
+
+
+def load_encoder_model(camera):
+    """Returns the {preset: realtime factor per thread} model of a camera, read from disk once."""
+    name = camera.name or ""
+    if name not in encoder_models:
+        try:
+            with open(os.path.join(camera.archive_path, ENCODER_MODEL_FILE)) as f:
+                encoder_models[name] = json.load(f)
+        except (OSError, ValueError):
+            encoder_models[name] = {}
+    return encoder_models[name]
+
+
+def estimate_preset_speed(model, preset):
+    """Returns the expected realtime factor per thread of a preset, or None without any measurement.
+
+    A preset not measured yet is extrapolated from the nearest measured one,
+    ENCODER_PRESET_SLOWDOWN per step. Measurements of presets outside
+    CONSOLIDATION_ADAPTIVE_PRESETS are not used.
+    """
+    presets = CONSOLIDATION_ADAPTIVE_PRESETS
+    measured = [(index, model[p]) for index, p in enumerate(presets) if model.get(p, 0) > 0]
+    if not measured:
+        return None
+    index = presets.index(preset)
+    if model.get(preset, 0) > 0:
+        return model[preset]
+    nearest, speed = min(measured, key=lambda item: abs(item[0] - index))
+    return speed / ENCODER_PRESET_SLOWDOWN ** (index - nearest)
+
+
+def choose_encoder_settings(camera, footage_seconds, budget_seconds):
+    """Returns (preset, threads) for encoding footage_seconds of a camera within budget_seconds.
+
+    The slowest preset that fits wins, with the fewest threads that fit, so
+    spare cores stay free for the other jobs. Threads are drawn from the
+    cores not held by running encodes (see held_encoder_threads). Until a
+    camera has a measurement of one of CONSOLIDATION_ADAPTIVE_PRESETS, the
+    adaptive preset nearest to CONSOLIDATION_PRESET runs on every free
+    thread, so that first encode is a usable measurement; if nothing fits,
+    the fastest preset does.
+    """
+    max_threads = max(1, (os.cpu_count() or 1) - held_encoder_threads())
+    model = load_encoder_model(camera)
+    if estimate_preset_speed(model, CONSOLIDATION_ADAPTIVE_PRESETS[0]) is None:
+        return nearest_adaptive_preset(CONSOLIDATION_PRESET), max_threads
+    for preset in reversed(CONSOLIDATION_ADAPTIVE_PRESETS):
+        speed = estimate_preset_speed(model, preset)
+        for threads in range(1, max_threads + 1):
+            if footage_seconds / (speed * threads) <= budget_seconds:
+                return preset, threads
+    return CONSOLIDATION_ADAPTIVE_PRESETS[0], max_threads
+
+
+def held_encoder_threads():
+    """Returns the x265 threads of the running consolidation encodes that were given a thread count."""
+    held = 0
+    for job in consolidation_jobs.values():
+        if job.get("threads"):
+            held += job["threads"]
+        elif job.get("kind") == "chunk":
+            held += chunk_encoder_threads()
+    return held
+
+
+def chunk_encoder_threads():
+    """Returns the x265 threads of each chunk encode, which share the cores evenly."""
+    return max(1, (os.cpu_count() or 1) // min(CONSOLIDATION_CHUNKS, MAX_CONSOLIDATION_JOBS))
+
+
+def nearest_adaptive_preset(preset):
+    """Returns the preset of CONSOLIDATION_ADAPTIVE_PRESETS closest in speed to a preset."""
+    if preset in CONSOLIDATION_ADAPTIVE_PRESETS:
+        return preset
+    if preset not in X265_PRESETS:
+        return CONSOLIDATION_ADAPTIVE_PRESETS[0]
+    rank = X265_PRESETS.index
+    return min(
+        (p for p in CONSOLIDATION_ADAPTIVE_PRESETS if p in X265_PRESETS),
+        key=lambda p: abs(rank(p) - rank(preset)),
+        default=CONSOLIDATION_ADAPTIVE_PRESETS[0],
+    )
+
+
+def record_encoder_speed(camera, preset, threads, speed):
+    """Folds a finished encode's realtime factor into the camera's model and saves it.
+
+    A moving average lets the model follow changes in load on the node.
+    Speeds that are not positive (e.g. an hour without footage) say
+    nothing about the encoder and are ignored.
+    """
+    if not speed or speed <= 0:
+        return
+    model = load_encoder_model(camera)
+    per_thread = speed / threads
+    previous = model.get(preset)
+    model[preset] = per_thread if previous is None else previous + ENCODER_MODEL_WEIGHT * (per_thread - previous)
+    path = os.path.join(camera.archive_path, ENCODER_MODEL_FILE)
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(model, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Warning: Could not save the encoder model of camera {camera}: {e}")
+
+
+def build_consolidation_command(job):
+    """Returns the ffmpeg command for a consolidation job of any kind."""
+    hour_identifier = job["hour"]
+    directory = hour_directory(hour_identifier, job["camera"])
+    # Written under a temporary name so a half-written MP4 never looks complete
+    output_mp4 = consolidation_temp_path(hour_identifier, job["camera"])
+
+    if job["kind"] == "chunk":
+        # Share the cores between the chunks encoding in parallel
+        command = build_transcode_command(job["input"], job["output"], job["preset"])
+        command[-1:-1] = ["-x265-params", f"pools={chunk_encoder_threads()}"]
+        return command
+    if job["kind"] == "stitch":
+        return with_creation_time(build_concat_command(job["input"], output_mp4), job)
+    if job["kind"] == "activity":
+        return build_activity_command(job["input"], job["output"])
+
+    hourly_playlist = job.get("input") or os.path.join(
+        directory, f"playlist_{hour_identifier}.m3u8"
+    )
+    if CONSOLIDATION_MODE == "copy" and uses_fmp4_segments():
+        return build_append_command(hourly_playlist, output_mp4, footage_start_timestamp(job))
+    if CONSOLIDATION_MODE == "copy":
+        return with_creation_time(build_remux_command(hourly_playlist, output_mp4), job)
+    extra_outputs = consolidation_extra_outputs(job)
+    if extra_outputs:
+        command = build_multi_output_command(
+            hourly_playlist,
+            output_mp4,
+            job["preset"],
+            proxy_path=extra_outputs.get("proxy", (None,))[0],
+            thumbnails_path=extra_outputs.get("thumbnails", (None,))[0],
+        )
+    else:
+        command = build_transcode_command(hourly_playlist, output_mp4, job["preset"])
+    if job.get("threads"):
+        # Chosen by choose_encoder_settings; applies to the archive output and is kept in its comment
+        position = command.index(output_mp4)
+        command[position:position] = [
+            "-x265-params", f"pools={job['threads']}",
+            "-metadata", f"comment=x265 preset={job['preset']} threads={job['threads']}",
+        ]
+    return with_creation_time(command, job)
+
+
+def with_creation_time(command, job):
+    """Stamps the archive MP4 of a consolidation command with the time its footage starts.
+
+    The hour's first segment may start well after :00 (e.g. the recorder
+    was started mid-hour), so exports read the start from the MP4's
+    creation_time. Compaction and downsampling carry it over.
+    """
+    output_mp4 = consolidation_temp_path(job["hour"], job["camera"])
+    started_at = footage_start_timestamp(job)
+    creation_time = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(started_at)) + f".{int(started_at % 1 * 1000):03d}Z"
+    position = command.index(output_mp4)
+    command[position:position] = ["-metadata", f"creation_time={creation_time}"]
+    return command
+
+
+def footage_start_timestamp(job):
+    """Returns the Unix time the first segment of a consolidation job's hour starts at."""
+    segments = hour_segment_offsets(job["hour"], job["camera"] or DEFAULT_CAMERA)
+    return hour_start_timestamp(job["hour"]) + (segments[0][1] if segments else 0.0)
+
+
+def start_consolidation_job(job):
+    """Starts the ffmpeg process for a dequeued consolidation job."""
+    key = job["key"]
+    command = with_job_priority(with_progress_output(build_consolidation_command(job)))
+    print(f"DEBUG: FFMPEG command being executed for MP4 consolidation: {command}")
+    try:
+        # Use a separate Popen call, don't block the main loop
+        consolidation_proc = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,  # Shutdown signals the encoder's process group, not the archiver
+        )
+        job["started_at"] = time.time()
+        consolidation_processes[key] = consolidation_proc
+        consolidation_jobs[key] = job
+        watch_job_output(job, consolidation_proc)
+        print(
+            f"Consolidation process for {key} started (PID: {consolidation_proc.pid}, "
+            f"waited {job['started_at'] - job['queued_at']:.1f}s, queue depth {len(consolidation_queue)})."
+        )
+    except Exception as e:
+        print(f"Error starting consolidation for {key}: {e}")
+        if job["kind"] == "chunk":
+            finish_chunk_job(job, succeeded=False)
+
+
+def with_progress_output(command):
+    """Makes an ffmpeg command report machine-readable progress on stdout instead of stats on stderr."""
+    if "ffmpeg" not in command:
+        return command  # Fragment appends report no progress
+    position = command.index("ffmpeg") + 1
+    return command[:position] + ["-nostats", "-progress", "pipe:1"] + command[position:]
+
+
+def watch_job_output(job, proc):
+    """Drains a job's stdout (-progress) and stderr (log) from the event loop.
+
+    The pipes are read as soon as data arrives, so a chatty encoder never
+    blocks on a full pipe buffer. Only the latest progress report and the
+    last CONSOLIDATION_LOG_LINES log lines are kept.
+    """
+    reset_job_output(job)
+    if event_selector is None:
+        return  # No event loop (e.g. a maintenance command); read at exit
+    for stream, kind in ((proc.stdout, "progress"), (proc.stderr, "log")):
+        os.set_blocking(stream.fileno(), False)
+        event_selector.register(
+            stream, selectors.EVENT_READ, lambda stream, kind=kind: read_job_output(job, stream, kind)
+        )
+
+
+def reset_job_output(job):
+    """Sets up the progress and log buffers of a job."""
+    job["progress"] = {}
+    job["log"] = collections.deque(maxlen=CONSOLIDATION_LOG_LINES)
+    job["partial_output"] = {"progress": b"", "log": b""}
+    job["progress_fields"] = {}
+
+
+def read_job_output(job, stream, kind):
+    """Event loop callback: consumes whatever a job's output pipe has to offer."""
+    try:
+        data = os.read(stream.fileno(), 65536)
+    except BlockingIOError:
+        return
+    if not data:
+        event_selector.unregister(stream)
+        return
+    consume_job_output(job, data, kind)
+
+
+def consume_job_output(job, data, kind):
+    """Splits job output into lines and feeds them to the progress parser or log ring buffer."""
+    if "log" not in job:
+        reset_job_output(job)
+    *lines, job["partial_output"][kind] = (job["partial_output"][kind] + data).split(b"\n")
+    for line in lines:
+        line = line.decode(errors="replace").strip()
+        if not line:
+            continue
+        if kind == "log":
+            job["log"].append(line)
+            continue
+        name, _, value = line.partition("=")
+        job["progress_fields"][name] = value
+        if name == "progress":  # Last key of every progress report
+            job["progress"] = parse_progress(job["progress_fields"])
+            job["progress_fields"] = {}
+
+
+def parse_progress(fields):
+    """Returns fps, speed (realtime factor) and out_time (seconds) from an ffmpeg -progress report."""
+    def number(value):
+        try:
+            return float(value.rstrip("x"))
+        except (AttributeError, ValueError):
+            return None  # Missing or "N/A"
+
+    out_time_us = number(fields.get("out_time_us"))
+    return {
+        "fps": number(fields.get("fps")),
+        "speed": number(fields.get("speed")),
+        "out_time": out_time_us / 1000000 if out_time_us is not None else None,
+        "finished": fields.get("progress") == "end",
+    }
+
+
+def finish_job_output(job, proc):
+    """Stops watching a finished job's pipes and consumes what is left in them."""
+    for stream in (proc.stdout, proc.stderr):
+        if event_selector is not None and stream is not None:
+            try:
+                event_selector.unregister(stream)
+            except (KeyError, ValueError):
+                pass  # Already unregistered at EOF
+    stdout, stderr = proc.communicate()
+    for data, kind in ((stdout, "progress"), (stderr, "log")):
+        # The trailing newline flushes a last line without one
+        consume_job_output(job, (data or b"") + b"\n", kind)
+
+
+def format_job_log(job):
+    """Returns the kept log lines of a job for a failure report."""
+    return "\n".join(job.get("log") or [])
+
+
+def finish_chunk_job(job, succeeded):
+    """Tracks a finished chunk and queues the stitch once every chunk of the hour is done."""
+    hour_identifier = job["hour"]
+    camera = job["camera"]
+    key = camera.job_key(hour_identifier)
+    state = chunked_hours.get(key)
+    if state is None:
+        return
+    state["remaining"] -= 1
+    state["failed"] = state["failed"] or not succeeded
+    if state["remaining"] > 0:
+        return
+
+    if state["failed"]:
+        print(f"Consolidation for {key} failed: at least one chunk did not encode.")
+        remove_chunk_files(hour_identifier, camera)
+        return
+
+    concat_list = chunk_path(hour_identifier, "concat.txt", camera)
+    with open(concat_list, "w") as f:
+        for output in state["outputs"]:
+            f.write(f"file '{output}'\n")
+    # Stitching is a cheap stream copy; run it before any other queued work
+    consolidation_queue.insert(0, {
+        "key": key,
+        "hour": hour_identifier,
+        "camera": camera,
+        "kind": "stitch",
+        "input": concat_list,
+        "queued_at": time.time(),
+    })
+
+
+def remove_chunk_files(hour_identifier, camera=None):
+    """Deletes the temporary chunk playlists, encodes and concat list of an hour."""
+    camera = camera or DEFAULT_CAMERA
+    chunked_hours.pop(camera.job_key(hour_identifier), None)
+    prefix = f".chunk_{worker_tag()}{hour_identifier}_"
+    directory = hour_directory(hour_identifier, camera)
+    try:
+        for f in os.listdir(directory):
+            if f.startswith(prefix):
+                os.remove(os.path.join(directory, f))
+    except OSError as e:
+        print(f"Error deleting chunk files for {hour_identifier}: {e}")
+
+
+def with_job_priority(command):
+    """Prefixes an encoder command with nice (CONSOLIDATION_NICE) and ionice (CONSOLIDATION_IONICE_CLASS).
+
+    The priorities are set by the command rather than in the forked child:
+    the archiver runs threads, and code between fork and exec is unsafe then.
+    """
+    if CONSOLIDATION_IONICE_CLASS and shutil.which("ionice"):
+        command = ["ionice", "-c", CONSOLIDATION_IONICE_CLASS] + command
+    if CONSOLIDATION_NICE and shutil.which("nice"):
+        command = ["nice", "-n", str(CONSOLIDATION_NICE)] + command
+    return command
+
+
+def record_consolidation_finished(identifier):
+    """Updates the scheduler statistics for a finished job and returns its run time."""
+    job = consolidation_jobs.pop(identifier, None)
+    if not job:
+        return None
+    run_time = time.time() - job["started_at"]
+    consolidation_stats["last_run_seconds"] = run_time
+    consolidation_stats["last_speed"] = (job.get("progress") or {}).get("speed")
+    consolidation_stats["completed"] += 1
+    consolidation_stats["total_wait_seconds"] += job["started_at"] - job["queued_at"]
+    consolidation_stats["total_run_seconds"] += run_time
+    consolidation_stats["max_run_seconds"] = max(consolidation_stats["max_run_seconds"], run_time)
+    return run_time
+
+
+def get_consolidation_queue_stats():
+    """Returns queue depth, wait and run time figures for sizing nodes."""
+    now = time.time()
+    completed = consolidation_stats["completed"]
+    return {
+        "queue_depth": len(consolidation_queue),
+        "running": len(consolidation_processes),
+        "max_jobs": MAX_CONSOLIDATION_JOBS,
+        "oldest_wait_seconds": max(
+            (now - job["queued_at"] for job in list(consolidation_queue)), default=0
+        ),
+        "completed": completed,
+        "avg_wait_seconds": consolidation_stats["total_wait_seconds"] / completed if completed else 0,
+        "avg_run_seconds": consolidation_stats["total_run_seconds"] / completed if completed else 0,
+        "max_run_seconds": consolidation_stats["max_run_seconds"],
+        "last_run_seconds": consolidation_stats["last_run_seconds"],
+        "last_speed": consolidation_stats["last_speed"],
+        # Live fps, speed and encoded position of every running job
+        "running_jobs": {key: job.get("progress") or {} for key, job in list(consolidation_jobs.items())},
+    }
+
+
+def check_consolidation_status():
+    """Checks the status of ongoing consolidation processes."""
+    global consolidation_processes
+    collect_segment_prechecks()
+    completed_identifiers = []
+    for identifier, proc in consolidation_processes.items():
+        if proc.poll() is not None:  # Process has finished
+            job = consolidation_jobs.get(identifier) or {
+                "hour": identifier, "camera": DEFAULT_CAMERA, "kind": "hour",
+            }
+            finish_job_output(job, proc)
+            hour_identifier = job["hour"]
+            directory = hour_directory(hour_identifier, job["camera"])
+            run_time = record_consolidation_finished(identifier)
+            if job["kind"] == "activity":
+                finish_activity_job(job, succeeded=proc.returncode == 0)
+            elif job["kind"] == "chunk":
+                if proc.returncode != 0:
+                    print(f"Consolidation chunk {identifier} failed with code {proc.returncode}.")
+                    print(f"STDERR (last lines):\n{format_job_log(job)}")
+                finish_chunk_job(job, succeeded=proc.returncode == 0)
+            elif proc.returncode == 0 and not finish_consolidation_output(job):
+                if job["kind"] == "stitch":
+                    remove_chunk_files(hour_identifier, job["camera"])
+            elif proc.returncode == 0:
+                speed = (job.get("progress") or {}).get("speed")
+                if run_time is None:
+                    print(f"Consolidation for {identifier} finished successfully.")
+                elif speed is None:
+                    print(f"Consolidation for {identifier} finished successfully in {run_time:.1f}s.")
+                else:
+                    print(
+                        f"Consolidation for {identifier} finished successfully in {run_time:.1f}s "
+                        f"({speed:.1f}x realtime)."
+                    )
+                if job.get("threads") and run_time:
+                    record_encoder_speed(
+                        job["camera"], job["preset"], job["threads"], speed or job["footage_seconds"] / run_time
+                    )
+                if CONSOLIDATION_MODE == "copy":
+                    mark_for_compaction(hour_identifier, job["camera"])
+                if job["kind"] == "stitch":
+                    remove_chunk_files(hour_identifier, job["camera"])
+                index_file(
+                    os.path.join(directory, f"archive_{hour_identifier}.mp4"),
+                    job["camera"],
+                    "remuxed" if CONSOLIDATION_MODE == "copy" else "complete",
+                    indexed_hour_duration(hour_identifier, job["camera"]),
+                )
+                if ACTIVITY_INTERVAL_SECONDS:
+                    queue_activity_job(hour_identifier, job["camera"])
+                delete_hour_hls_files(hour_identifier, job["camera"])
+            else:
+                print(
+                    f"Consolidation for {identifier} failed with code {proc.returncode}."
+                )
+                print(f"STDERR (last lines):\n{format_job_log(job)}")
+                for temp_path in [consolidation_temp_path(hour_identifier, job["camera"])] + [
+                    temp for temp, _ in consolidation_extra_outputs(job).values()
+                ]:
+                    try:
+                        os.remove(temp_path)
+                    except OSError:
+                        pass
+                if job["kind"] == "stitch":
+                    remove_chunk_files(hour_identifier, job["camera"])
+            completed_identifiers.append(identifier)
+
+    for identifier in completed_identifiers:
+        del consolidation_processes[identifier]
+
+    # Freed slots go to the oldest queued hours
+    dispatch_consolidation_jobs()
+
+
+def activity_path(hour_identifier, camera=None):
+    """Returns the path of an hour's activity timeline."""
+    camera = camera or DEFAULT_CAMERA
+    return os.path.join(hour_directory(hour_identifier, camera), f"activity_{hour_identifier}.bin")
+
+
+def queue_activity_job(hour_identifier, camera=None):
+    """Queues activity analysis of a consolidated hour.
+
+    Must run before the hour's HLS files are deleted: the first segment's
+    offset anchors the timeline within the hour.
+    """
+    camera = camera or DEFAULT_CAMERA
+    directory = hour_directory(hour_identifier, camera)
+    segments = hour_segment_offsets(hour_identifier, camera)
+    consolidation_queue.append({
+        "key": f"{camera.job_key(hour_identifier)}.activity",
+        "hour": hour_identifier,
+        "camera": camera,
+        "kind": "activity",
+        "input": os.path.join(directory, f"archive_{hour_identifier}.mp4"),
+        "output": os.path.join(directory, f".activity_{worker_tag()}{hour_identifier}.gray"),
+        "start_offset": int(segments[0][1]) if segments else 0,
+        "queued_at": time.time(),
+    })
+    consolidation_queue.sort(key=lambda job: (job["hour"], job["key"]))
+
+
+def score_activity(frames, interval_frames):
+    """Returns one activity score (0-100) per interval of raw grayscale frames.
+
+    A frame's score is the percentage of pixels that changed by more than
+    ACTIVITY_PIXEL_THRESHOLD since the previous frame; an interval scores its
+    busiest frame. Vectorized with NumPy when it is installed.
+    """
+    frame_size = ACTIVITY_FRAME_WIDTH * ACTIVITY_FRAME_HEIGHT
+    count = len(frames) // frame_size
+    intervals = -(-count // interval_frames)
+    if numpy is not None:
+        pixels = numpy.frombuffer(frames, numpy.uint8, count * frame_size).reshape(count, frame_size)
+        changed = numpy.abs(numpy.diff(pixels.astype(numpy.int16), axis=0)) > ACTIVITY_PIXEL_THRESHOLD
+        percentages = numpy.zeros(intervals * interval_frames)
+        percentages[1:count] = changed.sum(axis=1) * 100 / frame_size
+        return percentages.reshape(intervals, interval_frames).max(axis=1).round().astype(numpy.uint8).tobytes()
+
+    scores = [0] * intervals
+    for index in range(1, count):
+        previous = frames[(index - 1) * frame_size:index * frame_size]
+        current = frames[index * frame_size:(index + 1) * frame_size]
+        changed = sum(1 for a, b in zip(previous, current) if abs(a - b) > ACTIVITY_PIXEL_THRESHOLD)
+        interval = index // interval_frames
+        scores[interval] = max(scores[interval], round(changed * 100 / frame_size))
+    return bytes(scores)
+
+
+def finish_activity_job(job, succeeded):
+    """Scores the frames decoded by an activity job into the hour's activity_<hour>.bin."""
+    hour_identifier = job["hour"]
+    camera = job["camera"]
+    try:
+        if not succeeded:
+            print(f"Activity analysis for {job['key']} failed.")
+            print(f"STDERR (last lines):\n{format_job_log(job)}")
+            return
+        with open(job["output"], "rb") as f:
+            scores = score_activity(f.read(), ACTIVITY_INTERVAL_SECONDS)
+        path = activity_path(hour_identifier, camera)
+        with open(path + ".tmp", "wb") as f:
+            f.write(ACTIVITY_HEADER.pack(ACTIVITY_INTERVAL_SECONDS, job.get("start_offset", 0)) + scores)
+        os.replace(path + ".tmp", path)
+        index_file(path, camera, "complete")
+        print(f"Activity index for {job['key']} written: {len(scores)} interval(s), peak {max(scores, default=0)}%.")
+    except OSError as e:
+        print(f"Warning: Could not write activity index for {job['key']}: {e}")
+    finally:
+        try:
+            os.remove(job["output"])
+        except OSError:
+            pass
+
+
+def finish_consolidation_output(job):
+    """Moves a finished consolidation into place as archive_<hour>.mp4, with its extra outputs.
+
+    Returns False if the archive could not be moved; the hour stays journaled
+    and its HLS files are kept.
+    """
+    hour_identifier = job["hour"]
+    camera = job["camera"]
+    archive_mp4 = os.path.join(hour_directory(hour_identifier, camera), f"archive_{hour_identifier}.mp4")
+    # Extra outputs first: once the archive is in place the hour counts as done
+    for temp_path, final_path in consolidation_extra_outputs(job).values():
+        try:
+            os.replace(temp_path, final_path)
+            index_file(final_path, camera, "complete")
+        except OSError as e:
+            print(f"Warning: Could not move {temp_path} into place: {e}")
+    try:
+        os.replace(consolidation_temp_path(hour_identifier, camera), archive_mp4)
+    except OSError as e:
+        print(f"Error moving consolidated archive into place for {camera.job_key(hour_identifier)}: {e}")
+        return False
+    remove_journal_entry(hour_identifier, camera)
+    return True
+
+
+def delete_hour_hls_files(hour_identifier, camera=None):
+    """Deletes the segments and playlist of a consolidated hour."""
+    camera = camera or DEFAULT_CAMERA
+    directory = hour_directory(hour_identifier, camera)
+    deleted = []
+    try:
+        if get_archive_index() is not None:
+            hls_files = indexed_hour_files(hour_identifier, camera, ("segment", "playlist"))
+        else:
+            hls_files = [
+                os.path.join(directory, f)
+                for f in os.listdir(directory)
+                if f.startswith(f"{hour_identifier}_segment_") or f == f"playlist_{hour_identifier}.m3u8"
+            ]
+        for file_to_delete in hls_files:
+            try:
+                os.remove(file_to_delete)
+            except FileNotFoundError:
+                pass
+            deleted.append(file_to_delete)
+            print(f"Deleted HLS file: {file_to_delete}")
+    except Exception as e:
+        print(f"Error deleting HLS files for {camera.job_key(hour_identifier)}: {e}")
+    if SEGMENT_PROBE_WORKERS:
+        try:
+            os.remove(clean_playlist_path(hour_identifier, camera))
+        except OSError:
+            pass
+        for path in deleted:
+            segment_probe_cache.pop(path, None)
+    unindex_files(deleted)
+
+
+def mark_for_compaction(hour_identifier, camera=None):
+    """Records that archive_<hour>.mp4 is a stream copy still waiting for H.265 compaction."""
+    camera = camera or DEFAULT_CAMERA
+    marker_dir = os.path.join(camera.archive_path, COMPACTION_MARKER_DIR)
+    try:
+        os.makedirs(marker_dir, exist_ok=True)
+        open(os.path.join(marker_dir, hour_identifier), "w").close()
+    except OSError as e:
+        print(f"Error marking {hour_identifier} for compaction: {e}")
+
+
+def pending_compactions():
+    """Returns the (camera, hour identifier) pairs waiting for compaction, oldest first."""
+    pending = []
+    for camera in get_cameras():
+        try:
+            hours = os.listdir(os.path.join(camera.archive_path, COMPACTION_MARKER_DIR))
+        except FileNotFoundError:
+            continue
+        pending.extend((camera, hour_identifier) for hour_identifier in hours)
+    return sorted(pending, key=lambda item: (item[1], item[0].job_key(item[1])))
+
+
+def is_compaction_allowed():
+    """Returns True inside the compaction window or while the node is idle enough."""
+    if COMPACTION_WINDOW:
+        start_hour, end_hour = (int(h) for h in COMPACTION_WINDOW.split("-"))
+        hour = datetime.utcnow().hour
+        if start_hour <= end_hour:
+            in_window = start_hour <= hour < end_hour
+        else:  # Window wraps around midnight, e.g. "22-4"
+            in_window = hour >= start_hour or hour < end_hour
+        if in_window:
+            return True
+    if COMPACTION_MAX_LOAD is not None:
+        return os.getloadavg()[0] < COMPACTION_MAX_LOAD
+    return False
+
+
+def start_compaction(hour_identifier, camera=None, downsample=False):
+    """Starts re-encoding a remuxed hourly MP4 to H.265 into a temporary file.
+
+    With downsample, an aged archive is re-encoded at the lower
+    DOWNSAMPLE_HEIGHT and DOWNSAMPLE_CRF instead.
+    """
+    camera = camera or DEFAULT_CAMERA
+    archive_mp4 = os.path.join(hour_directory(hour_identifier, camera), f"archive_{hour_identifier}.mp4")
+    if not os.path.exists(archive_mp4):
+        print(f"Warning: {archive_mp4} not found for compaction. Skipping.")
+        if not downsample:
+            os.remove(os.path.join(camera.archive_path, COMPACTION_MARKER_DIR, hour_identifier))
+        return None
+
+    # The output is only moved over the archive once the encode succeeded
+    build_command = build_downsample_command if downsample else build_transcode_command
+    command = with_job_priority(build_command(archive_mp4, compaction_temp_path(hour_identifier, camera)))
+    print(f"DEBUG: FFMPEG command being executed for {'downsampling' if downsample else 'compaction'}: {command}")
+    proc, log = start_background_encode(command)
+    compaction_processes[camera.job_key(hour_identifier)] = (
+        camera, hour_identifier, proc, "downsampling" if downsample else "compaction", log
+    )
+    print(
+        f"{'Downsampling' if downsample else 'Compaction'} process for {camera.job_key(hour_identifier)} "
+        f"started (PID: {proc.pid})."
+    )
+    return proc
+
+
+def start_background_encode(command):
+    """Starts a compaction, downsampling or rollup ffmpeg. Returns (process, log file).
+
+    Nothing reads these processes while they run, so their errors go to an
+    unnamed temporary file: a pipe would fill up and stall ffmpeg.
+    """
+    position = command.index("ffmpeg") + 1
+    command[position:position] = ["-nostats", "-loglevel", "error"]
+    log = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        command,
+        stdout=subprocess.DEVNULL,
+        stderr=log,
+        start_new_session=True,
+    )
+    return proc, log
+
+
+def read_encoder_log(log):
+    """Returns the contents of a background encoder's log file and closes it."""
+    with log:
+        log.seek(0)
+        return log.read()
+
+
+def indexed_mp4_duration(mp4_path):
+    """Returns the indexed duration of an MP4, or None."""
+    index = get_archive_index()
+    if index is None:
+        return None
+    row = index.execute(
+        "SELECT duration FROM files WHERE path = ?", (os.path.relpath(mp4_path, ARCHIVE_PATH),)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def compaction_temp_path(hour_identifier, camera=None):
+    """Returns the temporary output path of a compaction encode."""
+    camera = camera or DEFAULT_CAMERA
+    return os.path.join(hour_directory(hour_identifier, camera), f".compacting_{hour_identifier}.mp4")
+
+
+def finish_compaction(hour_identifier, returncode, stderr, camera=None, downsample=False):
+    """Atomically replaces the remuxed MP4 with its compacted version.
+
+    A downsampled hour is recorded in DOWNSAMPLE_DONE_DIR, even if the encode
+    failed, so it is not retried on every cleanup pass.
+    """
+    camera = camera or DEFAULT_CAMERA
+    temp_mp4 = compaction_temp_path(hour_identifier, camera)
+    archive_mp4 = os.path.join(hour_directory(hour_identifier, camera), f"archive_{hour_identifier}.mp4")
+    marker_dir = DOWNSAMPLE_DONE_DIR if downsample else COMPACTION_MARKER_DIR
+    marker = os.path.join(camera.archive_path, marker_dir, hour_identifier)
+    key = camera.job_key(hour_identifier)
+    task = "Downsampling" if downsample else "Compaction"
+    try:
+        if returncode == 0:
+            os.replace(temp_mp4, archive_mp4)
+            if downsample:
+                os.makedirs(os.path.dirname(marker), exist_ok=True)
+                open(marker, "w").close()
+            else:
+                os.remove(marker)
+            index_file(
+                archive_mp4, camera, "downsampled" if downsample else "compacted", indexed_mp4_duration(archive_mp4)
+            )
+            print(f"{task} for {key} finished successfully.")
+        else:
+            print(f"{task} for {key} failed with code {returncode}.")
+            print(f"STDERR:\n{stderr.decode()}")
+            if os.path.exists(temp_mp4):
+                os.remove(temp_mp4)
+            if downsample:
+                os.makedirs(os.path.dirname(marker), exist_ok=True)
+                open(marker, "w").close()
+    except OSError as e:
+        print(f"Error finishing {task.lower()} for {key}: {e}")
+
+
+def schedule_compaction():
+    """Reaps finished compactions and starts the next one when allowed.
+
+    Compaction runs one hour at a time and only while the consolidation queue
+    is empty and a job slot is free, so it never delays fresh hours. Hours
+    due for downsampling and days due for a rollup share the same budget,
+    after pending compactions.
+    """
+    collect_rollup_probes()
+    for key, (camera, identifier, proc, task, log) in list(compaction_processes.items()):
+        if proc.poll() is not None:
+            stderr = read_encoder_log(log)
+            if task == "rollup":
+                finish_rollup(identifier, proc.returncode, stderr, camera)
+            else:
+                finish_compaction(identifier, proc.returncode, stderr, camera, task == "downsampling")
+            del compaction_processes[key]
+
+    if compaction_processes or rollup_probes or consolidation_queue:
+        return
+    if len(consolidation_processes) >= MAX_CONSOLIDATION_JOBS or not is_compaction_allowed():
+        return
+    for camera, hour_identifier in pending_compactions():
+        if start_compaction(hour_identifier, camera):
+            return
+    while pending_downsamples:
+        camera, hour_identifier = pending_downsamples.pop(0)
+        if start_compaction(hour_identifier, camera, downsample=True):
+            return
+    while pending_rollups:
+        camera, day = pending_rollups.pop(0)
+        if start_rollup(day, camera):
+            return
+
+
+def compact_archives():
+    """Compacts every pending remuxed archive now, one at a time (the `compact` command)."""
+    pending = pending_compactions()
+    print(f"Found {len(pending)} archive(s) waiting for compaction.")
+    for camera, hour_identifier in pending:
+        proc = start_compaction(hour_identifier, camera)
+        if proc:
+            proc.wait()
+            log = compaction_processes.pop(camera.job_key(hour_identifier))[4]
+            finish_compaction(hour_identifier, proc.returncode, read_encoder_log(log), camera)
+
+
+def daily_rollup_paths(day, camera=None):
+    """Returns the paths of the daily MP4 and its sidecar for a day (YYYY-MM-DD)."""
+    directory = hour_directory(f"{day}-00", camera)
+    return os.path.join(directory, f"daily_{day}.mp4"), os.path.join(directory, f"daily_{day}.json")
+
+
+def rollup_marker_path(day, camera=None):
+    """Returns the path of the marker of a day whose hours cannot be rolled up (see finish_rollup_probes)."""
+    return os.path.join(hour_directory(f"{day}-00", camera), f".norollup_{day}.json")
+
+
+def read_rollup_marker(day, camera=None):
+    """Returns the sorted hourly MP4 names a day was refused a rollup for, or None."""
+    try:
+        with open(rollup_marker_path(day, camera)) as f:
+            return json.load(f)["hours"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def read_daily_index(path):
+    """Returns {hour identifier: {"offset", "duration", "start"}} from a daily rollup sidecar."""
+    with open(path) as f:
+        return json.load(f)["hours"]
+
+
+def probe_media(path):
+    """Returns {"duration", "creation_time", "streams", "extradata"} of a media file, or None.
+
+    streams holds (codec type, codec, width, height, pixel format) and
+    extradata the codec headers' hash of each stream; files can only be
+    joined by a stream copy when these match. duration and creation_time
+    (a datetime in UTC) are None where the file has none.
+    """
+    try:
+        proc = subprocess.run(
+            [
+                "ffprobe", "-v", "error", "-show_data_hash", "CRC32",
+                "-show_entries",
+                "format=duration:format_tags=creation_time"
+                ":stream=codec_type,codec_name,width,height,pix_fmt,extradata_hash",
+                "-of", "json", path,
+            ],
+            capture_output=True,
+            timeout=30,
+        )
+        probed = json.loads(proc.stdout or b"{}")
+        if proc.returncode != 0 or "format" not in probed:
+            raise ValueError(proc.stderr.decode(errors="replace").strip() or "no format found")
+        creation_time = probed["format"].get("tags", {}).get("creation_time")
+        streams = probed.get("streams", [])
+        return {
+            "duration": float(probed["format"]["duration"]) if "duration" in probed["format"] else None,
+            "creation_time": parse_export_time(creation_time.replace("Z", "+00:00")) if creation_time else None,
+            "streams": tuple(
+                tuple(stream.get(field) for field in ("codec_type", "codec_name", "width", "height", "pix_fmt"))
+                for stream in streams
+            ),
+            "extradata": tuple(stream.get("extradata_hash") for stream in streams),
+        }
+    except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+        print(f"Warning: Could not probe {path}: {e}")
+        return None
+
+
+def archive_mp4_timing(archive_mp4, hour_identifier, probed=None):
+    """Returns (offset of the footage from the hour start, duration or None) of an hourly MP4.
+
+    The start comes from the creation_time written at consolidation (0 for
+    MP4s without one), the duration from ffprobe or else the archive index.
+    """
+    probed = probed or probe_media(archive_mp4) or {}
+    offset = 0.0
+    if probed.get("creation_time"):
+        offset = (probed["creation_time"] - parse_hour_identifier(hour_identifier)).total_seconds()
+        offset = min(max(offset, 0.0), 3600.0)
+    return offset, probed.get("duration") or indexed_mp4_duration(archive_mp4)
+
+
+def start_rollup(day, camera=None):
+    """Starts probing the hourly MP4s of a day on the probe thread pool.
+
+    Hours queued for deletion are left out. The supervisor keeps running
+    while the probes run; collect_rollup_probes then starts the join (see
+    finish_rollup_probes). Returns False if the day has no hourly MP4.
+    """
+    camera = camera or DEFAULT_CAMERA
+    directory = hour_directory(f"{day}-00", camera)
+    deleted_paths = {path for path, _ in pending_deletions}
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        names = []
+
+    hour_names = []
+    for name in names:
+        classified = classify_archive_file(name)
+        path = os.path.join(directory, name)
+        if classified and classified[0] == "mp4" and classified[1].startswith(f"{day}-") and path not in deleted_paths:
+            hour_names.append(name)
+    if not hour_names:
+        return False
+
+    executor = get_probe_executor()
+    probes = [(name, executor.submit(probe_media, os.path.join(directory, name))) for name in hour_names]
+    futures = [future for _, future in probes]
+    for future in futures:
+        # Wake the supervisor once the whole day is probed
+        future.add_done_callback(lambda _: all(f.done() for f in futures) and wake_supervisor())
+    rollup_probes[camera.job_key(day)] = {"day": day, "camera": camera, "probes": probes}
+    print(f"Probing {len(probes)} hour(s) of {camera.job_key(day)} for a rollup.")
+    return True
+
+
+def collect_rollup_probes():
+    """Starts the joins of the days whose probes have finished."""
+    for key, rollup in list(rollup_probes.items()):
+        if all(future.done() for _, future in rollup["probes"]):
+            del rollup_probes[key]
+            finish_rollup_probes(rollup)
+
+
+def finish_rollup_probes(rollup):
+    """Starts joining the probed hourly MP4s of a day into a temporary daily MP4.
+
+    The offset of each hour is the sum of the durations before it, so the
+    sidecar is written up front; finish_rollup moves both into place. It
+    also keeps where within its hour each hour's footage starts, since the
+    joined file only has the creation_time of the first hour. A stream copy
+    only joins hours encoded alike, so a day whose hours differ in codec,
+    resolution or codec headers (e.g. after a camera or preset change) is
+    not rolled up; a marker listing its hours keeps plan_rollups from
+    probing it again until those hours change.
+
+    Returns the ffmpeg process, or None if the day is not rolled up.
+    """
+    day, camera = rollup["day"], rollup["camera"]
+    directory = hour_directory(f"{day}-00", camera)
+    hour_names = [name for name, _ in rollup["probes"]]
+    hours = {}
+    offset = 0.0
+    parameters = None
+    for name, future in rollup["probes"]:
+        classified = classify_archive_file(name)
+        path = os.path.join(directory, name)
+        probed = future.result()
+        if probed is None:
+            print(f"Warning: Could not probe {path}. Skipping the rollup of {camera.job_key(day)}.")
+            return None
+        if parameters is None:
+            parameters = (probed["streams"], probed["extradata"])
+        elif (probed["streams"], probed["extradata"]) != parameters:
+            print(
+                f"Warning: The streams of {path} differ from those of the day's first hour. "
+                f"Skipping the rollup of {camera.job_key(day)}."
+            )
+            with open(rollup_marker_path(day, camera), "w") as f:
+                json.dump({"hours": hour_names}, f)
+            return None
+        start, duration = archive_mp4_timing(path, classified[1], probed)
+        if duration is None:
+            print(f"Warning: Could not get the duration of {path}. Skipping the rollup of {camera.job_key(day)}.")
+            return None
+        hours[classified[1]] = {"path": path, "offset": offset, "duration": duration, "start": start}
+        offset += duration
+
+    concat_list = os.path.join(directory, f".rollup_{day}.txt")
+    with open(concat_list, "w") as f:
+        for hour in hours.values():
+            f.write(f"file '{hour.pop('path')}'\n")
+    with open(os.path.join(directory, f".rollup_{day}.json"), "w") as f:
+        json.dump({"day": day, "hours": hours}, f, indent=1)
+
+    command = with_job_priority(build_concat_command(concat_list, os.path.join(directory, f".rollup_{day}.mp4")))
+    print(f"DEBUG: FFMPEG command being executed for rollup: {command}")
+    proc, log = start_background_encode(command)
+    compaction_processes[camera.job_key(day)] = (camera, day, proc, "rollup", log)
+    print(f"Rollup process for {camera.job_key(day)} ({len(hours)} hour(s)) started (PID: {proc.pid}).")
+    return proc
+
+
+def finish_rollup(day, returncode, stderr, camera=None):
+    """Moves a finished daily MP4 and its sidecar into place and deletes the hourly MP4s."""
+    camera = camera or DEFAULT_CAMERA
+    daily_mp4, daily_index = daily_rollup_paths(day, camera)
+    directory = os.path.dirname(daily_mp4)
+    key = camera.job_key(day)
+    try:
+        os.remove(os.path.join(directory, f".rollup_{day}.txt"))
+        if returncode == 0:
+            os.replace(os.path.join(directory, f".rollup_{day}.mp4"), daily_mp4)
+            os.replace(os.path.join(directory, f".rollup_{day}.json"), daily_index)
+            hours = read_daily_index(daily_index)
+            index_file(daily_mp4, camera, "complete", sum(hour["duration"] for hour in hours.values()))
+            index_file(daily_index, camera, "complete")
+            removed = remove_rolled_up_hours(day, camera)
+            print(f"Rollup for {key} finished successfully: {removed} hourly MP4(s) replaced.")
+        else:
+            print(f"Rollup for {key} failed with code {returncode}.")
+            print(f"STDERR:\n{stderr.decode()}")
+            for suffix in ("mp4", "json"):
+                temp_path = os.path.join(directory, f".rollup_{day}.{suffix}")
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error finishing rollup for {key}: {e}")
+
+
+def remove_rolled_up_hours(day, camera):
+    """Deletes the hourly MP4s listed in a day's rollup sidecar. Returns how many were removed."""
+    daily_mp4, daily_index = daily_rollup_paths(day, camera)
+    directory = os.path.dirname(daily_mp4)
+    removed = []
+    for hour_identifier in read_daily_index(daily_index):
+        archive_mp4 = os.path.join(directory, f"archive_{hour_identifier}.mp4")
+        try:
+            os.remove(archive_mp4)
+        except FileNotFoundError:
+            continue
+        removed.append(archive_mp4)
+    unindex_files(removed)
+    return len(removed)
+
+
+def find_daily_hour(hour_identifier, camera):
+    """Returns (daily MP4, offset, duration, start within the hour) of an hour that was rolled up, or None."""
+    daily_mp4, daily_index = daily_rollup_paths(hour_identifier[:10], camera)
+    try:
+        hour = read_daily_index(daily_index).get(hour_identifier)
+    except (OSError, ValueError, KeyError):
+        return None
+    if hour is None or not os.path.exists(daily_mp4):
+        return None
+    return daily_mp4, hour["offset"], hour["duration"], hour.get("start", 0.0)
+
+
+HOUR_PATTERN = r"\d{4}-\d{2}-\d{2}-\d{2}"  # YYYY-MM-DD-HH
+DAY_PATTERN = r"\d{4}-\d{2}-\d{2}"  # YYYY-MM-DD
+# (kind, pattern) of every archive file name; the first group is the hour identifier or day
+ARCHIVE_FILE_PATTERNS = [
+    ("segment", re.compile(rf"({HOUR_PATTERN})_segment_(?:\w+\.(?:ts|m4s)|init\.mp4)")),
+    ("playlist", re.compile(rf"playlist_({HOUR_PATTERN})\.m3u8")),
+    ("mp4", re.compile(rf"archive_({HOUR_PATTERN})\.mp4")),
+    ("proxy", re.compile(rf"proxy_({HOUR_PATTERN})\.mp4")),
+    ("thumbnails", re.compile(rf"thumbs_({HOUR_PATTERN})\.jpg")),
+    ("activity", re.compile(rf"activity_({HOUR_PATTERN})\.bin")),
+    ("manifest", re.compile(rf"manifest_({HOUR_PATTERN})\.json")),
+    ("daily", re.compile(rf"daily_({DAY_PATTERN})\.mp4")),
+    ("daily_index", re.compile(rf"daily_({DAY_PATTERN})\.json")),
+]
+
+
+def classify_archive_file(filename):
+    """Returns (kind, hour identifier) for archive files, or None for anything else.
+
+    kind is "segment", "playlist", "mp4" or one of the files derived from
+    an hour's archive, "proxy", "thumbnails", "activity" and "manifest".
+    A daily rollup ("daily" and its sidecar "daily_index") is given the
+    last hour of its day, so it ages with the whole day. Only well-formed
+    hour identifiers and days match, since playback requests name files
+    that are resolved to paths from them.
+    """
+    for kind, pattern in ARCHIVE_FILE_PATTERNS:
+        match = pattern.fullmatch(filename)
+        if match:
+            if kind in ("daily", "daily_index"):
+                return kind, f"{match.group(1)}-23"
+            return kind, match.group(1)
+    return None
+
+
+def get_archive_index():
+    """Returns the connection to the archive index, or None when it is disabled."""
+    global archive_index
+    if not ARCHIVE_INDEX_PATH:
+        return None
+    if archive_index is None:
+        archive_index = sqlite3.connect(ARCHIVE_INDEX_PATH, isolation_level=None)
+        # WAL lets `app.py reindex` and other readers work next to the recorder
+        archive_index.execute("PRAGMA journal_mode=WAL")
+        archive_index.execute("PRAGMA synchronous=NORMAL")
+        archive_index.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,  -- Relative to ARCHIVE_PATH
+                camera TEXT NOT NULL,   -- '' for the default camera
+                hour TEXT NOT NULL,     -- YYYY-MM-DD-HH
+                kind TEXT NOT NULL,     -- segment, playlist or mp4
+                size INTEGER,
+                duration REAL,
+                state TEXT NOT NULL,    -- recorded, remuxed, compacted or complete
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_kind_hour ON files (kind, hour);
+            CREATE INDEX IF NOT EXISTS files_camera_hour ON files (camera, hour);
+        """)
+    return archive_index
+
+
+def index_file(file_path, camera, state, duration=None):
+    """Adds or updates one archive file in the index (no-op when the index is disabled)."""
+    index = get_archive_index()
+    if index is None:
+        return
+    classified = classify_archive_file(os.path.basename(file_path))
+    if not classified:
+        return
+    kind, hour_identifier = classified
+    try:
+        size = os.path.getsize(file_path)
+    except OSError:
+        size = None
+    index.execute(
+        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            os.path.relpath(file_path, ARCHIVE_PATH), camera.name or "", hour_identifier,
+            kind, size, duration, state, time.time(),
+        ),
+    )
+
+
+def unindex_files(file_paths):
+    """Removes deleted files from the index."""
+    index = get_archive_index()
+    if index is None:
+        return
+    index.executemany(
+        "DELETE FROM files WHERE path = ?",
+        [(os.path.relpath(path, ARCHIVE_PATH),) for path in file_paths],
+    )
+
+
+def unindex_directory(directory):
+    """Removes every indexed file below a deleted directory from the index."""
+    index = get_archive_index()
+    if index is None:
+        return
+    prefix = os.path.relpath(directory, ARCHIVE_PATH) + os.sep
+    index.execute(
+        "DELETE FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)
+    )
+
+
+def index_hour_segments(hour_identifier, camera=None):
+    """Indexes a finished hour's playlist and segments with their durations."""
+    camera = camera or DEFAULT_CAMERA
+    index = get_archive_index()
+    if index is None:
+        return
+    directory = hour_directory(hour_identifier, camera)
+    playlist_path = os.path.join(directory, f"playlist_{hour_identifier}.m3u8")
+    try:
+        entries = read_playlist_entries(playlist_path)
+        init_segment = read_playlist_map(playlist_path)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not index {playlist_path}: {e}")
+        return
+    index.execute("BEGIN")
+    index_file(playlist_path, camera, "recorded", sum(d or 0 for _, d in entries))
+    if init_segment:
+        index_file(os.path.join(directory, init_segment), camera, "recorded")
+    for segment, duration in entries:
+        index_file(os.path.join(directory, segment), camera, "recorded", duration)
+    index.execute("COMMIT")
+
+
+def indexed_hour_files(hour_identifier, camera, kinds):
+    """Returns the absolute paths of the indexed files of one camera's hour."""
+    rows = get_archive_index().execute(
+        f"SELECT path FROM files WHERE camera = ? AND hour = ? AND kind IN ({','.join('?' * len(kinds))})",
+        (camera.name or "", hour_identifier, *kinds),
+    )
+    return [os.path.join(ARCHIVE_PATH, path) for path, in rows]
+
+
+def indexed_hour_duration(hour_identifier, camera):
+    """Returns the total duration of an hour's indexed segments, or None."""
+    index = get_archive_index()
+    if index is None:
+        return None
+    (duration,) = index.execute(
+        "SELECT SUM(duration) FROM files WHERE camera = ? AND hour = ? AND kind = 'segment'",
+        (camera.name or "", hour_identifier),
+    ).fetchone()
+    return duration
+
+
+def reindex_archive():
+    """Rebuilds the archive index from the files on disk (the `reindex` command)."""
+    index = get_archive_index()
+    if index is None:
+        print("Error: ARCHIVE_INDEX_PATH is not set. Nothing to reindex.")
+        return 0
+
+    count = 0
+    index.execute("BEGIN")
+    index.execute("DELETE FROM files")
+    for camera in get_cameras():
+        print(f"Indexing {camera.archive_path}...")
+        files = []
+        for directory in iter_archive_directories(camera):
+            try:
+                files.extend((directory, filename) for filename in os.listdir(directory))
+            except FileNotFoundError:
+                continue
+
+        durations = {}
+        for directory, filename in files:
+            classified = classify_archive_file(filename)
+            if classified and classified[0] == "playlist":
+                try:
+                    durations.update(read_playlist_entries(os.path.join(directory, filename)))
+                except (OSError, ValueError) as e:
+                    print(f"Warning: Could not read {filename}: {e}")
+        compaction_pending = set()
+        try:
+            compaction_pending.update(os.listdir(os.path.join(camera.archive_path, COMPACTION_MARKER_DIR)))
+        except FileNotFoundError:
+            pass
+        downsampled = set()
+        try:
+            downsampled.update(os.listdir(os.path.join(camera.archive_path, DOWNSAMPLE_DONE_DIR)))
+        except FileNotFoundError:
+            pass
+
+        for directory, filename in files:
+            classified = classify_archive_file(filename)
+            if not classified:
+                continue
+            kind, hour_identifier = classified
+            if kind == "mp4" and hour_identifier in compaction_pending:
+                state = "remuxed"
+            elif kind == "mp4" and hour_identifier in downsampled:
+                state = "downsampled"
+            elif kind == "mp4":
+                state = "complete"
+            elif kind in ("proxy", "thumbnails", "activity", "manifest", "daily", "daily_index"):
+                state = "complete"
+            else:
+                state = "recorded"
+            index_file(os.path.join(directory, filename), camera, state, durations.get(filename))
+            count += 1
+    index.execute("COMMIT")
+    print(f"Reindex complete: {count} file(s) indexed.")
+    return count
+
+
+def cleanup_old_files():
+    """Deletes archived MP4 files older than the retention period or over the size budget.
+    
+    Note: .ts segment files and .m3u8 playlists are deleted immediately after
+    successful consolidation (see check_consolidation_status), not by retention policy.
+
+    The age of an archive is taken from the hour in its filename. The files to
+    delete are queued oldest first and removed by delete_pending_files.
+    """
+    global last_cleanup_time
+    if time.time() - last_cleanup_time < CLEANUP_INTERVAL_SECONDS:
+        return
+
+    print("Running cleanup of old MP4 files...")
+    now = datetime.utcnow()
+    retention_delta = timedelta(days=RETENTION_DAYS)
+    cutoff_date = now - retention_delta
+    cutoff_hour_identifier = cutoff_date.strftime("%Y-%m-%d-%H")
+
+    if ARCHIVE_LAYOUT == "dated":
+        for camera in get_cameras():
+            cleanup_expired_days(camera, cutoff_date)
+
+    try:
+        archive_files = list_archive_files(with_sizes=bool(
+            RETENTION_MAX_BYTES or RETENTION_MIN_FREE_BYTES or CLEANUP_MAX_BYTES_PER_SECOND or METRICS_PORT
+        ))
+        archive_bytes = collections.Counter()
+        for _, kind, _, size in archive_files:
+            archive_bytes[kind] += size or 0
+        cleanup_stats["archive_bytes"] = dict(archive_bytes)
+        idle_hours = set()
+        if RETENTION_ACTIVE_DAYS:
+            idle_hours = find_idle_hours(
+                archive_files, (now - timedelta(days=RETENTION_ACTIVE_DAYS)).strftime("%Y-%m-%d-%H")
+            )
+        pending_deletions[:] = plan_cleanup(archive_files, cutoff_hour_identifier, idle_hours)
+        if RETENTION_DOWNSAMPLE_DAYS:
+            pending_downsamples[:] = plan_downsampling(
+                archive_files,
+                (now - timedelta(days=RETENTION_DOWNSAMPLE_DAYS)).strftime("%Y-%m-%d-%H"),
+                cutoff_hour_identifier,
+                {path for path, _ in pending_deletions},
+            )
+        if DAILY_ROLLUP_DAYS:
+            # Hours are only rolled up once the retention tiers are done with them
+            rollup_days = max(DAILY_ROLLUP_DAYS, RETENTION_DOWNSAMPLE_DAYS, RETENTION_ACTIVE_DAYS)
+            pending_rollups[:] = plan_rollups(
+                archive_files,
+                (now - timedelta(days=rollup_days)).strftime("%Y-%m-%d-%H"),
+                cutoff_hour_identifier,
+                {path for path, _ in pending_deletions},
+            )
+    except Exception as e:
+        print(f"An error occurred during MP4 cleanup: {e}")
+    if pending_deletions:
+        print(f"Queued {len(pending_deletions)} MP4 file(s) for deletion.")
+    if pending_downsamples:
+        print(f"{len(pending_downsamples)} archive(s) are due for downsampling.")
+    if pending_rollups:
+        print(f"{len(pending_rollups)} day(s) are due for a rollup.")
+
+    last_cleanup_time = time.time()
+    delete_pending_files()
+
+
+def list_archive_files(with_sizes=False):
+    """Returns (hour identifier, kind, path, size) for every archive file of every camera.
+
+    With the index enabled this is a single query. Otherwise each archive
+    directory is read with one os.scandir pass; files are only stat'ed when
+    sizes are needed (size is None otherwise).
+    """
+    index = get_archive_index()
+    if index is not None:
+        return [
+            (hour_identifier, kind, os.path.join(ARCHIVE_PATH, path), size)
+            for path, kind, hour_identifier, size in index.execute(
+                "SELECT path, kind, hour, size FROM files"
+            )
+        ]
+
+    archive_files = []
+    for camera in get_cameras():
+        for directory in iter_archive_directories(camera):
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        classified = classify_archive_file(entry.name)
+                        if not classified:
+                            continue
+                        size = None
+                        if with_sizes:
+                            try:
+                                size = entry.stat().st_size
+                            except OSError:
+                                continue
+                        archive_files.append((classified[1], classified[0], entry.path, size))
+            except FileNotFoundError:
+                continue
+    return archive_files
+
+
+def find_idle_hours(archive_files, active_cutoff_hour_identifier):
+    """Returns the (directory, hour identifier) of hours before the cutoff whose activity stayed low.
+
+    An hour is idle if no interval of its activity timeline reached
+    RETENTION_MIN_ACTIVITY. Hours without a timeline are never idle.
+    """
+    idle_hours = set()
+    for hour_identifier, kind, path, _ in archive_files:
+        if kind != "activity" or hour_identifier >= active_cutoff_hour_identifier:
+            continue
+        try:
+            _, _, scores = read_activity_timeline(path)
+        except (OSError, struct.error) as e:
+            print(f"Warning: Could not read {path}: {e}")
+            continue
+        if max(scores, default=0) < RETENTION_MIN_ACTIVITY:
+            idle_hours.add((os.path.dirname(path), hour_identifier))
+    return idle_hours
+
+
+def plan_downsampling(archive_files, downsample_cutoff_hour_identifier, cutoff_hour_identifier, deleted_paths):
+    """Returns the (camera, hour identifier) of archive MP4s due for downsampling, oldest first.
+
+    Hours already downsampled are skipped, as are hours still waiting for
+    compaction and those about to be deleted. Records of expired hours are
+    pruned from DOWNSAMPLE_DONE_DIR.
+    """
+    due = []
+    for camera in get_cameras():
+        done_dir = os.path.join(camera.archive_path, DOWNSAMPLE_DONE_DIR)
+        try:
+            done = set(os.listdir(done_dir))
+        except FileNotFoundError:
+            done = set()
+        for hour_identifier in done:
+            if hour_identifier < cutoff_hour_identifier:
+                os.remove(os.path.join(done_dir, hour_identifier))
+        try:
+            done.update(os.listdir(os.path.join(camera.archive_path, COMPACTION_MARKER_DIR)))
+        except FileNotFoundError:
+            pass
+
+        due.extend(
+            (camera, hour_identifier)
+            for hour_identifier, kind, path, _ in archive_files
+            if kind == "mp4"
+            and cutoff_hour_identifier <= hour_identifier < downsample_cutoff_hour_identifier
+            and hour_identifier not in done
+            and path not in deleted_paths
+            and os.path.dirname(path) == hour_directory(hour_identifier, camera)
+        )
+    return sorted(due, key=lambda item: (item[1], item[0].job_key(item[1])))
+
+
+def plan_rollups(archive_files, rollup_cutoff_hour_identifier, cutoff_hour_identifier, deleted_paths):
+    """Returns the (camera, day) of days whose hourly MP4s are due for a rollup, oldest first.
+
+    A day is due once its last hour is before the rollup cutoff and none of
+    its hours still waits for compaction or downsampling. Days refused a
+    rollup are skipped while their hourly MP4s stay the same. Hourly MP4s
+    left next to a finished rollup (e.g. by a crash) are deleted.
+    """
+    busy = {camera.job_key(hour_identifier) for camera, hour_identifier in pending_compactions() + pending_downsamples}
+    busy.update(compaction_processes)
+    busy.update(rollup_probes)
+    due = set()
+    blocked = set()
+    hour_names = collections.defaultdict(list)
+    for camera in get_cameras():
+        for hour_identifier, kind, path, _ in archive_files:
+            day = hour_identifier[:10]
+            if (
+                kind != "mp4"
+                or path in deleted_paths
+                or os.path.dirname(path) != hour_directory(hour_identifier, camera)
+            ):
+                continue
+            hour_names[camera, day].append(os.path.basename(path))
+            if not cutoff_hour_identifier <= hour_identifier or f"{day}-23" >= rollup_cutoff_hour_identifier:
+                continue
+            if camera.job_key(hour_identifier) in busy or camera.job_key(day) in busy:
+                blocked.add((camera, day))
+            else:
+                due.add((camera, day))
+        if ARCHIVE_LAYOUT != "dated":
+            remove_stale_rollup_markers(camera, {day for marked_camera, day in hour_names if marked_camera is camera})
+
+    rollups = []
+    for camera, day in sorted(due - blocked, key=lambda item: (item[1], item[0].job_key(item[1]))):
+        if os.path.exists(daily_rollup_paths(day, camera)[1]):
+            try:
+                remove_rolled_up_hours(day, camera)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Warning: Could not read the rollup of {camera.job_key(day)}: {e}")
+            continue
+        if read_rollup_marker(day, camera) == sorted(hour_names[camera, day]):
+            continue  # Refused before and nothing changed since
+        rollups.append((camera, day))
+    return rollups
+
+
+def remove_stale_rollup_markers(camera, days):
+    """Deletes the rollup markers of a camera's days that have no hourly MP4 left.
+
+    In the dated layout they go with their day's directory.
+    """
+    try:
+        names = os.listdir(camera.archive_path)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith(".norollup_") and name.endswith(".json") and name[10:-5] not in days:
+            try:
+                os.remove(os.path.join(camera.archive_path, name))
+            except OSError as e:
+                print(f"Warning: Could not delete {name}: {e}")
 
-def check_consolidation_status():
-    """Checks the status of ongoing consolidation processes."""
-    global consolidation_processes
-    completed_identifiers = []
-    for identifier, proc in consolidation_processes.items():
-        if proc.poll() is not None:  # Process has finished
-            stdout, stderr = proc.communicate()
-            if proc.returncode == 0:
-                print(f"Consolidation for {identifier} finished successfully.")
-                # Delete HLS files for this hour
-                try:
-                    for f in os.listdir(ARCHIVE_PATH):
-                        if f.startswith(f"{identifier}_segment_") or f == f"playlist_{identifier}.m3u8":
-                            file_to_delete = os.path.join(ARCHIVE_PATH, f)
-                            os.remove(file_to_delete)
-                            print(f"Deleted HLS file: {file_to_delete}")
-                except Exception as e:
-                    print(f"Error deleting HLS files for {identifier}: {e}")
-            else:
-                print(
-                    f"Consolidation for {identifier} failed with code {proc.returncode}."
-                )
-                print(f"STDOUT:\n{stdout.decode()}")
-                print(f"STDERR:\n{stderr.decode()}")
-            completed_identifiers.append(identifier)
 
-    for identifier in completed_identifiers:
-        del consolidation_processes[identifier]
+def plan_cleanup(archive_files, cutoff_hour_identifier, idle_hours=()):
+    """Returns the [(path, size)] of MP4s to delete, oldest first.
 
+    MP4s of hours before the cutoff always expire, as do those of idle hours
+    (see find_idle_hours). If the archive is over
+    RETENTION_MAX_BYTES, or the filesystem has less than
+    RETENTION_MIN_FREE_BYTES free, further MP4s are added oldest first until
+    enough space is freed. Recent hours are never deleted to make room.
+    Proxies, thumbnails, activity timelines and manifests go together with
+    the archive MP4 of their hour. A daily rollup expires with the last hour
+    of its day and is never pruned as idle.
+    """
+    mp4s = sorted(
+        (hour_identifier, path, size, kind)
+        for hour_identifier, kind, path, size in archive_files
+        if kind in ("mp4", "proxy", "thumbnails", "activity", "manifest", "daily", "daily_index")
+    )
+    deletions = [
+        (path, size)
+        for hour_identifier, path, size, kind in mp4s
+        if hour_identifier < cutoff_hour_identifier
+        or (kind not in ("daily", "daily_index") and (os.path.dirname(path), hour_identifier) in idle_hours)
+    ]
 
-def cleanup_old_files():
-    """Deletes archived MP4 files older than the retention period.
-    
-    Note: .ts segment files and .m3u8 playlists are deleted immediately after
-    successful consolidation (see check_consolidation_status), not by retention policy.
+    excess = 0
+    if RETENTION_MAX_BYTES:
+        excess = sum(size or 0 for _, _, _, size in archive_files) - RETENTION_MAX_BYTES
+    if RETENTION_MIN_FREE_BYTES:
+        excess = max(excess, RETENTION_MIN_FREE_BYTES - shutil.disk_usage(ARCHIVE_PATH).free)
+    excess -= sum(size or 0 for _, size in deletions)
+    if excess <= 0:
+        return deletions
+
+    recent_hours = get_recent_hour_identifiers()
+    deleted_paths = {path for path, _ in deletions}
+    for hour_identifier, path, size, _ in mp4s:
+        if excess <= 0 or hour_identifier in recent_hours:
+            break
+        if path in deleted_paths:
+            continue
+        deletions.append((path, size))
+        excess -= size or 0
+    if excess > 0:
+        print(f"Warning: Archive is still {excess / BYTES_PER_MB:.2f} MB over its size budget.")
+    return deletions
+
+
+def delete_pending_files():
+    """Deletes queued files without exceeding the cleanup rate limits.
+
+    Each deletion pushes the next one back by its share of
+    CLEANUP_MAX_BYTES_PER_SECOND and CLEANUP_MAX_FILES_PER_SECOND; the event
+    loop wakes up again when the next deletion is due.
     """
-    global last_cleanup_time
-    if time.time() - last_cleanup_time < CLEANUP_INTERVAL_SECONDS:
-        return
+    global next_deletion_time
+    now = time.time()
+    deleted = []
+    while pending_deletions and now >= next_deletion_time:
+        file_path, size = pending_deletions.pop(0)
+        try:
+            print(f"Deleting old MP4 file: {os.path.basename(file_path)}")
+            os.remove(file_path)
+            cleanup_stats["deleted_files"] += 1
+            cleanup_stats["bytes_freed"] += size or 0
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error processing file {file_path}: {e}")
+            continue
+        deleted.append(file_path)
 
-    print("Running cleanup of old MP4 files...")
-    now = datetime.utcnow()
-    retention_delta = timedelta(days=RETENTION_DAYS)
-    cutoff_date = now - retention_delta
+        delay = 0
+        if CLEANUP_MAX_BYTES_PER_SECOND:
+            delay = (size or 0) / CLEANUP_MAX_BYTES_PER_SECOND
+        if CLEANUP_MAX_FILES_PER_SECOND:
+            delay = max(delay, 1 / CLEANUP_MAX_FILES_PER_SECOND)
+        next_deletion_time = max(next_deletion_time, now) + delay
+    unindex_files(deleted)
 
-    try:
-        for filename in os.listdir(ARCHIVE_PATH):
-            if filename.endswith(".mp4"):  # Only target MP4 archived files
-                file_path = os.path.join(ARCHIVE_PATH, filename)
-                try:
-                    file_mod_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-                    if file_mod_time < cutoff_date:
-                        print(f"Deleting old MP4 file: {filename}")
-                        os.remove(file_path)
-                except OSError as e:
-                    print(f"Error processing file {file_path}: {e}")
-    except Exception as e:
-        print(f"An error occurred during MP4 cleanup: {e}")
 
-    last_cleanup_time = time.time()
+def cleanup_expired_days(camera, cutoff_date):
+    """Removes the dated directories of a camera whose whole day is past the cutoff.
+
+    The day the cutoff falls into is left for the per-file cleanup.
+    """
+    cutoff_day = cutoff_date.strftime("%Y-%m-%d")
+    for day, day_path in iter_day_directories(camera):
+        if day >= cutoff_day:
+            break  # Oldest first, so every remaining day is newer
+        print(f"Deleting expired day directory: {day_path}")
+        try:
+            with os.scandir(day_path) as entries:
+                day_files = [entry.stat().st_size for entry in entries if entry.is_file()]
+            shutil.rmtree(day_path)
+        except OSError as e:
+            print(f"Error deleting {day_path}: {e}")
+            continue
+        cleanup_stats["deleted_files"] += len(day_files)
+        cleanup_stats["bytes_freed"] += sum(day_files)
+        unindex_directory(day_path)
+        # Drop month and year directories left empty
+        for parent in (os.path.dirname(day_path), os.path.dirname(os.path.dirname(day_path))):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
 
 
 def purge_orphaned_files():
@@ -206,27 +3241,78 @@ def purge_orphaned_files():
     Returns:
         tuple: (deleted_count, total_size_bytes) Number of files deleted and total size freed
     """
-    if not os.path.exists(ARCHIVE_PATH):
-        print(f"Archive path {ARCHIVE_PATH} does not exist.")
+    if get_archive_index() is not None:
+        deleted_count, deleted_size = purge_indexed_files()
+    else:
+        deleted_count = 0
+        deleted_size = 0
+        for camera in get_cameras():
+            for directory in iter_archive_directories(camera):
+                camera_count, camera_size = purge_orphaned_camera_files(directory)
+                deleted_count += camera_count
+                deleted_size += camera_size
+    return deleted_count, deleted_size
+
+
+def get_recent_hour_identifiers(count=3):
+    """Returns the identifiers of the current hour and the count - 1 hours before it."""
+    now = datetime.utcnow()
+    return {(now - timedelta(hours=hours_ago)).strftime("%Y-%m-%d-%H") for hours_ago in range(count)}
+
+
+def purge_indexed_files():
+    """Purges leftover HLS files using the archive index (see purge_orphaned_files)."""
+    recent_hours = sorted(get_recent_hour_identifiers())
+    print(f"Excluding recent hours from purge: {recent_hours}")
+    rows = get_archive_index().execute(
+        f"""
+        SELECT hls.path, COALESCE(hls.size, 0) FROM files AS hls
+        JOIN files AS mp4 ON mp4.camera = hls.camera AND mp4.hour = hls.hour AND mp4.kind = 'mp4'
+        WHERE hls.kind IN ('segment', 'playlist') AND hls.hour NOT IN ({','.join('?' * len(recent_hours))})
+        """,
+        recent_hours,
+    ).fetchall()
+    if not rows:
+        print("No HLS files found that need to be deleted.")
+        return 0, 0
+
+    deleted = []
+    deleted_size = 0
+    for path, file_size in rows:
+        file_path = os.path.join(ARCHIVE_PATH, path)
+        try:
+            os.remove(file_path)
+            print(f"Deleted: {path} ({file_size / BYTES_PER_MB:.2f} MB)")
+            deleted_size += file_size
+            deleted.append(file_path)
+        except FileNotFoundError:
+            deleted.append(file_path)
+        except OSError as e:
+            print(f"Error deleting {file_path}: {e}")
+    unindex_files(deleted)
+
+    print(f"\nPurge complete: Deleted {len(deleted)} file(s), freed {deleted_size / BYTES_PER_MB:.2f} MB")
+    return len(deleted), deleted_size
+
+
+def purge_orphaned_camera_files(archive_path):
+    """Purges leftover HLS files from one camera's archive directory (see purge_orphaned_files)."""
+    if not os.path.exists(archive_path):
+        print(f"Archive path {archive_path} does not exist.")
         return 0, 0
     
-    print(f"Scanning {ARCHIVE_PATH} for HLS files that should have been deleted...")
+    print(f"Scanning {archive_path} for HLS files that should have been deleted...")
     
     # Calculate recent hour identifiers to exclude (current + previous 2 hours)
     # These files are likely still being recorded or waiting for consolidation
-    recent_hours = set()
-    now = datetime.utcnow()
-    for hours_ago in range(3):  # Current hour, 1 hour ago, 2 hours ago
-        recent_time = now - timedelta(hours=hours_ago)
-        recent_identifier = recent_time.strftime("%Y-%m-%d-%H")
-        recent_hours.add(recent_identifier)
+    recent_hours = get_recent_hour_identifiers()
     
     print(f"Excluding recent hours from purge: {sorted(recent_hours)}")
     
     # First, find all MP4 files and extract their hour identifiers
     mp4_identifiers = set()
     try:
-        for filename in os.listdir(ARCHIVE_PATH):
+        for filename in os.listdir(archive_path):
             if filename.endswith(".mp4") and filename.startswith("archive_"):
                 # Extract YYYY-MM-DD-HH from archive_YYYY-MM-DD-HH.mp4
                 identifier = filename[8:-4]  # Remove "archive_" prefix and ".mp4" suffix
@@ -242,12 +3328,12 @@ def purge_orphaned_files():
     total_size = 0
     
     try:
-        for filename in os.listdir(ARCHIVE_PATH):
+        for filename in os.listdir(archive_path):
             should_delete = False
             identifier = None
             
             # Check if it's a segment file
-            if filename.endswith(".ts") and "_segment_" in filename:
+            if filename.endswith((".ts", ".m4s", "_segment_init.mp4")) and "_segment_" in filename:
                 # Extract YYYY-MM-DD-HH from YYYY-MM-DD-HH_segment_XXXXX.ts
                 identifier = filename.split("_segment_")[0]
                 # File should be deleted if it HAS an MP4 AND is not from a recent hour
@@ -261,7 +3347,7 @@ def purge_orphaned_files():
                 should_delete = (identifier in mp4_identifiers) and (identifier not in recent_hours)
             
             if should_delete:
-                file_path = os.path.join(ARCHIVE_PATH, filename)
+                file_path = os.path.join(archive_path, filename)
                 try:
                     file_size = os.path.getsize(file_path)
                     files_to_delete.append((file_path, filename, file_size))
@@ -297,10 +3383,721 @@ def purge_orphaned_files():
     return deleted_count, deleted_size
 
 
+def reconcile_archive():
+    """Recovers consolidation work lost by a restart; runs once at startup.
+
+    Temporary outputs of interrupted encodes are deleted; with JOB_QUEUE_PATH
+    set, consolidation temporaries belong to the workers and are left to the
+    worker that claims their hour (see remove_stale_temp_files). Every past hour
+    with a playlist but no MP4 is queued again, oldest first, as long as it
+    has not failed CONSOLIDATION_MAX_ATTEMPTS times. Journaled hours whose
+    MP4 was moved into place before the restart get their HLS files deleted.
+    In continuous capture mode, past hours whose playlist was never written
+    are finalized from their segments.
+
+    Returns the number of hours queued or finalized.
+    """
+    current_hour_id = get_current_hour_identifier()
+    recovered = 0
+    temp_prefixes = (".compacting_", ".rollup_")
+    if not JOB_QUEUE_PATH:
+        temp_prefixes += CONSOLIDATION_TEMP_PREFIXES
+    for camera in get_cameras():
+        try:
+            journaled = set(os.listdir(os.path.join(camera.archive_path, CONSOLIDATION_JOURNAL_DIR)))
+        except FileNotFoundError:
+            journaled = set()
+        journaled = {name for name in journaled if not name.endswith(".tmp")}
+
+        hours = collections.defaultdict(set)
+        for directory in iter_archive_directories(camera):
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(temp_prefixes):
+                            print(f"Deleting incomplete output {entry.path}")
+                            os.remove(entry.path)
+                            continue
+                        classified = classify_archive_file(entry.name)
+                        if classified:
+                            hours[classified[0]].add(classified[1])
+            except FileNotFoundError:
+                continue
+
+        for hour_identifier in sorted(journaled | hours["playlist"] | hours["segment"]):
+            if hour_identifier >= current_hour_id:
+                continue
+            if hour_identifier in hours["mp4"]:
+                if hour_identifier in journaled:
+                    # Finished, but the restart came before the cleanup
+                    delete_hour_hls_files(hour_identifier, camera)
+                    remove_journal_entry(hour_identifier, camera)
+                continue
+            if read_journal_entry(hour_identifier, camera) >= CONSOLIDATION_MAX_ATTEMPTS:
+                print(f"Leaving {camera.job_key(hour_identifier)} as HLS: consolidation failed too often.")
+            elif hour_identifier in hours["playlist"]:
+                print(f"Recovering unconsolidated hour {camera.job_key(hour_identifier)}.")
+                consolidate_hourly_archive(hour_identifier, camera)
+                recovered += 1
+            elif hour_identifier in hours["segment"] and CAPTURE_MODE == "continuous":
+                print(f"Recovering hour {camera.job_key(hour_identifier)} without a playlist.")
+                camera.pending_rollover_hours.append(hour_identifier)
+                recovered += 1
+            elif hour_identifier in journaled and hour_identifier not in hours["segment"]:
+                remove_journal_entry(hour_identifier, camera)  # Nothing left to consolidate
+
+    print(f"Reconciliation complete: {recovered} hour(s) recovered.")
+    return recovered
+
+
+def find_camera(name=None):
+    """Returns the configured camera with the given name (the only camera if name is None)."""
+    cameras = get_cameras()
+    if name is None and len(cameras) == 1:
+        return cameras[0]
+    for camera in cameras:
+        if camera.name == name:
+            return camera
+    return None
+
+
+def parse_export_time(value):
+    """Parses an ISO 8601 timestamp given on the command line; times without an offset are UTC."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def hour_segment_offsets(hour_identifier, camera):
+    """Returns [(segment path, offset from the hour start, duration)] of an hour not consolidated yet.
+
+    Continuous capture names segments after the minute and second they start
+    at; hourly capture segments are placed back to back from the start of
+    the first one, which is taken from its modification time (when it was
+    closed) if that lies within the hour, or else from the hour start.
+    """
+    directory = hour_directory(hour_identifier, camera)
+    try:
+        entries = read_playlist_entries(os.path.join(directory, f"playlist_{hour_identifier}.m3u8"))
+    except (OSError, ValueError):
+        # The current hour of continuous capture only appears in the live playlist
+        prefix = f"{hour_identifier}_segment_"
+        entries = [
+            (name, duration) for name, duration in read_live_playlist(camera).items()
+            if name.startswith(prefix)
+        ]
+
+    segments = []
+    offset = 0.0
+    for name, duration in entries:
+        duration = duration or SEGMENT_TIME_SECONDS
+        match = re.search(r"_segment_(\d{2})(\d{2})\.ts$", name)
+        if match:
+            offset = int(match.group(1)) * 60 + int(match.group(2))
+        path = os.path.join(directory, name)
+        if STAGING_PATH and not os.path.exists(path):
+            path = os.path.join(camera.staging_path, name)  # Not flushed yet
+        if not match and not segments:
+            try:
+                started = os.path.getmtime(path) - duration - hour_start_timestamp(hour_identifier)
+            except OSError:
+                started = None
+            if started is not None and 0 <= started < 3600:
+                offset = started
+        segments.append((path, offset, duration))
+        offset += duration
+    return segments
+
+
+def find_export_sources(camera, start, end):
+    """Returns [(path, inpoint, outpoint)] of the files covering [start, end), oldest first.
+
+    Hours are taken from their archive MP4, from the daily rollup they were
+    joined into or, while not consolidated yet, from their HLS segments.
+    An MP4 is placed at the start and duration of its footage (see
+    archive_mp4_timing). inpoint/outpoint are offsets into the file, or None
+    where the whole file is used. Consecutive hours of one daily rollup
+    become a single source.
+    """
+    sources = []
+    hour_start = start.replace(minute=0, second=0, microsecond=0)
+    while hour_start < end:
+        hour_identifier = hour_start.strftime("%Y-%m-%d-%H")
+        archive_mp4 = os.path.join(hour_directory(hour_identifier, camera), f"archive_{hour_identifier}.mp4")
+        daily_hour = None
+        if os.path.exists(archive_mp4):
+            offset, duration = archive_mp4_timing(archive_mp4, hour_identifier)
+            files = [(archive_mp4, offset, duration or 3600.0 - offset)]
+        else:
+            daily_hour = find_daily_hour(hour_identifier, camera)
+            if daily_hour:
+                files = [(daily_hour[0], daily_hour[3], daily_hour[2])]
+            else:
+                files = hour_segment_offsets(hour_identifier, camera)
+
+        for path, offset, duration in files:
+            file_start = hour_start + timedelta(seconds=offset)
+            file_end = file_start + timedelta(seconds=duration)
+            if file_end <= start or file_start >= end:
+                continue
+            inpoint = (start - file_start).total_seconds() if start > file_start else None
+            outpoint = (end - file_start).total_seconds() if end < file_end else None
+            if daily_hour:
+                # The hour is a slice of the daily file, so both ends are always cut
+                position = daily_hour[1]
+                inpoint = position + (inpoint or 0.0)
+                outpoint = position + (duration if outpoint is None else outpoint)
+                if sources and sources[-1][0] == path and abs(sources[-1][2] - inpoint) < 0.001:
+                    inpoint = sources.pop()[1]
+            sources.append((path, inpoint, outpoint))
+        hour_start += timedelta(hours=1)
+    return sources
+
+
+def split_by_stream_parameters(sources):
+    """Splits export sources into runs whose streams can be joined by one stream copy.
+
+    Each MP4 is probed; segments are probed once per hour, since a capture
+    does not change its parameters. A file that cannot be probed joins the
+    run before it.
+    """
+    runs = []
+    previous = None
+    probed = {}
+    for source in sources:
+        kind, hour_identifier = classify_archive_file(os.path.basename(source[0])) or (None, None)
+        key = (kind, hour_identifier) if kind == "segment" else source[0]
+        if key not in probed:
+            probed[key] = (probe_media(source[0]) or {}).get("streams")
+        parameters = probed[key]
+        if runs and (parameters is None or previous is None or parameters == previous):
+            runs[-1].append(source)
+        else:
+            runs.append([source])
+        previous = parameters or previous
+    return runs
+
+
+def export_clip(camera_name, start, end, output_path):
+    """Writes the footage between two UTC times into MP4s (the `export` command).
+
+    The covering hourly MP4s and live segments are joined with the concat
+    demuxer and stream-copied, cut at inpoint/outpoint. Without re-encoding,
+    the clip starts at the keyframe at or before the requested start. Files
+    whose codec or resolution differ (e.g. H.265 archives and the camera's
+    live H.264 segments) cannot share a stream copy, so each run of
+    compatible files is written to its own output, numbered
+    <name>_1.mp4, <name>_2.mp4, ...
+
+    Returns the ffmpeg exit code (1 if nothing could be exported).
+    """
+    camera = find_camera(camera_name)
+    if camera is None:
+        print(f"Error: Unknown camera {camera_name!r}.")
+        return 1
+    if end <= start:
+        print("Error: The end of the export must be after its start.")
+        return 1
+
+    sources = find_export_sources(camera, start, end)
+    if not sources:
+        print(f"No footage of camera {camera} found between {start} and {end}.")
+        return 1
+    if any(path.endswith(".m4s") for path, _, _ in sources):
+        # Fragments cannot be read without their init segment
+        print("Error: Unconsolidated fMP4 segments cannot be exported. Export the range once it is consolidated.")
+        return 1
+
+    runs = split_by_stream_parameters(sources)
+    if len(runs) == 1:
+        outputs = [output_path]
+    else:
+        root, extension = os.path.splitext(output_path)
+        outputs = [f"{root}_{number}{extension}" for number in range(1, len(runs) + 1)]
+        print(f"The range spans {len(runs)} different stream formats; exporting each to its own file.")
+
+    for run, output in zip(runs, outputs):
+        concat_list = output + ".concat.txt"
+        with open(concat_list, "w") as f:
+            for path, inpoint, outpoint in run:
+                f.write(f"file '{path}'\n")
+                if inpoint is not None:
+                    f.write(f"inpoint {inpoint:.3f}\n")
+                if outpoint is not None:
+                    f.write(f"outpoint {outpoint:.3f}\n")
+        command = build_concat_command(concat_list, output)
+        print(f"Exporting {len(run)} file(s) of camera {camera} to {output}...")
+        print(f"DEBUG: FFMPEG command being executed for export: {command}")
+        try:
+            returncode = subprocess.run(command).returncode
+        finally:
+            os.remove(concat_list)
+        if returncode != 0:
+            print(f"Export failed with code {returncode}.")
+            return returncode
+        print(f"Export complete: {output}")
+    return 0
+
+
+def read_activity_timeline(path):
+    """Returns (offset of the first interval, interval seconds, scores) stored in an activity file."""
+    with open(path, "rb") as f:
+        data = f.read()
+    interval, offset = ACTIVITY_HEADER.unpack_from(data)
+    return offset, interval, data[ACTIVITY_HEADER.size:]
+
+
+def search_activity(camera_name, min_activity, start=None, end=None):
+    """Prints the periods whose activity score reaches min_activity (the `search` command).
+
+    Each line holds a start and end time usable with `export --from/--to`
+    and the period's peak score. Returns the process exit code.
+    """
+    camera = find_camera(camera_name)
+    if camera is None:
+        print(f"Error: Unknown camera {camera_name!r}.")
+        return 1
+
+    timelines = []
+    for directory in iter_archive_directories(camera):
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    classified = classify_archive_file(entry.name)
+                    if classified and classified[0] == "activity":
+                        timelines.append((classified[1], entry.path))
+        except FileNotFoundError:
+            continue
+
+    periods = []
+    for hour_identifier, path in sorted(timelines):
+        hour_start = parse_hour_identifier(hour_identifier)
+        if (start and hour_start + timedelta(hours=1) <= start) or (end and hour_start >= end):
+            continue
+        try:
+            offset, interval, scores = read_activity_timeline(path)
+        except (OSError, struct.error) as e:
+            print(f"Warning: Could not read {path}: {e}")
+            continue
+        for index, score in enumerate(scores):
+            period_start = hour_start + timedelta(seconds=offset + index * interval)
+            period_end = period_start + timedelta(seconds=interval)
+            if score < min_activity or (start and period_end <= start) or (end and period_start >= end):
+                continue
+            if periods and periods[-1][1] == period_start:
+                periods[-1][1] = period_end
+                periods[-1][2] = max(periods[-1][2], score)
+            else:
+                periods.append([period_start, period_end, score])
+
+    for period_start, period_end, peak in periods:
+        print(f"{period_start:%Y-%m-%dT%H:%M:%S} {period_end:%Y-%m-%dT%H:%M:%S} peak {peak}%")
+    if not periods:
+        print(f"No activity of at least {min_activity}% found for {camera}.")
+    return 0
+
+
+def migrate_archive_layout():
+    """Moves hour files from the flat layout into dated directories (the `migrate-layout` command).
+
+    Each file is renamed on its own, so the migration can be interrupted and
+    run again. Files of recent hours (current + previous 2 hours) stay where
+    they are because a running archiver may still record or consolidate
+    them; run the command again later to move them too. Segments are moved
+    before their playlist so a moved playlist never points at missing files.
+
+    Returns:
+        tuple: (moved_count, skipped_count)
+    """
+    recent_hours = get_recent_hour_identifiers()
+    index = get_archive_index()
+    moved_count = 0
+    skipped_count = 0
+    for camera in get_cameras():
+        print(f"Migrating {camera.archive_path} to the dated layout...")
+        try:
+            filenames = os.listdir(camera.archive_path)
+        except FileNotFoundError:
+            continue
+
+        files = []
+        for filename in filenames:
+            classified = classify_archive_file(filename)
+            if classified:
+                files.append((classified[0] == "playlist", filename, classified[1]))
+        for _, filename, hour_identifier in sorted(files):
+            if hour_identifier in recent_hours:
+                skipped_count += 1
+                continue
+            source = os.path.join(camera.archive_path, filename)
+            destination_dir = dated_directory(hour_identifier, camera)
+            destination = os.path.join(destination_dir, filename)
+            try:
+                os.makedirs(destination_dir, exist_ok=True)
+                if os.path.exists(destination):
+                    print(f"Warning: {destination} already exists. Leaving {source} in place.")
+                    skipped_count += 1
+                    continue
+                os.rename(source, destination)
+            except OSError as e:
+                print(f"Error moving {source}: {e}")
+                skipped_count += 1
+                continue
+            if index is not None:
+                index.execute(
+                    "UPDATE files SET path = ? WHERE path = ?",
+                    (os.path.relpath(destination, ARCHIVE_PATH), os.path.relpath(source, ARCHIVE_PATH)),
+                )
+            moved_count += 1
+
+    print(f"Migration complete: Moved {moved_count} file(s), skipped {skipped_count}.")
+    if ARCHIVE_LAYOUT != "dated":
+        print("Set ARCHIVE_LAYOUT=dated before restarting the archiver.")
+    return moved_count, skipped_count
+
+
+def last_segment_age(camera):
+    """Returns the seconds since the camera's capture last updated its playlist, or None.
+
+    ffmpeg rewrites the playlist after every segment, so one stat per camera
+    is enough; the archive is never scanned for metrics.
+    """
+    if camera.watch_descriptor is not None and camera.last_segment_at:
+        return time.time() - camera.last_segment_at
+    if CAPTURE_MODE == "continuous":
+        playlist_path = live_playlist_path(camera)
+    elif camera.hour_identifier:
+        playlist_path = os.path.join(
+            capture_directory(camera.hour_identifier, camera), f"playlist_{camera.hour_identifier}.m3u8"
+        )
+    else:
+        return None
+    try:
+        return time.time() - os.stat(playlist_path).st_mtime
+    except OSError:
+        return None
+
+
+def render_metrics():
+    """Returns the archiver's metrics in the Prometheus text exposition format.
+
+    Everything comes from counters the supervisor already keeps, so a scrape
+    is cheap. Called from the metrics server thread.
+    """
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f"# HELP cctv_{name} {help_text}")
+        lines.append(f"# TYPE cctv_{name} {metric_type}")
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ",".join(f'{label}="{label_value}"' for label, label_value in labels.items())
+            lines.append(f"cctv_{name}{{{label_text}}} {value}" if label_text else f"cctv_{name} {value}")
+
+    now = time.time()
+    cameras = list(get_cameras())
+    running = {
+        str(camera): camera.process is not None and camera.process.poll() is None for camera in cameras
+    }
+    metric("capture_up", "gauge", "1 while the camera's capture process is running.", [
+        ({"camera": str(camera)}, int(running[str(camera)])) for camera in cameras
+    ])
+    metric("capture_uptime_seconds", "gauge", "Seconds since the capture process was started.", [
+        ({"camera": str(camera)}, round(now - camera.started_at, 3) if running[str(camera)] else 0)
+        for camera in cameras
+    ])
+    metric("capture_restarts_total", "counter", "Capture processes restarted after a crash.", [
+        ({"camera": str(camera)}, camera.restart_count) for camera in cameras
+    ])
+    metric("capture_last_segment_age_seconds", "gauge", "Seconds since the last segment was written.", [
+        ({"camera": str(camera)}, round(age, 3) if (age := last_segment_age(camera)) is not None else None)
+        for camera in cameras
+    ])
+    metric(
+        "capture_rollover_restart_seconds", "gauge",
+        "Seconds from stopping to restarting the capture process at the last hourly rollover.",
+        [({"camera": str(camera)}, round(camera.rollover_restart_seconds, 3)) for camera in cameras],
+    )
+    metric("capture_stalls_total", "counter", "Hung capture processes killed by the watchdog.", [
+        ({"camera": str(camera)}, camera.stall_count) for camera in cameras
+    ])
+    metric("capture_stalled_seconds_total", "counter", "Footage lost to capture stalls, in seconds.", [
+        ({"camera": str(camera)}, round(camera.stalled_seconds, 3)) for camera in cameras
+    ])
+
+    stats = get_consolidation_queue_stats()
+    metric("consolidation_queue_depth", "gauge", "Consolidation jobs waiting for a slot.", [
+        ({}, stats["queue_depth"]),
+    ])
+    metric("consolidation_running_jobs", "gauge", "Consolidation jobs currently encoding.", [
+        ({}, stats["running"]),
+    ])
+    metric("consolidation_oldest_wait_seconds", "gauge", "Age of the oldest queued consolidation job.", [
+        ({}, round(stats["oldest_wait_seconds"], 3)),
+    ])
+    metric("consolidation_jobs_completed_total", "counter", "Finished consolidation jobs.", [
+        ({}, stats["completed"]),
+    ])
+    metric("consolidation_run_seconds_total", "counter", "Total run time of finished consolidation jobs.", [
+        ({}, round(consolidation_stats["total_run_seconds"], 3)),
+    ])
+    metric("consolidation_last_run_seconds", "gauge", "Run time of the last finished consolidation job.", [
+        ({}, round(stats["last_run_seconds"], 3)),
+    ])
+    metric("consolidation_last_speed", "gauge", "Realtime factor of the last finished consolidation job.", [
+        ({}, stats["last_speed"]),
+    ])
+    metric("consolidation_job_speed", "gauge", "Current realtime factor of a running consolidation job.", [
+        ({"job": key}, progress.get("speed")) for key, progress in sorted(stats["running_jobs"].items())
+    ])
+
+    metric("cleanup_deleted_files_total", "counter", "Files deleted by retention.", [
+        ({}, cleanup_stats["deleted_files"]),
+    ])
+    metric("cleanup_freed_bytes_total", "counter", "Bytes freed by retention.", [
+        ({}, cleanup_stats["bytes_freed"]),
+    ])
+    metric("archive_bytes", "gauge", "Archive size by file type, as of the last cleanup pass.", [
+        ({"type": kind}, size) for kind, size in sorted(cleanup_stats["archive_bytes"].items())
+    ])
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves render_metrics() on /metrics."""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep scrapes out of the archiver log
+
+
+def start_metrics_server(port=None):
+    """Serves the metrics endpoint from a background thread and returns the server."""
+    server = http.server.ThreadingHTTPServer(("", METRICS_PORT if port is None else port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on port {server.server_address[1]} at /metrics.")
+    return server
+
+
+PLAYBACK_CONTENT_TYPES = {
+    "mp4": "video/mp4",
+    "segment": "video/mp2t",
+    "playlist": "application/vnd.apple.mpegurl",
+    "proxy": "video/mp4",
+    "thumbnails": "image/jpeg",
+    "activity": "application/octet-stream",
+    "manifest": "application/json",
+    "daily": "video/mp4",
+    "daily_index": "application/json",
+}
+# fMP4 segments are classified as "segment" too
+FMP4_CONTENT_TYPES = {".m4s": "video/iso.segment", ".mp4": "video/mp4"}
+
+
+def resolve_playback_file(camera, filename):
+    """Returns (path, kind) of an archive file a viewer asked for, or None.
+
+    Only archive files and the live playlist are served, so a request can
+    never reach anything else on the volume.
+    """
+    if filename == LIVE_PLAYLIST_NAME and CAPTURE_MODE == "continuous":
+        return live_playlist_path(camera), "playlist"
+    classified = classify_archive_file(filename)
+    if not classified or "/" in filename or filename.startswith("."):
+        return None
+    kind, hour_identifier = classified
+    path = os.path.join(hour_directory(hour_identifier, camera), filename)
+    if STAGING_PATH and kind in ("segment", "playlist") and not os.path.exists(path):
+        # Live footage that has not been flushed to the archive volume yet
+        path = os.path.join(camera.staging_path, filename)
+    return path, kind
+
+
+def list_playback_hours(camera):
+    """Returns {hour identifier or day: [archive MP4 / playlist filenames]} of a camera, newest first."""
+    hours = collections.defaultdict(list)
+    for directory in iter_archive_directories(camera):
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    classified = classify_archive_file(entry.name)
+                    if classified and classified[0] in ("daily", "daily_index"):
+                        hours[classified[1][:10]].append(entry.name)  # Listed under its day
+                    elif classified and classified[0] != "segment":
+                        hours[classified[1]].append(entry.name)
+        except FileNotFoundError:
+            continue
+    return {hour: sorted(hours[hour]) for hour in sorted(hours, reverse=True)}
+
+
+def parse_range_header(value, size):
+    """Returns the (start, end) byte positions of a single "bytes=" range, or None if unsatisfiable."""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", value.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):  # Suffix range: the last N bytes
+        length = int(match.group(2))
+        return (max(0, size - length), size - 1) if length and size else None
+    start = int(match.group(1))
+    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    return (start, end) if start <= end else None
+
+
+class PlaybackHandler(http.server.BaseHTTPRequestHandler):
+    """Serves camera and hour listings, archive MP4s and HLS playlists and segments.
+
+    URLs are /, /<camera>/ and /<camera>/<filename>. Files are sent with
+    os.sendfile and support single byte ranges, so browsers can seek in
+    MP4s and play HLS without ffmpeg being involved.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, send_body):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        cameras = {str(camera): camera for camera in get_cameras()}
+        if not parts:
+            links = [f'<a href="/{html.escape(name)}/">{html.escape(name)}</a>' for name in cameras]
+            self.send_page("Cameras", links, send_body)
+            return
+        camera = cameras.get(parts[0])
+        if camera is None:
+            self.send_error(404)
+            return
+        if len(parts) == 1:
+            links = []
+            if CAPTURE_MODE == "continuous":
+                links.append(f'<a href="{LIVE_PLAYLIST_NAME}">live</a>')
+            for hour_identifier, filenames in list_playback_hours(camera).items():
+                files = " ".join(f'<a href="{html.escape(name)}">{html.escape(name)}</a>' for name in filenames)
+                links.append(f"{hour_identifier}: {files}")
+            self.send_page(f"Camera {camera}", links, send_body)
+            return
+
+        # Playlists may refer to segments through dated subdirectories
+        resolved = resolve_playback_file(camera, parts[-1])
+        if resolved is None:
+            self.send_error(404)
+            return
+        self.send_archive_file(*resolved, send_body)
+
+    def send_page(self, title, lines, send_body):
+        body = (
+            f"<!DOCTYPE html><html><head><title>{html.escape(title)}</title></head><body>"
+            f"<h1>{html.escape(title)}</h1><ul>"
+            + "".join(f"<li>{line}</li>" for line in lines)
+            + "</ul></body></html>"
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_archive_file(self, path, kind, send_body):
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(404)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size - 1
+            if self.headers.get("Range"):
+                byte_range = parse_range_header(self.headers["Range"], size)
+                if byte_range is None:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            content_type = PLAYBACK_CONTENT_TYPES[kind]
+            if kind == "segment":
+                content_type = FMP4_CONTENT_TYPES.get(os.path.splitext(path)[1], content_type)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            if kind == "playlist":
+                self.send_header("Cache-Control", "no-cache")  # Live playlists change every segment
+            self.end_headers()
+            if not send_body:
+                return
+
+            # Zero-copy from the page cache to the socket
+            offset, remaining = start, end - start + 1
+            try:
+                while remaining > 0:
+                    sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, min(remaining, 1 << 20))
+                    if sent == 0:
+                        break
+                    offset += sent
+                    remaining -= sent
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True  # Viewer went away, e.g. after seeking
+
+    def log_message(self, format, *args):
+        pass  # Range requests from players would flood the log
+
+
+def start_playback_server(port=None):
+    """Serves recordings from a thread pool and returns the server (see PlaybackHandler)."""
+    server = http.server.ThreadingHTTPServer(("", SERVE_PORT if port is None else port), PlaybackHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving recordings on port {server.server_address[1]}.")
+    return server
+
+
+def serve_recordings():
+    """Runs the playback server until interrupted (the `serve` command).
+
+    It runs next to the recorder as its own process and only reads the
+    archive, so viewers never slow down capture or consolidation.
+    """
+    # Server threads inherit the mask, so the signals are only taken by sigwait
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT, signal.SIGTERM])
+    server = start_playback_server()
+    try:
+        signal.sigwait([signal.SIGINT, signal.SIGTERM])
+    finally:
+        server.shutdown()
+
+
 def handle_shutdown_signal(signum, frame):
     """Handle termination signals to ensure clean shutdown."""
     print(f"Received signal {signum}. Shutting down.")
-    stop_ffmpeg_process()
+    for camera in get_cameras():
+        signal_ffmpeg_process(camera)
+    for camera in get_cameras():
+        stop_ffmpeg_process(camera)
+        # The staging directory may not outlive the pod
+        if STAGING_PATH:
+            flush_staged_segments(camera, everything=True)
     # Optionally, wait for consolidation processes to finish
     for identifier, proc in consolidation_processes.items():
         if proc.poll() is None:
@@ -315,53 +4112,313 @@ def handle_shutdown_signal(signum, frame):
                     f"Consolidation process {identifier} did not stop gracefully, killing."
                 )
                 os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
+    # A stopping worker hands its hours to the other workers right away
+    return_claimed_jobs()
+    # Compactions are simply restarted later; the remuxed archive stays intact
+    for identifier, (_, _, proc, _, _) in compaction_processes.items():
+        if proc.poll() is None:
+            print(f"Stopping compaction process {identifier} (PID: {proc.pid})...")
+            proc.kill()
+            proc.wait()
     exit(0)
 
 
+def seconds_until_next_hour():
+    """Returns the number of seconds until the next wall-clock (UTC) hour boundary."""
+    now = datetime.utcnow()
+    next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    return (next_hour - now).total_seconds()
+
+
+def install_event_wakeup():
+    """Sets up the supervisor's event selector.
+
+    SIGCHLD is routed through a self-pipe (signal.set_wakeup_fd) so the
+    supervisor wakes up as soon as a capture or consolidation child exits,
+    instead of noticing it on the next poll.
+    """
+    global event_selector, wakeup_read_fd, wakeup_write_fd
+
+    event_selector = selectors.DefaultSelector()
+    wakeup_read_fd, wakeup_write_fd = os.pipe()
+    os.set_blocking(wakeup_read_fd, False)
+    os.set_blocking(wakeup_write_fd, False)
+    signal.set_wakeup_fd(wakeup_write_fd)
+    # A Python-level handler is required for the wakeup fd to receive SIGCHLD
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    event_selector.register(wakeup_read_fd, selectors.EVENT_READ, drain_wakeup_fd)
+
+
+def wake_supervisor():
+    """Wakes the supervisor from another thread, e.g. once a background check is done."""
+    if wakeup_write_fd is not None:
+        try:
+            os.write(wakeup_write_fd, b"\0")
+        except BlockingIOError:
+            pass  # A wakeup is already pending
+
+
+def drain_wakeup_fd(fd):
+    """Empties the self-pipe after a wakeup."""
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def next_wakeup_timeout():
+    """Returns how long the supervisor may sleep before a timer is due."""
+    # Wake just after the boundary so the new hour identifier is visible
+    timeouts = [seconds_until_next_hour() + 0.01]
+    timeouts.append(last_cleanup_time + CLEANUP_INTERVAL_SECONDS - time.time())
+    if pending_deletions:
+        timeouts.append(next_deletion_time - time.time())
+    for camera in get_cameras():
+        if camera.process is None:
+            timeouts.append(camera.restart_not_before - time.time())
+        elif CAPTURE_STALL_SEGMENTS:
+            timeouts.append(
+                CAPTURE_STALL_SEGMENTS * SEGMENT_TIME_SECONDS - seconds_since_capture_progress(camera)
+            )
+        if camera.pending_rollover_hours:
+            # Waiting for the next segment to close out the previous hour
+            timeouts.append(SEGMENT_TIME_SECONDS)
+        if STAGING_PATH:
+            timeouts.append(camera.last_flush_at + STAGING_FLUSH_SECONDS - time.time())
+    return max(0, min(min(timeouts), SUPERVISOR_MAX_WAIT_SECONDS))
+
+
+def wait_for_events(timeout):
+    """Blocks until a child exits, another registered event fires or the timeout expires."""
+    for key, _ in event_selector.select(timeout):
+        key.data(key.fileobj)
+
+
+def install_capture_watchdog():
+    """Sets up inotify so the supervisor sees every segment the captures write.
+
+    inotify is reached through libc with ctypes. Where it is unavailable the
+    watchdog falls back to the modification time of the capture playlist.
+    """
+    global inotify_fd, inotify_libc
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        fd = -1
+    if fd < 0:
+        print("inotify is not available; the capture watchdog checks playlist modification times.")
+        return
+    inotify_fd, inotify_libc = fd, libc
+    event_selector.register(inotify_fd, selectors.EVENT_READ, read_inotify_events)
+
+
+def watch_capture_directory(camera, directory):
+    """Follows segment and playlist writes in the directory a camera's capture writes to."""
+    if inotify_fd is None:
+        return
+    # IN_CLOSE_WRITE | IN_MOVED_TO: a segment was closed or the playlist replaced
+    wd = inotify_libc.inotify_add_watch(inotify_fd, os.fsencode(directory), 0x08 | 0x80)
+    if wd < 0:
+        print(f"Warning: Could not watch {directory}: {os.strerror(ctypes.get_errno())}")
+        return
+    if camera.watch_descriptor not in (None, wd):
+        inotify_libc.inotify_rm_watch(inotify_fd, camera.watch_descriptor)
+        inotify_watches.pop(camera.watch_descriptor, None)
+    camera.watch_descriptor = wd
+    inotify_watches[wd] = camera
+
+
+def is_capture_output(camera, name):
+    """Returns whether a file name in a capture directory is written by the camera's capture.
+
+    The archiver writes there too (consolidation playlists, repaired
+    segments of the previous hour, hour playlists in continuous mode), which
+    must not count as capture progress.
+    """
+    if name.startswith(".") or not camera.hour_identifier:
+        return False
+    if name.startswith(f"{camera.hour_identifier}_segment_") and name.endswith((".ts", ".m4s", ".mp4")):
+        return True
+    if CAPTURE_MODE == "continuous":
+        return name == LIVE_PLAYLIST_NAME
+    return name == f"playlist_{camera.hour_identifier}.m3u8"
+
+
+def read_inotify_events(fd):
+    """Event loop callback: records when each camera last wrote a segment."""
+    try:
+        data = os.read(fd, 65536)
+    except BlockingIOError:
+        return
+    offset = 0
+    while offset + 16 <= len(data):
+        wd, _, _, name_length = struct.unpack_from("iIII", data, offset)
+        name = data[offset + 16:offset + 16 + name_length].rstrip(b"\0")
+        offset += 16 + name_length
+        camera = inotify_watches.get(wd)
+        if camera and is_capture_output(camera, os.fsdecode(name)):
+            camera.last_segment_at = time.time()
+
+
+def seconds_since_capture_progress(camera):
+    """Returns how long the camera's capture has gone without writing a segment."""
+    if camera.watch_descriptor is not None:
+        last_progress = camera.last_segment_at
+    else:
+        age = last_segment_age(camera)
+        last_progress = time.time() - age if age is not None else 0
+    # A fresh capture gets the full stall timeout to connect
+    return time.time() - max(last_progress, camera.started_at)
+
+
+def check_capture_stall(camera):
+    """Kills a capture that is running but no longer writing segments.
+
+    Returns True if the capture was stopped; the caller restarts it.
+    """
+    if not CAPTURE_STALL_SEGMENTS or camera.process is None or camera.process.poll() is not None:
+        return False
+    stalled_for = seconds_since_capture_progress(camera)
+    if stalled_for < CAPTURE_STALL_SEGMENTS * SEGMENT_TIME_SECONDS:
+        return False
+
+    print(
+        f"FFMPEG HLS capture process of camera {camera} wrote no segment for {stalled_for:.0f}s. "
+        f"Restarting."
+    )
+    stop_ffmpeg_process(camera)
+    camera.restart_count += 1
+    camera.stall_count += 1
+    # Footage since the last segment is lost; the restart itself is counted as rollover/backoff
+    camera.stalled_seconds += stalled_for
+    return True
+
+
+def restart_capture_process(current_hour_id, camera=None):
+    """Restarts a crashed or missing capture process, backing off on repeated failures."""
+    camera = camera or DEFAULT_CAMERA
+
+    if camera.process:
+        exit_code = camera.process.poll()
+        print(
+            f"FFMPEG HLS capture process of camera {camera} crashed with exit code {exit_code}. Restarting."
+        )
+        stop_ffmpeg_process(camera)
+        camera.restart_count += 1
+        # A capture that dies right away (e.g. camera offline) is retried with backoff
+        if time.time() - camera.started_at < CAPTURE_STABLE_SECONDS:
+            camera.restart_delay = min(
+                max(camera.restart_delay * 2, 1), CAPTURE_RESTART_MAX_DELAY_SECONDS
+            )
+        else:
+            camera.restart_delay = 0
+        camera.restart_not_before = time.time() + camera.restart_delay
+
+    if time.time() < camera.restart_not_before:
+        return
+    if camera.restart_delay:
+        print(f"Retrying capture of camera {camera} after {camera.restart_delay}s backoff.")
+    start_ffmpeg_process(current_hour_id, camera)
+
+
+def supervise_camera(camera, current_hour_id):
+    """Handles rollover, crash and stall recovery of one camera's capture process."""
+    check_capture_stall(camera)
+    if STAGING_PATH and is_flush_due(camera):
+        flush_staged_segments(camera)
+    capture_down = camera.process is None or camera.process.poll() is not None
+
+    # --- Hourly Rollover Logic (continuous capture) ---
+    if CAPTURE_MODE == "continuous":
+        if current_hour_id != camera.hour_identifier:
+            if camera.hour_identifier:  # Not the first run
+                print(f"Hour changed. {camera.job_key(camera.hour_identifier)} is waiting for its last segment.")
+                camera.pending_rollover_hours.append(camera.hour_identifier)
+            camera.hour_identifier = current_hour_id
+
+        if capture_down:
+            restart_capture_process(current_hour_id, camera)
+
+        finalize_pending_hours(camera)
+
+    # --- Hourly Rollover Logic ---
+    elif current_hour_id != camera.hour_identifier:
+        print(f"Hour changed. Rolling camera {camera} over to {current_hour_id}.")
+        rollover_started_at = camera.stop_requested_at or time.time()
+        if camera.hour_identifier:  # Not the first run
+            stop_ffmpeg_process(camera)
+            if STAGING_PATH:
+                flush_staged_segments(camera, camera.hour_identifier)
+            # Trigger consolidation for the hour that just finished
+            consolidate_hourly_archive(camera.hour_identifier, camera)
+        start_ffmpeg_process(current_hour_id, camera)
+        camera.rollover_restart_seconds = camera.started_at - rollover_started_at
+
+    # --- Crash Recovery Logic for FFMPEG HLS Capture ---
+    elif capture_down:
+        restart_capture_process(current_hour_id, camera)
+
+
+def supervise():
+    """Runs one pass of the supervisor: rollover, crash recovery, consolidation and cleanup."""
+    current_hour_id = get_current_hour_identifier()
+    if CAPTURE_MODE != "continuous":
+        # Stop every capture due for rollover at once, so no camera waits for the others to shut down
+        for camera in get_cameras():
+            if camera.hour_identifier and camera.hour_identifier != current_hour_id:
+                signal_ffmpeg_process(camera)
+    for camera in get_cameras():
+        supervise_camera(camera, current_hour_id)
+
+    # --- Check for finished consolidation tasks ---
+    check_consolidation_status()
+
+    # --- Deferred H.265 compaction, downsampling of aged archives and daily rollups ---
+    if CONSOLIDATION_MODE == "copy" or compaction_processes or rollup_probes or pending_downsamples or pending_rollups:
+        schedule_compaction()
+
+    # --- Periodic Cleanup ---
+    cleanup_old_files()
+    delete_pending_files()
+
+
 def main():
     """Main application loop."""
-    global ffmpeg_process, current_process_hour_identifier
-
     signal.signal(signal.SIGINT, handle_shutdown_signal)
     signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    install_event_wakeup()
+    if CAPTURE_STALL_SEGMENTS:
+        install_capture_watchdog()
+    if METRICS_PORT:
+        start_metrics_server()
 
-    print("CCTV Archiver starting up with hourly MP4 consolidation.")
-
-    while True:
-        current_hour_id = get_current_hour_identifier()
-
-        # --- Hourly Rollover Logic ---
-        if current_hour_id != current_process_hour_identifier:
-            print(f"Hour changed. Rolling over to {current_hour_id}.")
-            if current_process_hour_identifier:  # Not the first run
-                stop_ffmpeg_process()
-                # Trigger consolidation for the hour that just finished
-                consolidate_hourly_archive(current_process_hour_identifier)
-            start_ffmpeg_process(current_hour_id)
-
-        # --- Crash Recovery Logic for FFMPEG HLS Capture ---
-        elif ffmpeg_process is None or ffmpeg_process.poll() is not None:
-            if ffmpeg_process:
-                print(
-                    f"FFMPEG HLS capture process crashed with exit code {ffmpeg_process.poll()}. Restarting."
-                )
-            else:
-                print(
-                    "No FFMPEG HLS capture process running. Starting for the first time."
-                )
+    index = get_archive_index()
+    if index is not None and index.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 0:
+        print("Archive index is empty. Building it from the files on disk.")
+        reindex_archive()
 
-            stop_ffmpeg_process()  # Ensure it's clean before starting
-            start_ffmpeg_process(current_hour_id)
+    # Segments staged by a previous run that was killed before it could flush
+    if STAGING_PATH:
+        for camera in get_cameras():
+            moved = flush_staged_segments(camera, everything=True)
+            if moved:
+                print(f"Moved {moved} file(s) left in staging by a previous run of camera {camera}.")
 
-        # --- Check for finished consolidation tasks ---
-        check_consolidation_status()
+    # Pick up hours a previous run left unconsolidated
+    reconcile_archive()
 
-        # --- Periodic Cleanup ---
-        cleanup_old_files()
+    print(
+        f"CCTV Archiver starting up with hourly MP4 consolidation for "
+        f"{len(get_cameras())} camera(s)."
+    )
 
-        time.sleep(
-            CONSOLIDATION_CHECK_INTERVAL_SECONDS
-        )  # Check for rollover/status every minute
+    while True:
+        supervise()
+        # Sleep until a child exits or the next timer (hour boundary,
+        # cleanup, capture restart) is due
+        wait_for_events(next_wakeup_timeout())
 
 
 if __name__ == "__main__":
@@ -372,11 +4429,46 @@ if __name__ == "__main__":
 Commands:
   (none)    Start the archiver in continuous recording mode (default)
   purge     Delete orphaned HLS files (.ts and .m3u8) that don't have corresponding MP4 archives
+  compact   Re-encode remuxed archives (CONSOLIDATION_MODE=copy) to H.265 now
+  reindex   Rebuild the archive index (ARCHIVE_INDEX_PATH) from the files on disk
+  migrate-layout
+            Move a flat archive into <camera>/YYYY/MM/DD directories (resumable)
+  export    Copy a time range into one MP4 without re-encoding (--camera, --from, --to, --output)
+  serve     Serve recordings and live HLS over HTTP on SERVE_PORT (default: 8080)
+  search    List periods with activity (--camera, --min-activity, optional --from/--to)
+  worker    Consolidate hours queued in JOB_QUEUE_PATH by the recorder
 
 Environment Variables:
-  RTSP_URL         RTSP stream URL to capture (required for recording mode)
+  RTSP_URL         RTSP stream URL to capture (single camera)
+  CAMERAS_FILE     JSON file listing cameras: [{"name": ..., "rtsp_url": ...}]
+  CAMERA_<N>_NAME, CAMERA_<N>_RTSP_URL
+                   Cameras as numbered variables, starting at N=1
   ARCHIVE_PATH     Directory for archived files (default: /archive)
   RETENTION_DAYS   Number of days to keep archived files (default: 90)
+  RETENTION_MAX_BYTES, RETENTION_MIN_FREE_BYTES
+                   Also delete the oldest MP4s to stay within a size or free-space budget
+  RETENTION_DOWNSAMPLE_DAYS, RETENTION_ACTIVE_DAYS
+                   Downsample older archives, then keep only hours with activity
+  CAPTURE_MODE     "restart" (default) or "continuous" (no restart at hour change)
+  STAGING_PATH     Capture into this local directory and move segments to ARCHIVE_PATH in batches
+  CONSOLIDATION_MAX_ATTEMPTS
+                   Give up on an hour after this many failed consolidations (default: 3)
+  CONSOLIDATION_MODE
+                   "transcode" (default) or "copy" (remux now, compact to H.265 later)
+  COMPACTION_WINDOW
+                   UTC hours during which compaction runs (default: 0-6)
+  COMPACTION_MAX_LOAD
+                   Also compact whenever the 1-minute load average is below this
+  ARCHIVE_INDEX_PATH
+                   SQLite index of archive files used for cleanup, purge and lookups
+  ARCHIVE_LAYOUT   "flat" (default) or "dated" (<camera>/YYYY/MM/DD directories)
+  METRICS_PORT     Serve Prometheus metrics on this port at /metrics
+  SEGMENT_FORMAT   "mpegts" (default) or "fmp4" (hourly capture only)
+  JOB_QUEUE_PATH   Hand finished hours to `worker` processes through this directory
+  CAPTURE_STALL_SEGMENTS
+                   Restart a capture that wrote no segment for this many segment durations (default: 3)
+  ACTIVITY_INTERVAL_SECONDS
+                   Score consolidated hours for activity in intervals of this many seconds
 
 Examples:
   # Start continuous recording
@@ -384,18 +4476,56 @@ Examples:
   
   # Purge orphaned files
   python3 app.py purge
+
+  # Compact remuxed archives, e.g. from a nightly cron job
+  python3 app.py compact
+
+  # Export ten minutes across an hour boundary
+  python3 app.py export --camera front --from 2026-02-07T09:55 --to 2026-02-07T10:05
+
+  # Find periods where at least 5% of the picture changed
+  python3 app.py search --camera front --min-activity 5 --from 2026-02-07
         """
     )
     parser.add_argument(
         "command",
         nargs="?",
-        choices=["purge"],
+        choices=["purge", "compact", "reindex", "migrate-layout", "export", "serve", "search", "worker", "append-fragments"],
         help="Command to execute (omit for normal recording mode)"
     )
+    export_options = parser.add_argument_group("export and search options")
+    export_options.add_argument("--camera", help="Camera name (optional with a single camera)")
+    export_options.add_argument("--from", dest="start", type=parse_export_time, help="Start time (UTC, ISO 8601)")
+    export_options.add_argument("--to", dest="end", type=parse_export_time, help="End time (UTC, ISO 8601)")
+    export_options.add_argument("--output", help="Output MP4 path")
+    export_options.add_argument("--input", help=argparse.SUPPRESS)  # append-fragments: fMP4 playlist
+    export_options.add_argument("--creation-time", type=float, help=argparse.SUPPRESS)  # append-fragments
+    export_options.add_argument(
+        "--min-activity", type=int, default=5, help="Search: minimum activity score in percent (default: 5)"
+    )
     
     args = parser.parse_args()
     
     if args.command == "purge":
         purge_orphaned_files()
+    elif args.command == "compact":
+        compact_archives()
+    elif args.command == "reindex":
+        reindex_archive()
+    elif args.command == "migrate-layout":
+        migrate_archive_layout()
+    elif args.command == "serve":
+        serve_recordings()
+    elif args.command == "append-fragments":
+        exit(append_fragments(args.input, args.output, args.creation_time))
+    elif args.command == "worker":
+        run_worker()
+    elif args.command == "search":
+        exit(search_activity(args.camera, args.min_activity, args.start, args.end))
+    elif args.command == "export":
+        if not args.start or not args.end:
+            parser.error("export requires --from and --to")
+        output = args.output or f"export_{args.camera or 'default'}_{args.start:%Y%m%d-%H%M%S}.mp4"
+        exit(export_clip(args.camera, args.start, args.end, output))
     else:
         main()
@@ -0,0 +1,413 @@
+"""Performance benchmarks of the archiver against synthetic footage.
+
+Measures footage lost per hourly rollover, consolidation speed per mode and
+preset, and the cost of the retention and purge scans over large synthetic
+archives. Video is generated locally with ffmpeg's lavfi testsrc2; a UDP
+MPEG-TS stream sent in realtime stands in for the RTSP camera. Results are
+written as JSON so runs can be compared.
+
+    python benchmarks/run_benchmarks.py --output results.json
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+# Hour identifiers of the synthetic footage; far from the present so no
+# recent-hour rule applies to them
+SYNTHETIC_DAY = datetime(2000, 1, 1)
+# Files of a consolidated hour in the synthetic archives used for the scan benchmark
+HOUR_FILE_NAMES = ["archive_{}.mp4", "proxy_{}.mp4", "thumbs_{}.jpg", "activity_{}.bin", "manifest_{}.json"]
+
+
+def reset_app(archive_path):
+    """Points the archiver at a fresh archive with a single default camera."""
+    app.ARCHIVE_PATH = archive_path
+    app.ARCHIVE_INDEX_PATH = ""
+    app.archive_index = None
+    app.DEFAULT_CAMERA = app.Camera()
+    app.cameras[:] = [app.DEFAULT_CAMERA]
+    app.consolidation_processes = {}
+    app.consolidation_queue = []
+    app.consolidation_jobs = {}
+    app.pending_deletions.clear()
+    app.next_deletion_time = 0
+
+
+def synthetic_source(size, rate):
+    """Returns the lavfi input arguments of a synthetic test pattern with a running clock."""
+    return ["-f", "lavfi", "-i", f"testsrc2=size={size}:rate={rate}"]
+
+
+def h264_arguments(rate):
+    """Returns encoder arguments giving the synthetic footage a camera-like 2s GOP."""
+    return ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-g", str(rate * 2)]
+
+
+def probe_timing(path):
+    """Returns (start time, duration) of a media file from ffprobe."""
+    proc = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=start_time,duration", "-of", "json", path],
+        capture_output=True,
+        check=True,
+    )
+    probed = json.loads(proc.stdout)["format"]
+    return float(probed["start_time"]), float(probed["duration"])
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def synthetic_camera(size, rate):
+    """Streams synthetic footage over UDP in realtime; yields the URL the capture reads from."""
+    port = free_udp_port()
+    sender = subprocess.Popen(
+        ["ffmpeg", "-v", "error", "-re"] + synthetic_source(size, rate) + h264_arguments(rate)
+        + ["-f", "mpegts", f"udp://127.0.0.1:{port}?pkt_size=1316"],
+        stdin=subprocess.DEVNULL,
+    )
+    try:
+        yield f"udp://127.0.0.1:{port}?overrun_nonfatal=1&fifo_size=1000000"
+    finally:
+        sender.terminate()
+        sender.wait()
+
+
+def segment_gap(earlier_path, later_path):
+    """Returns the seconds between the end of one segment and the start of the next, from their timestamps."""
+    start, duration = probe_timing(earlier_path)
+    next_start, _ = probe_timing(later_path)
+    return next_start - (start + duration)
+
+
+def benchmark_rollover(capture_modes, rollovers, hour_seconds, size, rate):
+    """Measures the footage lost at each rollover, once per capture mode.
+
+    A realtime UDP stream plays the camera, so its timestamps keep running
+    while the capture restarts. The loss is the gap between the end of an
+    hour's last segment and the start of the next hour's first segment.
+    Finished hours are not consolidated, so no encoder competes with the
+    capture for the CPU.
+    """
+    results = []
+    for capture_mode in capture_modes:
+        with synthetic_camera(size, rate) as url, tempfile.TemporaryDirectory() as archive, \
+                mock.patch.object(app, "consolidate_hourly_archive"), \
+                mock.patch.object(app, "CAPTURE_MODE", capture_mode), \
+                mock.patch.object(app, "ARCHIVE_LAYOUT", "flat"):
+            reset_app(archive)
+            app.RTSP_URL = url
+            app.CAPTURE_STALL_SEGMENTS = 0  # Only the rollover restarts the capture
+            if capture_mode == "restart":
+                lost, restarts = measure_restart_rollovers(archive, rollovers, hour_seconds)
+            else:
+                lost, restarts = measure_continuous_rollovers(archive, rollovers, hour_seconds), []
+        results.append({
+            "benchmark": "rollover",
+            "params": {
+                "capture_mode": capture_mode, "rollovers": rollovers, "hour_seconds": hour_seconds,
+                "size": size, "rate": rate, "segment_seconds": app.SEGMENT_TIME_SECONDS,
+            },
+            "metrics": {
+                "lost_seconds": lost,
+                "mean_lost_seconds": sum(lost) / len(lost) if lost else None,
+                "max_lost_seconds": max(lost, default=None),
+                "capture_restart_seconds": restarts,
+            },
+        })
+    return results
+
+
+def measure_restart_rollovers(archive, rollovers, hour_seconds):
+    """Rolls a restart-mode capture over synthetic hours. Returns (lost seconds, restart seconds) per rollover."""
+    camera = app.DEFAULT_CAMERA
+    hours = [(SYNTHETIC_DAY + timedelta(hours=i)).strftime("%Y-%m-%d-%H") for i in range(rollovers + 1)]
+    restarts = []
+    for hour_identifier in hours:
+        # Stops the previous hour and starts the next one
+        app.supervise_camera(camera, hour_identifier)
+        if hour_identifier != hours[0]:
+            restarts.append(camera.rollover_restart_seconds)
+        time.sleep(hour_seconds)
+    app.stop_ffmpeg_process(camera)
+
+    lost = []
+    for previous, following in zip(hours, hours[1:]):
+        last_segment = app.read_playlist_entries(os.path.join(archive, f"playlist_{previous}.m3u8"))[-1][0]
+        first_segment = app.read_playlist_entries(os.path.join(archive, f"playlist_{following}.m3u8"))[0][0]
+        lost.append(segment_gap(os.path.join(archive, last_segment), os.path.join(archive, first_segment)))
+    return lost, restarts
+
+
+def measure_continuous_rollovers(archive, rollovers, hour_seconds):
+    """Runs a continuous capture through simulated rollovers. Returns the lost seconds per rollover.
+
+    Continuous capture names its segments after the wall clock, so the
+    synthetic hours cannot change its file names; the supervisor runs at
+    every simulated rollover instead, and the loss is the gap between the
+    last segment closed before it and the first segment closed after it.
+    """
+    camera = app.DEFAULT_CAMERA
+    rollover_times = []
+    for index in range(rollovers + 1):
+        app.supervise_camera(camera, app.get_current_hour_identifier())
+        if index:
+            rollover_times.append(time.time())
+        time.sleep(hour_seconds)
+    app.stop_ffmpeg_process(camera)
+
+    segments = sorted(
+        (entry.stat().st_mtime, entry.path)
+        for entry in os.scandir(archive)
+        if (app.classify_archive_file(entry.name) or (None,))[0] == "segment"
+    )
+    lost = []
+    for rollover_time in rollover_times:
+        before = [path for closed_at, path in segments if closed_at <= rollover_time]
+        after = [path for closed_at, path in segments if closed_at > rollover_time]
+        if before and after:
+            lost.append(segment_gap(before[-1], after[0]))
+    return lost
+
+
+def write_synthetic_hour(directory, hour_identifier, seconds, size, rate, fmp4=False):
+    """Records seconds of synthetic footage as an hour's HLS segments. Returns the playlist path."""
+    playlist = os.path.join(directory, f"playlist_{hour_identifier}.m3u8")
+    extension = "m4s" if fmp4 else "ts"
+    command = (
+        ["ffmpeg", "-v", "error", "-y"] + synthetic_source(size, rate) + ["-t", str(seconds)] + h264_arguments(rate)
+        + [
+            "-f", "hls", "-hls_time", str(app.SEGMENT_TIME_SECONDS), "-hls_list_size", "0",
+            "-hls_playlist_type", "vod",
+            "-hls_segment_filename", os.path.join(directory, f"{hour_identifier}_segment_%05d.{extension}"),
+        ]
+    )
+    if fmp4:
+        command += ["-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", f"{hour_identifier}_segment_init.mp4"]
+    subprocess.run(command + [playlist], check=True)
+    return playlist
+
+
+def benchmark_consolidation(presets, footage_seconds, size, rate):
+    """Measures the realtime factor of consolidating one hour in each mode.
+
+    transcode runs once per x265 preset; copy is the stream-copy remux and
+    append the ffmpeg-free join of fMP4 segments.
+    """
+    results = []
+
+    def record(mode, preset, playlist, elapsed, output):
+        results.append({
+            "benchmark": "consolidation",
+            "params": {"mode": mode, "preset": preset, "footage_seconds": footage_seconds, "size": size, "rate": rate},
+            "metrics": {
+                "wall_seconds": elapsed,
+                "realtime_factor": footage_seconds / elapsed,
+                "input_bytes": sum(
+                    os.path.getsize(os.path.join(os.path.dirname(playlist), name))
+                    for name, _ in app.read_playlist_entries(playlist)
+                ),
+                "output_bytes": os.path.getsize(output),
+            },
+        })
+
+    with tempfile.TemporaryDirectory() as directory:
+        reset_app(directory)
+        ts_playlist = write_synthetic_hour(directory, "2000-01-01-00", footage_seconds, size, rate)
+        fmp4_playlist = write_synthetic_hour(directory, "2000-01-01-01", footage_seconds, size, rate, fmp4=True)
+        output = os.path.join(directory, "output.mp4")
+
+        for mode, preset in [("transcode", preset) for preset in presets] + [("copy", None)]:
+            if mode == "copy":
+                command = app.build_remux_command(ts_playlist, output)
+            else:
+                command = app.build_transcode_command(ts_playlist, output, preset)
+            started_at = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            record(mode, preset, ts_playlist, time.perf_counter() - started_at, output)
+
+        started_at = time.perf_counter()
+        if app.append_fragments(fmp4_playlist, output) != 0:
+            raise RuntimeError(f"Could not append the fragments of {fmp4_playlist}")
+        record("append", None, fmp4_playlist, time.perf_counter() - started_at, output)
+    return results
+
+
+def populate_archive(archive, file_count, layout):
+    """Creates file_count empty archive files of consolidated hours. Returns the cameras.
+
+    Hours go back from just before the present but stay within the
+    retention period, so a cleanup pass scans everything and deletes
+    nothing. Cameras are added until the file count is reached.
+    """
+    now = datetime.utcnow()
+    hours = [
+        (now - timedelta(hours=hours_ago)).strftime("%Y-%m-%d-%H")
+        for hours_ago in range(3, (app.RETENTION_DAYS - 1) * 24)
+    ]
+    camera_count = math.ceil(file_count / (len(hours) * len(HOUR_FILE_NAMES)))
+    cameras = [app.Camera(f"camera{index:03d}", "synthetic") for index in range(camera_count)]
+    app.ARCHIVE_LAYOUT = layout
+    app.cameras[:] = cameras
+
+    created = 0
+    for camera in cameras:
+        for hour_identifier in hours:
+            directory = app.hour_directory(hour_identifier, camera)
+            os.makedirs(directory, exist_ok=True)
+            for name in HOUR_FILE_NAMES:
+                if created == file_count:
+                    return cameras
+                os.close(os.open(os.path.join(directory, name.format(hour_identifier)), os.O_CREAT | os.O_WRONLY))
+                created += 1
+    return cameras
+
+
+def timed(function):
+    started_at = time.perf_counter()
+    function()
+    return time.perf_counter() - started_at
+
+
+def benchmark_cleanup_scan(file_counts, layouts):
+    """Measures one cleanup_old_files and purge_orphaned_files pass over synthetic archives.
+
+    Each archive is scanned from the directories and then through the
+    archive index, whose one-off reindex is timed too.
+    """
+    results = []
+    original_layout = app.ARCHIVE_LAYOUT
+    for layout in layouts:
+        for file_count in file_counts:
+            with tempfile.TemporaryDirectory() as archive:
+                reset_app(archive)
+                populate_started_at = time.perf_counter()
+                cameras = populate_archive(archive, file_count, layout)
+                populate_seconds = time.perf_counter() - populate_started_at
+
+                for indexed in (False, True):
+                    metrics = {"populate_seconds": populate_seconds}
+                    if indexed:
+                        app.ARCHIVE_INDEX_PATH = os.path.join(archive, "index.sqlite3")
+                        metrics["reindex_seconds"] = timed(app.reindex_archive)
+                    deleted_files = app.cleanup_stats["deleted_files"]
+                    app.last_cleanup_time = 0
+                    metrics["cleanup_seconds"] = timed(app.cleanup_old_files)
+                    purged = []
+                    metrics["purge_seconds"] = timed(lambda: purged.append(app.purge_orphaned_files()))
+                    # Should stay 0: the scans are measured, not the deletions
+                    metrics["deleted_files"] = app.cleanup_stats["deleted_files"] - deleted_files + purged[0][0]
+                    results.append({
+                        "benchmark": "cleanup_scan",
+                        "params": {"files": file_count, "cameras": len(cameras), "layout": layout, "index": indexed},
+                        "metrics": metrics,
+                    })
+                if app.archive_index is not None:
+                    app.archive_index.close()
+    app.ARCHIVE_LAYOUT = original_layout
+    return results
+
+
+def describe_environment():
+    """Returns what a run's numbers depend on: host, Python, ffmpeg and the archiver revision."""
+    def output(command):
+        try:
+            return subprocess.run(command, capture_output=True, text=True).stdout.strip() or None
+        except OSError:
+            return None
+
+    ffmpeg_version = output(["ffmpeg", "-version"])
+    return {
+        "started_at": datetime.utcnow().isoformat() + "Z",
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "ffmpeg": ffmpeg_version.splitlines()[0] if ffmpeg_version else None,
+        "revision": output(["git", "-C", os.path.dirname(os.path.abspath(__file__)), "rev-parse", "HEAD"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CCTV archiver against synthetic footage")
+    parser.add_argument(
+        "--only", default="rollover,consolidation,cleanup",
+        help="Comma-separated benchmarks to run (default: rollover,consolidation,cleanup)",
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--size", default="1280x720", help="Resolution of the synthetic video (default: 1280x720)")
+    parser.add_argument("--rate", type=int, default=15, help="Frame rate of the synthetic video (default: 15)")
+    parser.add_argument("--rollovers", type=int, default=3, help="Rollovers to measure (default: 3)")
+    parser.add_argument(
+        "--capture-modes", default="restart,continuous",
+        help="Capture modes whose rollovers are measured (default: restart,continuous)",
+    )
+    parser.add_argument(
+        "--hour-seconds", type=float, default=30,
+        help="Seconds each synthetic hour is recorded before rolling over (default: 30)",
+    )
+    parser.add_argument(
+        "--footage-seconds", type=int, default=120,
+        help="Seconds of footage consolidated per mode (default: 120)",
+    )
+    parser.add_argument(
+        "--presets", default="ultrafast,veryfast,medium",
+        help="x265 presets of the transcode mode (default: ultrafast,veryfast,medium)",
+    )
+    parser.add_argument(
+        "--files", default="10000,100000,1000000",
+        help="Synthetic archive sizes in files for the cleanup scan (default: 10000,100000,1000000)",
+    )
+    parser.add_argument("--layouts", default="flat,dated", help="Archive layouts to scan (default: flat,dated)")
+    args = parser.parse_args()
+
+    benchmarks = args.only.split(",")
+    results = []
+    # The archiver logs to stdout; keep it free for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        for name in benchmarks:
+            if name in ("rollover", "consolidation") and not shutil.which("ffmpeg"):
+                results.append({"benchmark": name, "skipped": "ffmpeg not found"})
+                continue
+            if name == "rollover":
+                results += benchmark_rollover(
+                    args.capture_modes.split(","), args.rollovers, args.hour_seconds, args.size, args.rate
+                )
+            elif name == "consolidation":
+                results += benchmark_consolidation(
+                    args.presets.split(","), args.footage_seconds, args.size, args.rate
+                )
+            elif name == "cleanup":
+                results += benchmark_cleanup_scan(
+                    [int(count) for count in args.files.split(",")], args.layouts.split(",")
+                )
+            else:
+                parser.error(f"Unknown benchmark {name!r}")
+
+    report = json.dumps({"environment": describe_environment(), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
+import concurrent.futures
+import json
 import unittest
 from unittest.mock import patch, MagicMock
 import os
+import struct
 import time
 import signal
 import subprocess
+import tempfile
 from datetime import datetime, timedelta
 
 # Import the functions from app.py
@@ -15,6 +19,30 @@ _original_datetime = datetime
 
 class TestCCTVArchiver(unittest.TestCase):
 
+    def setUp(self):
+        # Reset the consolidation scheduler between tests
+        app.consolidation_processes = {}
+        app.consolidation_queue = []
+        app.consolidation_jobs = {}
+        app.compaction_processes = {}
+        # Single default camera recording RTSP_URL into ARCHIVE_PATH
+        app.DEFAULT_CAMERA = app.Camera()
+        app.cameras = [app.DEFAULT_CAMERA]
+        app.archive_index = None
+        app.event_selector = None
+        app.pending_deletions.clear()
+        app.pending_downsamples.clear()
+        app.pending_rollups.clear()
+        app.encoder_models.clear()
+        app.segment_prechecks.clear()
+        app.rollup_probes.clear()
+        app.claimed_jobs.clear()
+        app.worker_id = None
+        app.segment_probe_cache.clear()
+        app.next_deletion_time = 0
+        app.inotify_fd = None
+        app.inotify_watches.clear()
+
     @patch('app.datetime')
     def test_get_current_hour_identifier(self, mock_datetime):
         mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 30, 0)
@@ -24,9 +52,7 @@ class TestCCTVArchiver(unittest.TestCase):
     @patch('app.subprocess.Popen')
     @patch('app.RTSP_URL', "rtsp://test_url")
     @patch('app.ARCHIVE_PATH', "/test_archive")
-    @patch('app.current_process_hour_identifier', None) # Ensure it's not set initially
     def test_start_ffmpeg_process_hls(self, mock_popen, mock_makedirs):
-        app.ffmpeg_process = None # Reset global state for test
         app.start_ffmpeg_process("2026-02-07-10")
 
         mock_makedirs.assert_called_once_with("/test_archive", exist_ok=True)
@@ -44,8 +70,8 @@ class TestCCTVArchiver(unittest.TestCase):
             "/test_archive/playlist_2026-02-07-10.m3u8",
         ]
         self.assertEqual(mock_popen.call_args[0][0], expected_command)
-        self.assertIsNotNone(app.ffmpeg_process)
-        self.assertEqual(app.current_process_hour_identifier, "2026-02-07-10")
+        self.assertIsNotNone(app.DEFAULT_CAMERA.process)
+        self.assertEqual(app.DEFAULT_CAMERA.hour_identifier, "2026-02-07-10")
         
     @patch('app.RTSP_URL', None) # Simulate missing RTSP_URL
     def test_start_ffmpeg_process_no_rtsp_url(self):
@@ -59,13 +85,13 @@ class TestCCTVArchiver(unittest.TestCase):
         mock_proc = MagicMock()
         mock_proc.poll.return_value = None # Process is still running
         mock_proc.wait.return_value = 0
-        app.ffmpeg_process = mock_proc
+        app.DEFAULT_CAMERA.process = mock_proc
 
         app.stop_ffmpeg_process()
 
         mock_killpg.assert_called_once_with(1234, signal.SIGTERM)
         mock_proc.wait.assert_called_once_with(timeout=30)
-        self.assertIsNone(app.ffmpeg_process)
+        self.assertIsNone(app.DEFAULT_CAMERA.process)
 
     @patch('app.os.killpg')
     @patch('app.os.getpgid', return_value=1234)
@@ -73,32 +99,38 @@ class TestCCTVArchiver(unittest.TestCase):
         mock_proc = MagicMock()
         mock_proc.poll.return_value = None # Process is still running
         mock_proc.wait.side_effect = subprocess.TimeoutExpired(cmd="ffmpeg", timeout=30)
-        app.ffmpeg_process = mock_proc
+        app.DEFAULT_CAMERA.process = mock_proc
 
         app.stop_ffmpeg_process()
 
         mock_killpg.assert_any_call(1234, signal.SIGTERM)
         mock_killpg.assert_any_call(1234, signal.SIGKILL) # Should be called after timeout
-        self.assertIsNone(app.ffmpeg_process)
+        self.assertIsNone(app.DEFAULT_CAMERA.process)
 
+    @patch('app.shutil.which', return_value="/usr/bin/nice")
     @patch('app.os.path.exists', return_value=True)
     @patch('app.subprocess.Popen')
     @patch('app.ARCHIVE_PATH', "/test_archive")
-    def test_consolidate_hourly_archive(self, mock_popen, mock_exists):
+    def test_consolidate_hourly_archive(self, mock_popen, mock_exists, mock_which):
         app.consolidate_hourly_archive("2026-02-07-09")
 
         mock_popen.assert_called_once()
         expected_command = [
+            "nice", "-n", "10",
             "ffmpeg",
+            "-nostats", "-progress", "pipe:1",
             "-y",
             "-i", "/test_archive/playlist_2026-02-07-09.m3u8",
             "-c:v", "libx265",
             "-preset", "medium",
             "-crf", "26",
             "-c:a", "copy",
-            "/test_archive/archive_2026-02-07-09.mp4",
+            "-metadata", "creation_time=2026-02-07T09:00:00.000Z",
+            "/test_archive/.consolidating_2026-02-07-09.mp4",
         ]
         self.assertEqual(mock_popen.call_args[0][0], expected_command)
+        self.assertTrue(mock_popen.call_args[1]["start_new_session"])
+        self.assertNotIn("preexec_fn", mock_popen.call_args[1])
         self.assertIn("2026-02-07-09", app.consolidation_processes)
 
     @patch('app.os.listdir', return_value=[
@@ -109,7 +141,8 @@ class TestCCTVArchiver(unittest.TestCase):
         "other_file.txt", # Should not be deleted
     ])
     @patch('app.os.remove')
-    def test_check_consolidation_status_success(self, mock_remove, mock_listdir):
+    @patch('app.os.replace')
+    def test_check_consolidation_status_success(self, mock_replace, mock_remove, mock_listdir):
         mock_proc = MagicMock()
         mock_proc.poll.return_value = 0 # Process finished successfully
         mock_proc.returncode = 0 # Set the returncode attribute
@@ -129,55 +162,81 @@ class TestCCTVArchiver(unittest.TestCase):
         self.assertNotIn(unittest.mock.call("/test_archive/archive_2026-02-07-09.mp4"), calls)
         self.assertNotIn(unittest.mock.call("/test_archive/other_file.txt"), calls)
         
-        self.assertEqual(mock_remove.call_count, 3) # Only 3 files should be deleted
+        # The hour leaves the consolidation journal
+        self.assertIn(unittest.mock.call("/test_archive/.consolidation/2026-02-07-09"), calls)
+        self.assertEqual(mock_remove.call_count, 4) # Only 3 HLS files and the journal entry should be deleted
 
-    @patch('app.os.listdir', return_value=[
-        "archive_2026-02-07-09.mp4",
-        "archive_2026-02-06-09.mp4", # Recent file
-        "archive_2025-11-01-09.mp4", # Very old file (should be deleted)
-        "2026-02-07-09_segment_00001.ts", # Recent TS file (not subject to retention)
-        "2025-11-01-09_segment_00001.ts", # Old TS file (not subject to retention)
-        "playlist_2026-02-07-09.m3u8", # Recent playlist (not subject to retention)
-        "playlist_2025-11-01-09.m3u8", # Old playlist (not subject to retention)
-        "other_file.txt", # Should not be deleted
-    ])
-    @patch('app.os.path.getmtime')
     @patch('app.os.remove')
     @patch('app.datetime')
-    def test_cleanup_old_files(self, mock_datetime, mock_remove, mock_getmtime, mock_listdir):
+    def test_cleanup_old_files(self, mock_datetime, mock_remove):
         # Mock current time to Feb 7, 2026, 10:00:00
         mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 0, 0)
-        # Use the original (unmocked) datetime.fromtimestamp to avoid infinite recursion
-        mock_datetime.fromtimestamp.side_effect = lambda ts: _original_datetime.fromtimestamp(ts)
-        
-        # Mock file modification times - only .mp4 files will be checked
-        mock_getmtime.side_effect = [
-            datetime(2026, 2, 7, 9, 0, 0).timestamp(),   # 2026-02-07-09.mp4 (recent)
-            datetime(2026, 2, 6, 9, 0, 0).timestamp(),   # 2026-02-06-09.mp4 (recent)
-            datetime(2025, 11, 1, 9, 0, 0).timestamp(),  # 2025-11-01-09.mp4 (old, should be deleted)
-        ]
-        
-        app.ARCHIVE_PATH = "/test_archive"
-        app.RETENTION_DAYS = 90
-        app.last_cleanup_time = time.time() - app.CLEANUP_INTERVAL_SECONDS - 1 # Ensure cleanup runs
 
-        app.cleanup_old_files()
+        with tempfile.TemporaryDirectory() as archive:
+            self._create_files(archive, [
+                "archive_2026-02-07-09.mp4",
+                "archive_2026-02-06-09.mp4", # Recent file
+                "archive_2025-11-01-09.mp4", # Very old file (should be deleted)
+                "2026-02-07-09_segment_00001.ts", # Recent TS file (not subject to retention)
+                "2025-11-01-09_segment_00001.ts", # Old TS file (not subject to retention)
+                "playlist_2026-02-07-09.m3u8", # Recent playlist (not subject to retention)
+                "playlist_2025-11-01-09.m3u8", # Old playlist (not subject to retention)
+                "other_file.txt", # Should not be deleted
+            ])
+            app.ARCHIVE_PATH = archive
+            app.RETENTION_DAYS = 90
+            app.last_cleanup_time = time.time() - app.CLEANUP_INTERVAL_SECONDS - 1 # Ensure cleanup runs
+
+            # The age comes from the filename; files are not stat'ed
+            with patch('app.os.stat', side_effect=AssertionError("stat called")):
+                app.cleanup_old_files()
 
         # Only old MP4 files should be removed by retention policy
         # TS and M3U8 files are deleted after consolidation, not by retention policy
         calls = mock_remove.call_args_list
-        self.assertIn(unittest.mock.call("/test_archive/archive_2025-11-01-09.mp4"), calls)
-        # TS and M3U8 files should NOT be removed by cleanup_old_files
-        self.assertNotIn(unittest.mock.call("/test_archive/2025-11-01-09_segment_00001.ts"), calls)
-        self.assertNotIn(unittest.mock.call("/test_archive/playlist_2025-11-01-09.m3u8"), calls)
-        # Recent MP4 files should not be removed
-        self.assertNotIn(unittest.mock.call("/test_archive/archive_2026-02-07-09.mp4"), calls)
-        self.assertNotIn(unittest.mock.call("/test_archive/archive_2026-02-06-09.mp4"), calls)
-        # Non-archive files should not be removed
-        self.assertNotIn(unittest.mock.call("/test_archive/other_file.txt"), calls)
+        self.assertIn(unittest.mock.call(os.path.join(archive, "archive_2025-11-01-09.mp4")), calls)
         # Should delete exactly 1 old MP4 file
         self.assertEqual(mock_remove.call_count, 1)
 
+    @patch('app.RETENTION_MAX_BYTES', 3100)
+    @patch('app.CLEANUP_MAX_BYTES_PER_SECOND', 1000)
+    @patch('app.datetime')
+    def test_cleanup_enforces_size_budget_with_rate_limit(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 0, 0)
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            app.RETENTION_DAYS = 90
+            self._create_files(archive, [
+                "archive_2026-02-07-05.mp4",
+                "archive_2026-02-07-06.mp4",
+                "archive_2026-02-07-07.mp4",
+                "archive_2026-02-07-09.mp4",  # Recent hour, never deleted for space
+                "2026-02-07-10_segment_00000.ts",
+            ])
+            app.last_cleanup_time = 1000.0 - app.CLEANUP_INTERVAL_SECONDS - 1
+            app.next_deletion_time = 0
+            app.DEFAULT_CAMERA.process = MagicMock()
+            app.DEFAULT_CAMERA.started_at = 1000.0
+
+            with patch('app.time.time', return_value=1000.0):
+                app.cleanup_old_files()
+                # 5 KB on disk, 3.1 KB budget: the two oldest are due, but only one
+                # may go per second at 1 KB/s
+                self.assertEqual(app.pending_deletions, [
+                    (os.path.join(archive, "archive_2026-02-07-06.mp4"), 1024),
+                ])
+                self.assertAlmostEqual(app.next_deletion_time - 1000.0, 1.024)
+                self.assertAlmostEqual(app.next_wakeup_timeout(), 1.024)
+            with patch('app.time.time', return_value=1001.1):
+                app.delete_pending_files()
+
+            self.assertEqual(sorted(os.listdir(archive)), [
+                "2026-02-07-10_segment_00000.ts",
+                "archive_2026-02-07-07.mp4",
+                "archive_2026-02-07-09.mp4",
+            ])
+            self.assertEqual(app.pending_deletions, [])
+
     @patch('app.os.path.exists', return_value=True)
     @patch('app.os.listdir')
     @patch('app.os.path.getsize')
@@ -316,6 +375,1484 @@ class TestCCTVArchiver(unittest.TestCase):
         self.assertNotIn("/test_archive/2026-02-16-11_segment_00001.ts", deleted_files)
         self.assertNotIn("/test_archive/playlist_2026-02-16-11.m3u8", deleted_files)
 
+    @patch('app.os.makedirs')
+    @patch('app.subprocess.Popen')
+    @patch('app.RTSP_URL', "rtsp://test_url")
+    @patch('app.ARCHIVE_PATH', "/test_archive")
+    @patch('app.CAPTURE_MODE', "continuous")
+    def test_start_ffmpeg_process_continuous(self, mock_popen, mock_makedirs):
+        app.start_ffmpeg_process("2026-02-07-10")
+
+        command = mock_popen.call_args[0][0]
+        self.assertIn("-strftime", command)
+        self.assertIn("/test_archive/%Y-%m-%d-%H_segment_%M%S.ts", command)
+        self.assertEqual(command[-1], "/test_archive/live.m3u8")
+        self.assertEqual(mock_popen.call_args[1]["env"]["TZ"], "UTC")
+
+    @patch('app.datetime')
+    def test_is_hour_complete(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 0, 20)
+        mock_datetime.strptime.side_effect = _original_datetime.strptime
+
+        # Last segment of hour 09 is still open
+        live = {"2026-02-07-09_segment_5950.ts": 10.0}
+        self.assertFalse(app.is_hour_complete("2026-02-07-09", live))
+        # A segment from hour 10 has been closed, so hour 09 is final
+        live["2026-02-07-10_segment_0000.ts"] = 10.0
+        self.assertTrue(app.is_hour_complete("2026-02-07-09", live))
+        # Without new segments the grace period eventually completes the hour
+        mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 5, 0)
+        self.assertTrue(app.is_hour_complete("2026-02-07-09", {}))
+
+    def test_write_hour_playlist(self):
+        with tempfile.TemporaryDirectory() as archive:
+            for name in [
+                "2026-02-07-09_segment_0000.ts",
+                "2026-02-07-09_segment_0010.ts",
+                "2026-02-07-10_segment_0000.ts",
+            ]:
+                open(os.path.join(archive, name), "w").close()
+            app.ARCHIVE_PATH = archive
+
+            count = app.write_hour_playlist(
+                "2026-02-07-09", {"2026-02-07-09_segment_0000.ts": 9.5}
+            )
+
+            self.assertEqual(count, 2)
+            with open(os.path.join(archive, "playlist_2026-02-07-09.m3u8")) as f:
+                playlist = f.read()
+            self.assertIn("#EXTINF:9.500000,\n2026-02-07-09_segment_0000.ts", playlist)
+            self.assertIn("#EXTINF:10.000000,\n2026-02-07-09_segment_0010.ts", playlist)
+            self.assertNotIn("2026-02-07-10_segment_0000.ts", playlist)
+            self.assertTrue(playlist.endswith("#EXT-X-ENDLIST\n"))
+
+    @patch('app.datetime')
+    def test_next_wakeup_timeout_hour_boundary(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 59, 58)
+        app.DEFAULT_CAMERA.process = MagicMock()
+        app.DEFAULT_CAMERA.started_at = time.time()
+        app.last_cleanup_time = time.time()
+
+        self.assertAlmostEqual(app.next_wakeup_timeout(), 2.01, places=2)
+
+    @patch('app.start_ffmpeg_process')
+    @patch('app.check_consolidation_status')
+    @patch('app.cleanup_old_files')
+    @patch('app.get_current_hour_identifier', return_value="2026-02-07-10")
+    def test_supervise_restarts_crashed_capture_with_backoff(
+        self, mock_hour, mock_cleanup, mock_check, mock_start
+    ):
+        crashed = MagicMock()
+        crashed.poll.return_value = 1
+        camera = app.DEFAULT_CAMERA
+        camera.process = crashed
+        camera.hour_identifier = "2026-02-07-10"
+        camera.started_at = time.time()  # Died right after starting
+
+        app.supervise()
+
+        # A capture that crashes immediately is not restarted in a tight loop
+        mock_start.assert_not_called()
+        self.assertEqual(camera.restart_delay, 1)
+        self.assertEqual(camera.restart_count, 1)
+        self.assertIsNone(camera.process)
+
+        camera.restart_not_before = time.time() - 1
+        app.supervise()
+        mock_start.assert_called_once_with("2026-02-07-10", camera)
+
+    def test_wait_for_events_wakes_on_child_exit(self):
+        previous_handler = signal.getsignal(signal.SIGCHLD)
+        app.install_event_wakeup()
+        try:
+            proc = subprocess.Popen(["true"])
+            started = time.monotonic()
+            app.wait_for_events(10)
+            self.assertLess(time.monotonic() - started, 5)
+            proc.wait()
+        finally:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, previous_handler)
+            app.event_selector.close()
+
+    @patch('app.shutil.which', return_value="/usr/bin/nice")
+    @patch('app.os.path.exists', return_value=True)
+    @patch('app.subprocess.Popen')
+    @patch('app.ARCHIVE_PATH', "/test_archive")
+    @patch('app.CONSOLIDATION_MODE', "copy")
+    def test_consolidate_hourly_archive_copy_mode(self, mock_popen, mock_exists, mock_which):
+        app.consolidate_hourly_archive("2026-02-07-09")
+
+        expected_command = [
+            "nice", "-n", "10",
+            "ffmpeg",
+            "-nostats", "-progress", "pipe:1",
+            "-y",
+            "-i", "/test_archive/playlist_2026-02-07-09.m3u8",
+            "-c", "copy",
+            "-movflags", "+faststart",
+            "-metadata", "creation_time=2026-02-07T09:00:00.000Z",
+            "/test_archive/.consolidating_2026-02-07-09.mp4",
+        ]
+        self.assertEqual(mock_popen.call_args[0][0], expected_command)
+
+    @patch('app.is_compaction_allowed', return_value=True)
+    @patch('app.subprocess.Popen')
+    def test_compaction_replaces_remuxed_archive(self, mock_popen, mock_allowed):
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            app.compaction_processes = {}
+            archive_mp4 = os.path.join(archive, "archive_2026-02-07-09.mp4")
+            with open(archive_mp4, "w") as f:
+                f.write("remuxed")
+            app.mark_for_compaction("2026-02-07-09")
+            self.assertEqual(app.pending_compactions(), [(app.DEFAULT_CAMERA, "2026-02-07-09")])
+
+            # First pass starts the encode into a temporary file
+            app.schedule_compaction()
+            command = mock_popen.call_args[0][0]
+            self.assertIn("libx265", command)
+            self.assertEqual(command[-1], app.compaction_temp_path("2026-02-07-09"))
+            # Nobody reads the encoder while it runs, so it must not log into a pipe
+            self.assertIn("-nostats", command)
+            self.assertNotEqual(mock_popen.call_args[1]["stderr"], subprocess.PIPE)
+
+            # Encoder finishes: the temporary file replaces the archive
+            with open(command[-1], "w") as f:
+                f.write("compacted")
+            proc = mock_popen.return_value
+            proc.poll.return_value = 0
+            proc.returncode = 0
+            proc.communicate.return_value = (None, b"")
+            mock_allowed.return_value = False
+            app.schedule_compaction()
+
+            with open(archive_mp4) as f:
+                self.assertEqual(f.read(), "compacted")
+            self.assertEqual(app.pending_compactions(), [])
+            self.assertEqual(app.compaction_processes, {})
+
+    @patch('app.datetime')
+    @patch('app.COMPACTION_MAX_LOAD', None)
+    def test_is_compaction_allowed_window(self, mock_datetime):
+        with patch('app.COMPACTION_WINDOW', "22-4"):
+            mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 23, 0, 0)
+            self.assertTrue(app.is_compaction_allowed())
+            mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 12, 0, 0)
+            self.assertFalse(app.is_compaction_allowed())
+
+    @patch('app.os.path.exists', return_value=True)
+    @patch('app.subprocess.Popen')
+    @patch('app.ARCHIVE_PATH', "/test_archive")
+    @patch('app.MAX_CONSOLIDATION_JOBS', 1)
+    @patch('app.CONSOLIDATION_BACKLOG_THRESHOLD', 2)
+    def test_consolidation_scheduler_limits_concurrency(self, mock_popen, mock_exists):
+        for hour in ["2026-02-07-09", "2026-02-07-07", "2026-02-07-08", "2026-02-07-06"]:
+            app.consolidate_hourly_archive(hour)
+
+        # Only one job runs; the rest wait oldest-first
+        self.assertEqual(list(app.consolidation_processes), ["2026-02-07-09"])
+        self.assertEqual(
+            [job["hour"] for job in app.consolidation_queue],
+            ["2026-02-07-06", "2026-02-07-07", "2026-02-07-08"],
+        )
+        self.assertEqual(app.get_consolidation_queue_stats()["queue_depth"], 3)
+
+        # Duplicate requests are ignored
+        app.consolidate_hourly_archive("2026-02-07-07")
+        self.assertEqual(len(app.consolidation_queue), 3)
+
+        # When the running job finishes, the oldest hour starts with the backlog preset
+        finished = app.consolidation_processes["2026-02-07-09"]
+        finished.poll.return_value = 0
+        finished.returncode = 0
+        finished.communicate.return_value = (b"", b"")
+        with patch('app.os.listdir', return_value=[]):
+            app.check_consolidation_status()
+
+        self.assertEqual(list(app.consolidation_processes), ["2026-02-07-06"])
+        command = mock_popen.call_args[0][0]
+        self.assertEqual(command[command.index("-preset") + 1], "veryfast")
+        self.assertIn("/test_archive/playlist_2026-02-07-06.m3u8", command)
+
+    @patch('app.os.cpu_count', return_value=4)
+    @patch('app.subprocess.Popen')
+    @patch('app.MAX_CONSOLIDATION_JOBS', 1)
+    @patch('app.CONSOLIDATION_LATENCY_BUDGET_SECONDS', 3000)
+    def test_adaptive_encoder_settings(self, mock_popen, mock_cpu_count):
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            camera = app.DEFAULT_CAMERA
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), [
+                (f"2026-02-07-09_segment_{i:05d}.ts", 10.0) for i in range(360)
+            ])
+
+            # Until the first measurement, the default preset runs on every thread
+            app.consolidate_hourly_archive("2026-02-07-09")
+            command = mock_popen.call_args[0][0]
+            self.assertEqual(command[command.index("-preset") + 1], "medium")
+            self.assertEqual(command[command.index("-x265-params") + 1], "pools=4")
+            job = app.consolidation_jobs["2026-02-07-09"]
+            self.assertEqual((job["preset"], job["threads"], job["footage_seconds"]), ("medium", 4, 3600.0))
+            # The settings are kept in the journal and in the archive MP4
+            self.assertIn("comment=x265 preset=medium threads=4", command)
+            with open(app.journal_entry_path("2026-02-07-09")) as f:
+                self.assertEqual(f.read(), "1\nmedium 4\n")
+            self.assertEqual(app.read_journal_entry("2026-02-07-09"), 1)
+
+            # The realtime factor of the finished encode calibrates the camera's model
+            job["progress"] = {"speed": 2.0}
+            self._create_files(archive, [".consolidating_2026-02-07-09.mp4"])
+            proc = app.consolidation_processes["2026-02-07-09"]
+            proc.poll.return_value = 0
+            proc.returncode = 0
+            proc.communicate.return_value = (b"", b"")
+            app.check_consolidation_status()
+            self.assertEqual(app.encoder_models, {"": {"medium": 0.5}})
+            with open(os.path.join(archive, app.ENCODER_MODEL_FILE)) as f:
+                self.assertEqual(json.load(f), {"medium": 0.5})
+
+            # Headroom is spent on the next slower preset, then corrected by its measurement
+            self.assertEqual(app.choose_encoder_settings(camera, 3600, 3000), ("slow", 4))
+            app.record_encoder_speed(camera, "slow", 4, 1.0)
+            self.assertEqual(app.choose_encoder_settings(camera, 3600, 3000), ("medium", 3))
+            self.assertEqual(app.choose_encoder_settings(camera, 3600, 6000), ("slow", 3))
+            # A budget no preset can meet falls back to the fastest one
+            self.assertEqual(app.choose_encoder_settings(camera, 3600, 60), ("ultrafast", 4))
+
+            # An hour without footage measures nothing
+            app.record_encoder_speed(camera, "slow", 4, 0.0)
+            app.record_encoder_speed(camera, "slow", 4, None)
+            self.assertEqual(app.encoder_models[""]["slow"], 0.25)
+
+            # Only a preset outside CONSOLIDATION_ADAPTIVE_PRESETS measured: the nearest adaptive preset
+            # runs instead of the default, so the model gets a measurement it can use
+            app.encoder_models[""] = {"placebo": 0.1, "fast": 0}
+            with patch('app.CONSOLIDATION_PRESET', "placebo"):
+                self.assertEqual(app.choose_encoder_settings(camera, 3600, 3000), ("slow", 4))
+            with patch('app.CONSOLIDATION_PRESET', "faster"), \
+                    patch('app.CONSOLIDATION_ADAPTIVE_PRESETS', ["ultrafast", "veryfast", "medium"]):
+                self.assertEqual(app.choose_encoder_settings(camera, 3600, 3000), ("veryfast", 4))
+
+    @patch('app.os.cpu_count', return_value=8)
+    @patch('app.MAX_CONSOLIDATION_JOBS', 8)  # The default, one job slot per core
+    def test_adaptive_encoder_threads_come_from_free_cores(self, mock_cpu_count):
+        camera = app.DEFAULT_CAMERA
+        app.encoder_models[""] = {}
+        self.assertEqual(app.choose_encoder_settings(camera, 3600, 3000), ("medium", 8))
+
+        app.encoder_models[""] = {"medium": 0.2}
+        self.assertEqual(app.choose_encoder_settings(camera, 3600, 3000), ("medium", 6))
+        # Another encode holds six cores, so this one picks a faster preset for the two left
+        app.consolidation_jobs["2026-02-07-08"] = {"kind": "hour", "threads": 6}
+        self.assertEqual(app.choose_encoder_settings(camera, 3600, 3000), ("veryfast", 2))
+        app.consolidation_jobs["2026-02-07-07"] = {"kind": "hour", "threads": 2}
+        self.assertEqual(app.choose_encoder_settings(camera, 3600, 3000), ("ultrafast", 1))
+
+    @patch('app.subprocess.Popen')
+    @patch('app.MAX_CONSOLIDATION_JOBS', 4)
+    @patch('app.CONSOLIDATION_CHUNKS', 3)
+    def test_consolidate_hourly_archive_chunked(self, mock_popen):
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            segments = [(f"2026-02-07-09_segment_{i:05d}.ts", 10.0) for i in range(7)]
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), segments)
+            mock_popen.side_effect = lambda *args, **kwargs: MagicMock()
+
+            app.consolidate_hourly_archive("2026-02-07-09")
+
+            # Three contiguous chunks encode in parallel
+            self.assertEqual(sorted(app.consolidation_processes), [
+                "2026-02-07-09.chunk000", "2026-02-07-09.chunk001", "2026-02-07-09.chunk002",
+            ])
+            chunk_segments = [
+                [name for name, _ in app.read_playlist_entries(app.chunk_path("2026-02-07-09", f"{i:03d}.m3u8"))]
+                for i in range(3)
+            ]
+            self.assertEqual(sum(chunk_segments, []), [name for name, _ in segments])
+            for call in mock_popen.call_args_list:
+                self.assertIn("libx265", call[0][0])
+
+            # Once every chunk succeeded, a stream-copy stitch produces the hourly MP4
+            for proc in app.consolidation_processes.values():
+                proc.poll.return_value = 0
+                proc.returncode = 0
+                proc.communicate.return_value = (b"", b"")
+            app.check_consolidation_status()
+
+            self.assertEqual(list(app.consolidation_processes), ["2026-02-07-09"])
+            stitch_command = mock_popen.call_args[0][0]
+            self.assertIn("concat", stitch_command)
+            self.assertEqual(stitch_command[stitch_command.index("-c") + 1], "copy")
+            self.assertEqual(stitch_command[-1], os.path.join(archive, ".consolidating_2026-02-07-09.mp4"))
+            with open(app.chunk_path("2026-02-07-09", "concat.txt")) as f:
+                self.assertEqual(len(f.readlines()), 3)
+
+            stitch = app.consolidation_processes["2026-02-07-09"]
+            stitch.poll.return_value = 0
+            stitch.returncode = 0
+            stitch.communicate.return_value = (b"", b"")
+            self._create_files(archive, [".consolidating_2026-02-07-09.mp4"])
+            app.check_consolidation_status()
+
+            # Chunk files and the hour's HLS files are gone, the MP4 is in place
+            self.assertEqual(sorted(os.listdir(archive)), [".consolidation", "archive_2026-02-07-09.mp4"])
+            self.assertEqual(os.listdir(os.path.join(archive, ".consolidation")), [])
+
+    @patch.dict(os.environ, {
+        "CAMERA_1_NAME": "front", "CAMERA_1_RTSP_URL": "rtsp://front",
+        "CAMERA_2_NAME": "back", "CAMERA_2_RTSP_URL": "rtsp://back",
+    })
+    @patch('app.ARCHIVE_PATH', "/test_archive")
+    def test_load_cameras_from_environment(self):
+        loaded = app.load_cameras()
+
+        self.assertEqual([c.name for c in loaded], ["front", "back"])
+        self.assertEqual(loaded[0].rtsp_url, "rtsp://front")
+        self.assertEqual(loaded[1].archive_path, "/test_archive/back")
+        self.assertEqual(loaded[1].job_key("2026-02-07-09"), "back/2026-02-07-09")
+
+    def test_load_cameras_defaults_to_single_camera(self):
+        self.assertEqual(app.load_cameras(), [app.DEFAULT_CAMERA])
+
+    @patch('app.os.makedirs')
+    @patch('app.subprocess.Popen')
+    @patch('app.consolidate_hourly_archive')
+    @patch('app.os.getpgid', side_effect=lambda pid: pid)
+    @patch('app.os.killpg')
+    @patch('app.get_current_hour_identifier', return_value="2026-02-07-10")
+    @patch('app.ARCHIVE_PATH', "/test_archive")
+    def test_rollover_stops_every_camera_before_waiting(
+        self, mock_hour, mock_killpg, mock_getpgid, mock_consolidate, mock_popen, mock_makedirs
+    ):
+        events = []
+        mock_killpg.side_effect = lambda pgid, signum: events.append(("signal", pgid, signum))
+        app.cameras = []
+        for pid, name in enumerate(["front", "back", "side"], start=1):
+            camera = app.Camera(name, f"rtsp://{name}")
+            camera.hour_identifier = "2026-02-07-09"
+            camera.process = MagicMock(pid=pid, **{"poll.return_value": None})
+            camera.process.wait.side_effect = lambda timeout, pid=pid: events.append(("wait", pid))
+            app.cameras.append(camera)
+        app.last_cleanup_time = time.time()
+        mock_popen.side_effect = lambda *args, **kwargs: MagicMock(**{"poll.return_value": None})
+
+        app.supervise()
+
+        self.assertEqual(events, [
+            ("signal", 1, signal.SIGTERM), ("signal", 2, signal.SIGTERM), ("signal", 3, signal.SIGTERM),
+            ("wait", 1), ("wait", 2), ("wait", 3),
+        ])
+        self.assertEqual(mock_popen.call_count, 3)
+        self.assertEqual([camera.stop_requested_at for camera in app.cameras], [0, 0, 0])
+
+    @patch('app.os.makedirs')
+    @patch('app.subprocess.Popen')
+    @patch('app.get_current_hour_identifier', return_value="2026-02-07-10")
+    @patch('app.ARCHIVE_PATH', "/test_archive")
+    def test_supervise_multiple_cameras(self, mock_hour, mock_popen, mock_makedirs):
+        front = app.Camera("front", "rtsp://front")
+        back = app.Camera("back", "rtsp://back")
+        app.cameras = [front, back]
+        app.last_cleanup_time = time.time()
+        mock_popen.side_effect = lambda *args, **kwargs: MagicMock(**{"poll.return_value": None})
+
+        app.supervise()
+
+        # Each camera gets its own capture process writing to its own directory
+        commands = [call[0][0] for call in mock_popen.call_args_list]
+        self.assertEqual(len(commands), 2)
+        self.assertIn("rtsp://front", commands[0])
+        self.assertEqual(commands[0][-1], "/test_archive/front/playlist_2026-02-07-10.m3u8")
+        self.assertEqual(commands[1][-1], "/test_archive/back/playlist_2026-02-07-10.m3u8")
+
+        # A crash of one camera only restarts that camera
+        back.process.poll.return_value = 1
+        back.started_at = 0
+        app.supervise()
+        self.assertEqual(mock_popen.call_count, 3)
+        self.assertEqual(front.restart_count, 0)
+        self.assertEqual(back.restart_count, 1)
+
+    @patch('app.os.path.exists', return_value=True)
+    @patch('app.subprocess.Popen')
+    @patch('app.ARCHIVE_PATH', "/test_archive")
+    @patch('app.MAX_CONSOLIDATION_JOBS', 4)
+    def test_consolidation_queue_is_shared_between_cameras(self, mock_popen, mock_exists):
+        front = app.Camera("front", "rtsp://front")
+        back = app.Camera("back", "rtsp://back")
+
+        app.consolidate_hourly_archive("2026-02-07-09", front)
+        app.consolidate_hourly_archive("2026-02-07-09", back)
+
+        self.assertIn("front/2026-02-07-09", app.consolidation_processes)
+        self.assertIn("back/2026-02-07-09", app.consolidation_processes)
+        self.assertEqual(
+            mock_popen.call_args[0][0][-1], "/test_archive/back/.consolidating_2026-02-07-09.mp4"
+        )
+
+    def _wait_for_rollup_probes(self):
+        concurrent.futures.wait(
+            [future for rollup in app.rollup_probes.values() for _, future in rollup["probes"]]
+        )
+
+    def _create_files(self, directory, names, size=1024):
+        for name in names:
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(b"\0" * size)
+
+    def test_reindex_archive(self):
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            self._create_files(archive, [
+                "archive_2026-02-07-08.mp4",
+                "2026-02-07-09_segment_00000.ts",
+                "2026-02-07-09_segment_00001.ts",
+                "other_file.txt",
+            ])
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), [
+                ("2026-02-07-09_segment_00000.ts", 10.0),
+                ("2026-02-07-09_segment_00001.ts", 4.5),
+            ])
+
+            with patch('app.ARCHIVE_INDEX_PATH', os.path.join(archive, ".index.sqlite3")):
+                self.assertEqual(app.reindex_archive(), 4)
+                rows = app.get_archive_index().execute(
+                    "SELECT path, hour, kind, size, duration, state FROM files ORDER BY path"
+                ).fetchall()
+                app.archive_index.close()
+
+        self.assertEqual(rows, [
+            ("2026-02-07-09_segment_00000.ts", "2026-02-07-09", "segment", 1024, 10.0, "recorded"),
+            ("2026-02-07-09_segment_00001.ts", "2026-02-07-09", "segment", 1024, 4.5, "recorded"),
+            ("archive_2026-02-07-08.mp4", "2026-02-07-08", "mp4", 1024, None, "complete"),
+            ("playlist_2026-02-07-09.m3u8", "2026-02-07-09", "playlist", rows[3][3], None, "recorded"),
+        ])
+
+    @patch('app.datetime')
+    def test_cleanup_and_purge_use_index(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 0, 0)
+        with tempfile.TemporaryDirectory() as archive, \
+                patch('app.ARCHIVE_INDEX_PATH', os.path.join(archive, ".index.sqlite3")):
+            app.ARCHIVE_PATH = archive
+            app.RETENTION_DAYS = 90
+            self._create_files(archive, [
+                "archive_2025-11-01-09.mp4",  # Expired
+                "archive_2026-02-07-05.mp4",
+                "2026-02-07-05_segment_00000.ts",  # Leftover of a consolidated hour
+                "2026-02-07-09_segment_00000.ts",  # Recent hour, not consolidated
+            ])
+            app.reindex_archive()
+
+            # Files that are not in the index are never touched
+            self._create_files(archive, ["archive_2025-10-01-09.mp4"])
+
+            app.last_cleanup_time = time.time() - app.CLEANUP_INTERVAL_SECONDS - 1
+            with patch('app.os.listdir', side_effect=AssertionError("listdir called")):
+                app.cleanup_old_files()
+                deleted_count, deleted_size = app.purge_orphaned_files()
+
+            self.assertEqual((deleted_count, deleted_size), (1, 1024))
+            self.assertEqual(sorted(f for f in os.listdir(archive) if not f.startswith(".")), [
+                "2026-02-07-09_segment_00000.ts",
+                "archive_2025-10-01-09.mp4",
+                "archive_2026-02-07-05.mp4",
+            ])
+            remaining = [path for path, in app.get_archive_index().execute("SELECT path FROM files")]
+            self.assertEqual(sorted(remaining), [
+                "2026-02-07-09_segment_00000.ts", "archive_2026-02-07-05.mp4",
+            ])
+            app.archive_index.close()
+
+    @patch('app.subprocess.Popen')
+    def test_consolidation_updates_index(self, mock_popen):
+        with tempfile.TemporaryDirectory() as archive, \
+                patch('app.ARCHIVE_INDEX_PATH', os.path.join(archive, ".index.sqlite3")):
+            app.ARCHIVE_PATH = archive
+            self._create_files(archive, [
+                "2026-02-07-09_segment_00000.ts", "2026-02-07-09_segment_00001.ts",
+            ])
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), [
+                ("2026-02-07-09_segment_00000.ts", 10.0),
+                ("2026-02-07-09_segment_00001.ts", 10.0),
+            ])
+
+            app.consolidate_hourly_archive("2026-02-07-09")
+            self._create_files(archive, [".consolidating_2026-02-07-09.mp4"])
+            proc = app.consolidation_processes["2026-02-07-09"]
+            proc.poll.return_value = 0
+            proc.returncode = 0
+            proc.communicate.return_value = (b"", b"")
+            app.check_consolidation_status()
+
+            rows = app.get_archive_index().execute(
+                "SELECT path, kind, duration, state FROM files"
+            ).fetchall()
+            app.archive_index.close()
+            self.assertEqual(rows, [("archive_2026-02-07-09.mp4", "mp4", 20.0, "complete")])
+            self.assertEqual(sorted(os.listdir(archive))[-1], "archive_2026-02-07-09.mp4")
+            self.assertFalse(os.path.exists(os.path.join(archive, "playlist_2026-02-07-09.m3u8")))
+
+    @patch('app.datetime')
+    def test_migrate_archive_layout(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 0, 0)
+        with tempfile.TemporaryDirectory() as archive, \
+                patch('app.ARCHIVE_INDEX_PATH', os.path.join(archive, ".index.sqlite3")):
+            app.ARCHIVE_PATH = archive
+            self._create_files(archive, [
+                "archive_2026-02-06-23.mp4",
+                "2026-02-07-05_segment_00000.ts",
+                "2026-02-07-09_segment_00000.ts",  # Recent hour, left in place
+                "live.m3u8",
+            ])
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-05.m3u8"), [
+                ("2026-02-07-05_segment_00000.ts", 10.0),
+            ])
+            app.reindex_archive()
+
+            self.assertEqual(app.migrate_archive_layout(), (3, 1))
+            # Running it again is a no-op
+            self.assertEqual(app.migrate_archive_layout(), (0, 1))
+
+            self.assertEqual(
+                sorted(f for f in os.listdir(archive) if not f.startswith(".")),
+                ["2026", "2026-02-07-09_segment_00000.ts", "live.m3u8"],
+            )
+            self.assertEqual(sorted(os.listdir(os.path.join(archive, "2026", "02", "07"))), [
+                "2026-02-07-05_segment_00000.ts", "playlist_2026-02-07-05.m3u8",
+            ])
+            self.assertEqual(
+                os.listdir(os.path.join(archive, "2026", "02", "06")), ["archive_2026-02-06-23.mp4"]
+            )
+            paths = [path for path, in app.get_archive_index().execute("SELECT path FROM files")]
+            app.archive_index.close()
+            self.assertEqual(sorted(paths), [
+                "2026-02-07-09_segment_00000.ts",
+                os.path.join("2026", "02", "06", "archive_2026-02-06-23.mp4"),
+                os.path.join("2026", "02", "07", "2026-02-07-05_segment_00000.ts"),
+                os.path.join("2026", "02", "07", "playlist_2026-02-07-05.m3u8"),
+            ])
+
+    @patch('app.ARCHIVE_LAYOUT', "dated")
+    @patch('app.datetime')
+    def test_dated_layout_paths_and_cleanup(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 0, 0)
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            app.RETENTION_DAYS = 1
+            command = app.build_hourly_capture_command("2026-02-07-10")
+            self.assertEqual(command[-1], os.path.join(archive, "2026", "02", "07", "playlist_2026-02-07-10.m3u8"))
+            command = app.build_continuous_capture_command()
+            self.assertIn(os.path.join(archive, "%Y", "%m", "%d", "%Y-%m-%d-%H_segment_%M%S.ts"), command)
+            self.assertEqual(command[-3:-1], ["-strftime_mkdir", "1"])
+
+            for day, names in [
+                ("2026/01/31", ["archive_2026-01-31-05.mp4"]),
+                ("2026/02/05", ["archive_2026-02-05-05.mp4", "2026-02-05-05_segment_00000.ts"]),
+                ("2026/02/06", ["archive_2026-02-06-09.mp4", "archive_2026-02-06-10.mp4"]),
+            ]:
+                os.makedirs(os.path.join(archive, day))
+                self._create_files(os.path.join(archive, day), names)
+
+            app.last_cleanup_time = time.time() - app.CLEANUP_INTERVAL_SECONDS - 1
+            app.cleanup_old_files()
+
+            # Whole expired days are removed, empty month directories too
+            self.assertEqual(os.listdir(os.path.join(archive, "2026")), ["02"])
+            self.assertEqual(os.listdir(os.path.join(archive, "2026", "02")), ["06"])
+            self.assertEqual(
+                os.listdir(os.path.join(archive, "2026", "02", "06")), ["archive_2026-02-06-10.mp4"]
+            )
+
+    def test_job_output_is_drained_from_event_loop(self):
+        previous_handler = signal.getsignal(signal.SIGCHLD)
+        app.install_event_wakeup()
+        progress_read, progress_write = os.pipe()
+        log_read, log_write = os.pipe()
+        proc = MagicMock()
+        proc.stdout = open(progress_read, "rb", buffering=0)
+        proc.stderr = open(log_read, "rb", buffering=0)
+        try:
+            job = {"key": "2026-02-07-09"}
+            with patch('app.CONSOLIDATION_LOG_LINES', 2):
+                app.watch_job_output(job, proc)
+            os.write(log_write, b"line 1\nline 2\nline 3\npartial")
+            os.write(progress_write, b"fps=48.5\nout_time_us=4000000\nspeed=1.94x\nprogress=continue\nfps=")
+            app.wait_for_events(0)
+            app.wait_for_events(0)
+
+            self.assertEqual(job["progress"], {
+                "fps": 48.5, "speed": 1.94, "out_time": 4.0, "finished": False,
+            })
+            self.assertEqual(list(job["log"]), ["line 2", "line 3"])
+
+            os.close(progress_write)
+            os.close(log_write)
+            proc.communicate.return_value = (b"", b"")
+            app.finish_job_output(job, proc)
+            self.assertEqual(app.format_job_log(job), "line 3\npartial")
+        finally:
+            proc.stdout.close()
+            proc.stderr.close()
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, previous_handler)
+            app.event_selector.close()
+
+    def test_metrics_endpoint(self):
+        import urllib.error
+        import urllib.request
+
+        camera = app.Camera("front", "rtsp://front")
+        camera.process = MagicMock()
+        camera.process.poll.return_value = None
+        camera.started_at = time.time() - 60
+        camera.restart_count = 2
+        camera.rollover_restart_seconds = 0.25
+        app.cameras = [camera]
+        app.consolidation_queue.append({"key": "front/2026-02-07-08", "hour": "2026-02-07-08",
+                                        "camera": camera, "queued_at": time.time()})
+        app.consolidation_jobs["front/2026-02-07-09"] = {"progress": {"speed": 2.5}}
+        app.cleanup_stats["archive_bytes"] = {"mp4": 4096, "segment": 1024}
+
+        server = app.start_metrics_server(port=0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(url + "/metrics") as response:
+                self.assertEqual(response.headers["Content-Type"], "text/plain; version=0.0.4")
+                body = response.read().decode()
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url + "/")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertIn('cctv_capture_up{camera="front"} 1\n', body)
+        self.assertIn('cctv_capture_restarts_total{camera="front"} 2\n', body)
+        self.assertIn("cctv_consolidation_queue_depth 1\n", body)
+        self.assertIn('cctv_consolidation_job_speed{job="front/2026-02-07-09"} 2.5\n', body)
+        self.assertIn('cctv_archive_bytes{type="mp4"} 4096\n', body)
+        self.assertIn("# TYPE cctv_cleanup_freed_bytes_total counter\n", body)
+        self.assertIn('cctv_capture_rollover_restart_seconds{camera="front"} 0.25\n', body)
+        # The playlist does not exist, so there is no segment age sample
+        self.assertNotIn("cctv_capture_last_segment_age_seconds{", body)
+
+    @patch('app.start_ffmpeg_process')
+    @patch('app.os.getpgid', return_value=1234)
+    @patch('app.os.killpg')
+    def test_supervise_restarts_stalled_capture(self, mock_killpg, mock_getpgid, mock_start):
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            camera = app.DEFAULT_CAMERA
+            camera.process = MagicMock()
+            camera.process.poll.return_value = None  # Hung, not exited
+            camera.hour_identifier = "2026-02-07-10"
+            camera.started_at = time.time() - 100
+            self._create_files(archive, ["playlist_2026-02-07-10.m3u8"])
+            os.utime(os.path.join(archive, "playlist_2026-02-07-10.m3u8"), (time.time() - 45,) * 2)
+
+            app.supervise_camera(camera, "2026-02-07-10")
+
+        mock_killpg.assert_called_once_with(1234, signal.SIGTERM)
+        mock_start.assert_called_once_with("2026-02-07-10", camera)
+        self.assertEqual((camera.stall_count, camera.restart_count), (1, 1))
+        self.assertAlmostEqual(camera.stalled_seconds, 45, delta=1)
+
+    @patch('app.RTSP_URL', "rtsp://test_url")
+    @patch('app.subprocess.Popen')
+    @patch('app.os.getpgid', return_value=1234)
+    @patch('app.os.killpg')
+    def test_capture_restarted_within_its_hour_keeps_earlier_segments(self, mock_killpg, mock_getpgid, mock_popen):
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            camera = app.DEFAULT_CAMERA
+            mock_popen.return_value.poll.return_value = None
+            app.start_ffmpeg_process("2026-02-07-10")
+            self.assertNotIn("-hls_flags", mock_popen.call_args[0][0])
+
+            # The first capture wrote three segments, then hung
+            names = [f"2026-02-07-10_segment_{i:05d}.ts" for i in range(3)]
+            self._create_files(archive, names)
+            playlist = os.path.join(archive, "playlist_2026-02-07-10.m3u8")
+            app.write_playlist(playlist, [(name, 10.0) for name in names])
+            camera.started_at = time.time() - 100
+            os.utime(playlist, (time.time() - 45,) * 2)
+            app.supervise_camera(camera, "2026-02-07-10")
+
+            # The new capture appends to the playlist and numbers on from the last segment
+            command = mock_popen.call_args[0][0]
+            self.assertEqual(mock_popen.call_count, 2)
+            self.assertEqual(command[command.index("-hls_flags") + 1], "append_list+discont_start")
+            self.assertEqual(command[command.index("-start_number") + 1], "3")
+            self.assertEqual(command[-1], playlist)
+            self.assertEqual([name for name, _ in app.read_playlist_entries(playlist)], names)
+            for name in names:
+                self.assertTrue(os.path.exists(os.path.join(archive, name)))
+
+    def test_capture_watchdog_follows_segments_with_inotify(self):
+        previous_handler = signal.getsignal(signal.SIGCHLD)
+        app.install_event_wakeup()
+        try:
+            app.install_capture_watchdog()
+            if app.inotify_fd is None:
+                self.skipTest("inotify is not available")
+            with tempfile.TemporaryDirectory() as archive:
+                app.DEFAULT_CAMERA.hour_identifier = "2026-02-07-10"
+                app.watch_capture_directory(app.DEFAULT_CAMERA, archive)
+                # Files the archiver writes itself are not capture progress
+                self._create_files(archive, [
+                    "other_file.txt", ".consolidating_2026-02-07-09.m3u8", "2026-02-07-09_segment_00359.ts",
+                    "playlist_2026-02-07-09.m3u8",
+                ])
+                app.wait_for_events(0)
+                self.assertEqual(app.DEFAULT_CAMERA.last_segment_at, 0)
+
+                self._create_files(archive, ["2026-02-07-10_segment_00000.ts"])
+                app.wait_for_events(0)
+                self.assertAlmostEqual(app.DEFAULT_CAMERA.last_segment_at, time.time(), delta=1)
+                self.assertLess(app.seconds_since_capture_progress(app.DEFAULT_CAMERA), 1)
+        finally:
+            if app.inotify_fd is not None:
+                os.close(app.inotify_fd)
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, previous_handler)
+            app.event_selector.close()
+
+    @patch('app.subprocess.Popen')
+    @patch('app.datetime')
+    def test_reconcile_archive_requeues_unfinished_hours(self, mock_datetime, mock_popen):
+        mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 0, 0)
+        with tempfile.TemporaryDirectory() as archive, \
+                patch('app.MAX_CONSOLIDATION_JOBS', 4):
+            app.ARCHIVE_PATH = archive
+            self._create_files(archive, [
+                "2026-02-07-05_segment_00000.ts",
+                ".consolidating_2026-02-07-05.mp4",  # Interrupted encode
+                ".chunk_2026-02-07-05_000.mp4",
+                "archive_2026-02-07-06.mp4",  # Finished before the restart
+                "2026-02-07-06_segment_00000.ts",
+                "2026-02-07-07_segment_00000.ts",  # Failed too often
+                "2026-02-07-10_segment_00000.ts",  # Being recorded
+            ])
+            for hour in ["2026-02-07-05", "2026-02-07-06", "2026-02-07-07", "2026-02-07-10"]:
+                app.write_playlist(os.path.join(archive, f"playlist_{hour}.m3u8"), [
+                    (f"{hour}_segment_00000.ts", 10.0),
+                ])
+            app.write_journal_entry("2026-02-07-05", attempts=1)
+            app.write_journal_entry("2026-02-07-06", attempts=1)
+            app.write_journal_entry("2026-02-07-07", attempts=3)
+
+            self.assertEqual(app.reconcile_archive(), 1)
+
+            self.assertEqual(list(app.consolidation_processes), ["2026-02-07-05"])
+            self.assertEqual(app.read_journal_entry("2026-02-07-05"), 2)
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(archive, ".consolidation"))), ["2026-02-07-05", "2026-02-07-07"]
+            )
+            self.assertEqual(sorted(f for f in os.listdir(archive) if f != ".consolidation"), [
+                "2026-02-07-05_segment_00000.ts",
+                "2026-02-07-07_segment_00000.ts",
+                "2026-02-07-10_segment_00000.ts",
+                "archive_2026-02-07-06.mp4",
+                "playlist_2026-02-07-05.m3u8",
+                "playlist_2026-02-07-07.m3u8",
+                "playlist_2026-02-07-10.m3u8",
+            ])
+
+    @patch('app.CAPTURE_MODE', "continuous")
+    @patch('app.CONSOLIDATION_MODE', "copy")
+    @patch('app.subprocess.run')
+    def test_export_clip_across_hour_boundary(self, mock_run):
+        mock_run.return_value.returncode = 0
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            self._create_files(archive, ["archive_2026-02-07-09.mp4"])
+            app.write_playlist(os.path.join(archive, "live.m3u8"), [
+                ("2026-02-07-09_segment_5950.ts", 10.0),
+                ("2026-02-07-10_segment_0000.ts", 10.0),
+                ("2026-02-07-10_segment_0010.ts", 10.0),
+                ("2026-02-07-10_segment_0020.ts", 10.0),
+            ])
+            output = os.path.join(archive, "clip.mp4")
+            # The recorder was started at 09:00:30, so the hour's MP4 holds 3570s of footage
+            archive_codec = ["h264"]
+            concat_lists = {}
+
+            def run(command, **kwargs):
+                if command[0] == "ffprobe":
+                    codec = archive_codec[0] if command[-1].endswith(".mp4") else "h264"
+                    probed = {
+                        "format": {"duration": "3570.0", "tags": {"creation_time": "2026-02-07T09:00:30.000000Z"}},
+                        "streams": [{"codec_type": "video", "codec_name": codec, "width": 1920, "height": 1080}],
+                    }
+                    return MagicMock(returncode=0, stdout=json.dumps(probed).encode(), stderr=b"")
+                concat_lists[command[-1]] = open(command[command.index("-i") + 1]).read()
+                return MagicMock(returncode=0)
+
+            mock_run.side_effect = run
+            returncode = app.export_clip(
+                None, datetime(2026, 2, 7, 9, 55), datetime(2026, 2, 7, 10, 0, 15), output
+            )
+
+            self.assertEqual(returncode, 0)
+            command = mock_run.call_args[0][0]
+            self.assertEqual(command[command.index("-c") + 1], "copy")
+            self.assertEqual(command[-1], output)
+            self.assertEqual(concat_lists, {output: (
+                f"file '{archive}/archive_2026-02-07-09.mp4'\ninpoint 3270.000\n"
+                f"file '{archive}/2026-02-07-10_segment_0000.ts'\n"
+                f"file '{archive}/2026-02-07-10_segment_0010.ts'\noutpoint 5.000\n"
+            )})
+            self.assertFalse(os.path.exists(output + ".concat.txt"))
+
+            # Re-encoded archives and raw segments cannot share a stream copy, so each gets its own file
+            archive_codec[0] = "hevc"
+            concat_lists.clear()
+            self.assertEqual(app.export_clip(
+                None, datetime(2026, 2, 7, 9, 55), datetime(2026, 2, 7, 10, 0, 15), output
+            ), 0)
+            self.assertEqual(concat_lists, {
+                os.path.join(archive, "clip_1.mp4"): f"file '{archive}/archive_2026-02-07-09.mp4'\ninpoint 3270.000\n",
+                os.path.join(archive, "clip_2.mp4"): (
+                    f"file '{archive}/2026-02-07-10_segment_0000.ts'\n"
+                    f"file '{archive}/2026-02-07-10_segment_0010.ts'\noutpoint 5.000\n"
+                ),
+            })
+
+    def test_archive_mp4_records_when_its_footage_starts(self):
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            names = ["2026-02-07-09_segment_00000.ts", "2026-02-07-09_segment_00001.ts"]
+            self._create_files(archive, names)
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), [(name, 10.0) for name in names])
+            # The recorder was started at 09:25, so the first segment was closed at 09:25:10
+            closed_at = app.hour_start_timestamp("2026-02-07-09") + 25 * 60 + 10
+            os.utime(os.path.join(archive, names[0]), (closed_at, closed_at))
+
+            self.assertEqual(
+                [offset for _, offset, _ in app.hour_segment_offsets("2026-02-07-09", app.DEFAULT_CAMERA)],
+                [1500.0, 1510.0],
+            )
+            command = app.build_consolidation_command(
+                {"hour": "2026-02-07-09", "camera": app.DEFAULT_CAMERA, "kind": "hour", "preset": None}
+            )
+            self.assertEqual(command[command.index("-metadata") + 1], "creation_time=2026-02-07T09:25:00.000Z")
+
+            probed = {"duration": 2100.0, "creation_time": datetime(2026, 2, 7, 9, 25), "streams": (), "extradata": ()}
+            self.assertEqual(
+                app.archive_mp4_timing(os.path.join(archive, "archive_2026-02-07-09.mp4"), "2026-02-07-09", probed),
+                (1500.0, 2100.0),
+            )
+
+    @patch('app.ARCHIVE_LAYOUT', "dated")
+    def test_playback_server_serves_ranges(self):
+        import http.client
+
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            day = os.path.join(archive, "2026", "02", "07")
+            os.makedirs(day)
+            with open(os.path.join(day, "archive_2026-02-07-09.mp4"), "wb") as f:
+                f.write(bytes(range(256)) * 4)
+            self._create_files(day, ["2026-02-07-10_segment_00000.ts"])
+            app.write_playlist(os.path.join(day, "playlist_2026-02-07-10.m3u8"), [
+                ("2026-02-07-10_segment_00000.ts", 10.0),
+            ])
+
+            server = app.start_playback_server(port=0)
+            connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+            try:
+                def get(path, headers=None):
+                    connection.request("GET", path, headers=headers or {})
+                    response = connection.getresponse()
+                    return response, response.read()
+
+                response, body = get("/")
+                self.assertIn(b'href="/default/"', body)
+                response, body = get("/default/")
+                self.assertIn(b'2026-02-07-09: <a href="archive_2026-02-07-09.mp4">', body)
+                self.assertIn(b'href="playlist_2026-02-07-10.m3u8"', body)
+
+                response, body = get("/default/archive_2026-02-07-09.mp4", {"Range": "bytes=250-261"})
+                self.assertEqual(response.status, 206)
+                self.assertEqual(response.headers["Content-Range"], "bytes 250-261/1024")
+                self.assertEqual(body, bytes([250, 251, 252, 253, 254, 255, 0, 1, 2, 3, 4, 5]))
+
+                response, body = get("/default/archive_2026-02-07-09.mp4", {"Range": "bytes=-4"})
+                self.assertEqual((response.status, body), (206, bytes([252, 253, 254, 255])))
+                response, body = get("/default/archive_2026-02-07-09.mp4", {"Range": "bytes=2000-"})
+                self.assertEqual(response.status, 416)
+
+                response, body = get("/default/playlist_2026-02-07-10.m3u8")
+                self.assertEqual(response.headers["Content-Type"], "application/vnd.apple.mpegurl")
+                self.assertIn(b"2026-02-07-10_segment_00000.ts", body)
+                response, body = get("/default/2026-02-07-10_segment_00000.ts")
+                self.assertEqual((response.status, len(body)), (200, 1024))
+
+                # Malformed hour identifiers would climb out of the dated layout ("..-..-.." = ../../..)
+                self.assertIsNone(app.classify_archive_file("archive_..-..-..-x.mp4"))
+                for path in [
+                    "/default/..%2F..%2Fetc%2Fpasswd", "/default/other_file.txt", "/back/",
+                    "/default/archive_..-..-..-x.mp4", "/default/daily_..-..-...mp4",
+                    "/default/..-..-..-x_segment_00000.ts",
+                ]:
+                    response, body = get(path)
+                    self.assertEqual(response.status, 404)
+            finally:
+                connection.close()
+                server.shutdown()
+                server.server_close()
+
+    @patch('app.PROXY_HEIGHT', 360)
+    @patch('app.THUMBNAIL_INTERVAL_SECONDS', 60)
+    @patch('app.subprocess.Popen')
+    @patch('app.datetime')
+    def test_consolidation_produces_proxy_and_thumbnails(self, mock_datetime, mock_popen):
+        mock_datetime.utcnow.return_value = datetime(2026, 5, 7, 10, 0, 0)
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            self._create_files(archive, ["2026-02-07-09_segment_00000.ts"])
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), [
+                ("2026-02-07-09_segment_00000.ts", 10.0),
+            ])
+
+            app.consolidate_hourly_archive("2026-02-07-09")
+
+            command = mock_popen.call_args[0][0]
+            # One input, decoded once and split three ways
+            self.assertEqual(command.count("-i"), 1)
+            self.assertEqual(command[command.index("-filter_complex") + 1], (
+                "[0:v]split=3[archive][proxy][thumbs];[proxy]scale=-2:360[proxy_out];"
+                "[thumbs]fps=1/60,scale=160:-2,tile=10x6[thumbs_out]"
+            ))
+            temp_prefix = os.path.join(archive, ".consolidating_2026-02-07-09")
+            for output in [temp_prefix + ".mp4", temp_prefix + ".proxy.mp4", temp_prefix + ".thumbs.jpg"]:
+                self.assertIn(output, command)
+                self._create_files(archive, [os.path.basename(output)])
+
+            proc = app.consolidation_processes["2026-02-07-09"]
+            proc.poll.return_value = 0
+            proc.returncode = 0
+            proc.communicate.return_value = (b"", b"")
+            app.check_consolidation_status()
+
+            self.assertEqual(sorted(f for f in os.listdir(archive) if not f.startswith(".")), [
+                "archive_2026-02-07-09.mp4", "proxy_2026-02-07-09.mp4", "thumbs_2026-02-07-09.jpg",
+            ])
+
+            # The extra outputs expire together with the archive
+            app.RETENTION_DAYS = 30
+            app.last_cleanup_time = 0
+            with patch('app.time.time', return_value=app.CLEANUP_INTERVAL_SECONDS + 1):
+                app.cleanup_old_files()
+            self.assertEqual([f for f in os.listdir(archive) if not f.startswith(".")], [])
+
+    @patch('app.ACTIVITY_INTERVAL_SECONDS', 10)
+    @patch('app.subprocess.Popen')
+    def test_activity_index_and_search(self, mock_popen):
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            self._create_files(archive, ["2026-02-07-09_segment_0100.ts"])
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), [
+                ("2026-02-07-09_segment_0100.ts", 10.0),
+            ])
+            app.consolidate_hourly_archive("2026-02-07-09")
+            self._create_files(archive, [".consolidating_2026-02-07-09.mp4"])
+            proc = app.consolidation_processes["2026-02-07-09"]
+            proc.poll.return_value = 0
+            proc.returncode = 0
+            proc.communicate.return_value = (b"", b"")
+            app.check_consolidation_status()
+
+            # The consolidated hour's keyframes are decoded as tiny gray frames
+            job = app.consolidation_jobs["2026-02-07-09.activity"]
+            command = mock_popen.call_args[0][0]
+            self.assertEqual(command[command.index("-skip_frame") + 1], "nokey")
+            self.assertEqual(command[command.index("-i") + 1], os.path.join(archive, "archive_2026-02-07-09.mp4"))
+            self.assertEqual(command[-1], job["output"])
+
+            frame_size = app.ACTIVITY_FRAME_WIDTH * app.ACTIVITY_FRAME_HEIGHT
+            still, changed = bytes(frame_size), bytes([255]) * frame_size
+            with open(job["output"], "wb") as f:
+                f.write(still * 15 + changed * 5 + still * 10)
+            app.check_consolidation_status()
+
+            self.assertFalse(os.path.exists(job["output"]))
+            # Anchored at the first segment, one minute into the hour
+            self.assertEqual(
+                app.read_activity_timeline(os.path.join(archive, "activity_2026-02-07-09.bin")),
+                (60, 10, bytes([0, 100, 100])),
+            )
+            self.assertEqual(app.classify_archive_file("activity_2026-02-07-09.bin"), ("activity", "2026-02-07-09"))
+
+            with patch('builtins.print') as mock_print:
+                self.assertEqual(app.search_activity(None, 50), 0)
+            mock_print.assert_called_once_with("2026-02-07T09:01:10 2026-02-07T09:01:30 peak 100%")
+            with patch('builtins.print') as mock_print:
+                app.search_activity(None, 50, start=datetime(2026, 2, 7, 10))
+            self.assertIn("No activity", mock_print.call_args[0][0])
+
+    @patch('app.RETENTION_DOWNSAMPLE_DAYS', 7)
+    @patch('app.RETENTION_ACTIVE_DAYS', 30)
+    @patch('app.is_compaction_allowed', return_value=True)
+    @patch('app.subprocess.Popen')
+    @patch('app.datetime')
+    def test_tiered_retention(self, mock_datetime, mock_popen, mock_allowed):
+        mock_datetime.utcnow.return_value = datetime(2026, 3, 1, 12, 0, 0)
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            app.RETENTION_DAYS = 90
+            self._create_files(archive, [
+                "archive_2026-01-10-09.mp4", "activity_2026-01-10-09.bin",  # Idle, past the active tier
+                "archive_2026-01-10-10.mp4", "activity_2026-01-10-10.bin",  # Active, past the active tier
+                "archive_2026-01-10-11.mp4",  # Not analyzed
+                "archive_2026-02-10-09.mp4",  # Already downsampled
+                "archive_2026-02-28-09.mp4",  # Original quality tier
+            ])
+            for hour_identifier, scores in [("2026-01-10-09", [0, 3]), ("2026-01-10-10", [0, 40])]:
+                with open(os.path.join(archive, f"activity_{hour_identifier}.bin"), "wb") as f:
+                    f.write(app.ACTIVITY_HEADER.pack(10, 0) + bytes(scores))
+            os.mkdir(os.path.join(archive, app.DOWNSAMPLE_DONE_DIR))
+            self._create_files(os.path.join(archive, app.DOWNSAMPLE_DONE_DIR), ["2026-02-10-09", "2025-11-01-00"])
+
+            app.last_cleanup_time = 0
+            with patch('app.time.time', return_value=app.CLEANUP_INTERVAL_SECONDS + 1):
+                app.cleanup_old_files()
+
+            self.assertEqual(sorted(f for f in os.listdir(archive) if not f.startswith(".")), [
+                "activity_2026-01-10-10.bin", "archive_2026-01-10-10.mp4", "archive_2026-01-10-11.mp4",
+                "archive_2026-02-10-09.mp4", "archive_2026-02-28-09.mp4",
+            ])
+            self.assertEqual(app.pending_downsamples, [
+                (app.DEFAULT_CAMERA, "2026-01-10-10"), (app.DEFAULT_CAMERA, "2026-01-10-11"),
+            ])
+            # Records of expired hours are pruned
+            self.assertEqual(os.listdir(os.path.join(archive, app.DOWNSAMPLE_DONE_DIR)), ["2026-02-10-09"])
+
+            # Downsampling runs one hour at a time within the compaction budget
+            app.schedule_compaction()
+            command = mock_popen.call_args[0][0]
+            self.assertEqual(command[command.index("-vf") + 1], "scale=-2:'min(480,ih)'")
+            self.assertEqual(command[command.index("-crf") + 1], str(app.DOWNSAMPLE_CRF))
+            self.assertEqual(command[-1], app.compaction_temp_path("2026-01-10-10"))
+            self._create_files(archive, [os.path.basename(command[-1])], size=10)
+            proc = mock_popen.return_value
+            proc.poll.return_value = 0
+            proc.returncode = 0
+            proc.communicate.return_value = (None, b"")
+            mock_allowed.return_value = False
+            app.schedule_compaction()
+
+            self.assertEqual(os.path.getsize(os.path.join(archive, "archive_2026-01-10-10.mp4")), 10)
+            self.assertIn("2026-01-10-10", os.listdir(os.path.join(archive, app.DOWNSAMPLE_DONE_DIR)))
+            self.assertEqual(app.pending_downsamples, [(app.DEFAULT_CAMERA, "2026-01-10-11")])
+
+    @patch('app.DAILY_ROLLUP_DAYS', 2)
+    @patch('app.is_compaction_allowed', return_value=True)
+    @patch('app.probe_media', side_effect=[
+        {"duration": 3600.0, "creation_time": None, "streams": (("video", "hevc", 1920, 1080, "yuv420p"),),
+         "extradata": ("CRC32:1a2b3c4d",)},
+        {"duration": 3590.0, "creation_time": None, "streams": (("video", "hevc", 1920, 1080, "yuv420p"),),
+         "extradata": ("CRC32:1a2b3c4d",)},
+    ])
+    @patch('app.subprocess.Popen')
+    @patch('app.datetime')
+    def test_daily_rollup(self, mock_datetime, mock_popen, mock_probe, mock_allowed):
+        mock_datetime.utcnow.return_value = datetime(2026, 3, 10, 12, 0, 0)
+        mock_popen.return_value.poll.return_value = None
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            app.RETENTION_DAYS = 90
+            self._create_files(archive, [
+                "archive_2026-03-07-00.mp4", "archive_2026-03-07-01.mp4", "thumbs_2026-03-07-00.jpg",
+                "archive_2026-03-08-05.mp4",  # Day not old enough yet
+            ])
+            app.last_cleanup_time = 0
+            with patch('app.time.time', return_value=app.CLEANUP_INTERVAL_SECONDS + 1):
+                app.cleanup_old_files()
+            self.assertEqual(app.pending_rollups, [(app.DEFAULT_CAMERA, "2026-03-07")])
+
+            # The hourly MP4s are probed off the supervisor loop, then stream-copied into one faststart file
+            app.schedule_compaction()
+            mock_popen.assert_not_called()
+            self._wait_for_rollup_probes()
+            app.schedule_compaction()
+            command = mock_popen.call_args[0][0]
+            self.assertIn("concat", command)
+            self.assertEqual(command[command.index("-movflags") + 1], "+faststart")
+            self.assertEqual(command[-1], os.path.join(archive, ".rollup_2026-03-07.mp4"))
+            with open(command[command.index("-i") + 1]) as f:
+                self.assertEqual(f.read(), "".join(
+                    f"file '{os.path.join(archive, name)}'\n"
+                    for name in ("archive_2026-03-07-00.mp4", "archive_2026-03-07-01.mp4")
+                ))
+            self._create_files(archive, [".rollup_2026-03-07.mp4"], size=10)
+            proc = mock_popen.return_value
+            proc.poll.return_value = 0
+            proc.returncode = 0
+            proc.communicate.return_value = (None, b"")
+            mock_allowed.return_value = False
+            app.schedule_compaction()
+
+            self.assertEqual(sorted(os.listdir(archive)), [
+                "archive_2026-03-08-05.mp4", "daily_2026-03-07.json", "daily_2026-03-07.mp4",
+                "thumbs_2026-03-07-00.jpg",
+            ])
+            self.assertEqual(app.read_daily_index(os.path.join(archive, "daily_2026-03-07.json")), {
+                "2026-03-07-00": {"offset": 0.0, "duration": 3600.0, "start": 0.0},
+                "2026-03-07-01": {"offset": 3600.0, "duration": 3590.0, "start": 0.0},
+            })
+            self.assertEqual(app.classify_archive_file("daily_2026-03-07.mp4"), ("daily", "2026-03-07-23"))
+            self.assertEqual(app.list_playback_hours(app.DEFAULT_CAMERA), {
+                "2026-03-08-05": ["archive_2026-03-08-05.mp4"],
+                "2026-03-07-00": ["thumbs_2026-03-07-00.jpg"],
+                "2026-03-07": ["daily_2026-03-07.json", "daily_2026-03-07.mp4"],
+            })
+
+            # Exports cut the rolled-up hours out of the daily file in one piece
+            daily_mp4 = os.path.join(archive, "daily_2026-03-07.mp4")
+            self.assertEqual(
+                app.find_export_sources(app.DEFAULT_CAMERA, datetime(2026, 3, 7, 0, 30), datetime(2026, 3, 7, 1, 15)),
+                [(daily_mp4, 1800.0, 4500.0)],
+            )
+            self.assertEqual(
+                app.find_export_sources(app.DEFAULT_CAMERA, datetime(2026, 3, 7, 1, 0), datetime(2026, 3, 7, 3, 0)),
+                [(daily_mp4, 3600.0, 7190.0)],
+            )
+
+            # A daily file expires once its whole day is past the retention period
+            archive_files = app.list_archive_files()
+            self.assertEqual(app.plan_cleanup(archive_files, "2026-03-07-12"), [
+                (os.path.join(archive, "thumbs_2026-03-07-00.jpg"), None),
+            ])
+            self.assertEqual(sorted(path for path, _ in app.plan_cleanup(archive_files, "2026-03-08-00")), [
+                os.path.join(archive, "daily_2026-03-07.json"), daily_mp4,
+                os.path.join(archive, "thumbs_2026-03-07-00.jpg"),
+            ])
+
+            # Hours encoded differently (here a resolution change) are not stream-copied together
+            self._create_files(archive, ["archive_2026-03-06-00.mp4", "archive_2026-03-06-01.mp4"])
+            mock_popen.reset_mock()
+            with patch('app.probe_media', side_effect=[
+                {"duration": 3600.0, "creation_time": None, "streams": (("video", "hevc", 1920, 1080, "yuv420p"),),
+                 "extradata": ("CRC32:1a2b3c4d",)},
+                {"duration": 3600.0, "creation_time": None, "streams": (("video", "hevc", 1280, 720, "yuv420p"),),
+                 "extradata": ("CRC32:5e6f7a8b",)},
+            ]):
+                self.assertTrue(app.start_rollup("2026-03-06"))
+                self._wait_for_rollup_probes()
+            app.collect_rollup_probes()
+            mock_popen.assert_not_called()
+            self.assertEqual(app.rollup_probes, {})
+            self.assertFalse(os.path.exists(os.path.join(archive, ".rollup_2026-03-06.txt")))
+
+            # The refused day is not planned (and probed) again until its hours change
+            self.assertEqual(app.plan_rollups(app.list_archive_files(), "2026-03-08-12", "2026-01-01-00", set()), [])
+            os.remove(os.path.join(archive, "archive_2026-03-06-01.mp4"))
+            self.assertEqual(
+                app.plan_rollups(app.list_archive_files(), "2026-03-08-12", "2026-01-01-00", set()),
+                [(app.DEFAULT_CAMERA, "2026-03-06")],
+            )
+            os.remove(os.path.join(archive, "archive_2026-03-06-00.mp4"))
+            app.plan_rollups(app.list_archive_files(), "2026-03-08-12", "2026-01-01-00", set())
+            self.assertFalse(os.path.exists(os.path.join(archive, ".norollup_2026-03-06.json")))
+
+    @patch('app.ARCHIVE_LAYOUT', "dated")
+    @patch('app.RTSP_URL', "rtsp://test_url")
+    def test_staged_segments_are_flushed_in_batches(self):
+        with tempfile.TemporaryDirectory() as archive, tempfile.TemporaryDirectory() as staging, \
+                patch('app.STAGING_PATH', staging):
+            app.ARCHIVE_PATH = archive
+            camera = app.DEFAULT_CAMERA
+            command = app.build_hourly_capture_command("2026-02-07-09")
+            self.assertEqual(command[-1], os.path.join(staging, "playlist_2026-02-07-09.m3u8"))
+
+            # The segment still being written is not listed in the playlist yet
+            self._create_files(staging, [f"2026-02-07-09_segment_{i:05d}.ts" for i in range(3)])
+            app.write_playlist(os.path.join(staging, "playlist_2026-02-07-09.m3u8"), [
+                (f"2026-02-07-09_segment_{i:05d}.ts", 10.0) for i in range(2)
+            ])
+            self.assertTrue(app.is_flush_due(camera))
+            self.assertEqual(app.flush_staged_segments(camera), 2)
+            day_directory = os.path.join(archive, "2026", "02", "07")
+            self.assertEqual(sorted(os.listdir(day_directory)), [
+                "2026-02-07-09_segment_00000.ts", "2026-02-07-09_segment_00001.ts",
+            ])
+            self.assertFalse(app.is_flush_due(camera))
+            with patch('app.STAGING_MAX_BYTES', 1000):
+                self.assertTrue(app.is_flush_due(camera))
+
+            # Unflushed live segments are still served from staging
+            self.assertEqual(
+                app.resolve_playback_file(camera, "2026-02-07-09_segment_00002.ts")[0],
+                os.path.join(staging, "2026-02-07-09_segment_00002.ts"),
+            )
+
+            # Once the hour's capture has stopped, all of its files are moved
+            self.assertEqual(app.flush_staged_segments(camera, "2026-02-07-09"), 2)
+            self.assertEqual(os.listdir(staging), [])
+            self.assertEqual(len(os.listdir(day_directory)), 4)
+
+    @patch('app.SEGMENT_PROBE_WORKERS', 2)
+    @patch('app.subprocess.Popen')
+    @patch('app.subprocess.run')
+    def test_segment_precheck_repairs_and_drops_damaged_segments(self, mock_run, mock_popen):
+        starts = {"00000": 0.0, "00001": 10.0, "00002": 20.0, "00003": 35.0}
+
+        def fake_run(command, **kwargs):
+            name = os.path.basename(command[-1])
+            index = name[-8:-3]
+            if command[0] == "ffmpeg":
+                # Segment 00002 can be salvaged by a remux, 00001 cannot
+                if index == "00002":
+                    self._create_files(os.path.dirname(command[-1]), [name], size=512)
+                    return MagicMock(returncode=0)
+                return MagicMock(returncode=1)
+            if index in ("00001", "00002") and not name.startswith(".repairing_"):
+                return MagicMock(returncode=0, stdout=b'{"format": {}}', stderr=b"Packet corrupt")
+            stdout = f'{{"format": {{"start_time": "{starts[index]}", "duration": "10.0"}}}}'
+            return MagicMock(returncode=0, stdout=stdout.encode(), stderr=b"")
+        mock_run.side_effect = fake_run
+        mock_popen.return_value.poll.return_value = None
+
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            names = [f"2026-02-07-09_segment_{i:05d}.ts" for i in range(4)]
+            self._create_files(archive, names)
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), [(n, 10.0) for n in names])
+
+            app.consolidate_hourly_archive("2026-02-07-09")
+            self.assertTrue(app.is_consolidation_scheduled("2026-02-07-09"))
+            mock_popen.assert_not_called()
+            for _, future in app.segment_prechecks["2026-02-07-09"]["checks"]:
+                future.result(timeout=5)
+            app.check_consolidation_status()
+
+            # The encode reads the clean playlist
+            clean_playlist = app.clean_playlist_path("2026-02-07-09")
+            self.assertIn(clean_playlist, mock_popen.call_args[0][0])
+            self.assertEqual(
+                [name for name, _ in app.read_playlist_entries(clean_playlist)],
+                [names[0], names[2], names[3]],
+            )
+            self.assertEqual(os.path.getsize(os.path.join(archive, names[2])), 512)
+            with open(os.path.join(archive, "manifest_2026-02-07-09.json")) as f:
+                manifest = json.load(f)
+            self.assertEqual(manifest["dropped"], [names[1]])
+            self.assertEqual(manifest["repaired"], [names[2]])
+            self.assertEqual(manifest["gaps"], [{"after": names[0], "seconds": 10.0}, {"after": names[2], "seconds": 5.0}])
+            self.assertEqual(app.classify_archive_file("manifest_2026-02-07-09.json"), ("manifest", "2026-02-07-09"))
+
+            # Probe results are cached
+            probes = mock_run.call_count
+            self.assertEqual(app.probe_segment(os.path.join(archive, names[3]))["start"], 35.0)
+            self.assertEqual(mock_run.call_count, probes)
+
+    @patch('app.subprocess.Popen')
+    def test_worker_claims_jobs_queued_by_recorder(self, mock_popen):
+        with tempfile.TemporaryDirectory() as archive, patch('app.JOB_QUEUE_PATH', os.path.join(archive, ".jobs")):
+            app.ARCHIVE_PATH = archive
+            self._create_files(archive, ["2026-02-07-09_segment_00000.ts"])
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), [
+                ("2026-02-07-09_segment_00000.ts", 10.0),
+            ])
+
+            # The recorder only enqueues the finished hour, once
+            app.consolidate_hourly_archive("2026-02-07-09")
+            app.consolidate_hourly_archive("2026-02-07-09")
+            mock_popen.assert_not_called()
+            queued_dir = os.path.join(archive, ".jobs", "queued")
+            self.assertEqual(os.listdir(queued_dir), ["2026-02-07-09.json"])
+
+            # A worker claims it with an atomic rename and encodes it
+            app.worker_id = "worker-1"
+            claimed = app.claim_next_job()
+            self.assertEqual(claimed, (app.DEFAULT_CAMERA, "2026-02-07-09"))
+            self.assertIsNone(app.claim_next_job())
+            claim_path = os.path.join(archive, ".jobs", "claimed", "2026-02-07-09.json")
+            self.assertTrue(os.path.exists(claim_path))
+            app.consolidate_hourly_archive("2026-02-07-09")
+            mock_popen.assert_called_once()
+
+            # The claim is kept while the encode runs, and survives a lease check
+            proc = mock_popen.return_value
+            proc.poll.return_value = None
+            app.release_finished_jobs()
+            app.reclaim_expired_jobs()
+            self.assertTrue(os.path.exists(claim_path))
+
+            # A dead worker's claim goes back to the queue once its lease ran out
+            os.utime(claim_path, (0, 0))
+            app.reclaim_expired_jobs()
+            self.assertEqual(os.listdir(queued_dir), ["2026-02-07-09.json"])
+            self.assertEqual(app.claim_next_job(), (app.DEFAULT_CAMERA, "2026-02-07-09"))
+
+            # The claim is removed once the hour is consolidated
+            temp_mp4 = app.consolidation_temp_path("2026-02-07-09")
+            self.assertEqual(os.path.basename(temp_mp4), ".consolidating_worker-1.2026-02-07-09.mp4")
+            self._create_files(archive, [os.path.basename(temp_mp4)])
+            proc.poll.return_value = 0
+            proc.returncode = 0
+            proc.communicate.return_value = (b"", b"")
+            app.check_consolidation_status()
+            app.release_finished_jobs()
+            self.assertTrue(os.path.exists(os.path.join(archive, "archive_2026-02-07-09.mp4")))
+            self.assertFalse(os.path.exists(claim_path))
+            self.assertEqual(app.claimed_jobs, {})
+
+    def test_competing_workers_claim_each_job_once(self):
+        with tempfile.TemporaryDirectory() as archive, patch('app.JOB_QUEUE_PATH', os.path.join(archive, ".jobs")):
+            app.ARCHIVE_PATH = archive
+            app.enqueue_hour("2026-02-07-09")
+            app.enqueue_hour("2026-02-07-10")
+            # Both jobs waited in the queue for longer than a lease
+            queued_dir = os.path.join(archive, ".jobs", "queued")
+            for name in os.listdir(queued_dir):
+                os.utime(os.path.join(queued_dir, name), (0, 0))
+
+            app.worker_id = "worker-1"
+            self.assertEqual(app.claim_next_job(), (app.DEFAULT_CAMERA, "2026-02-07-09"))
+            # A fresh claim is not mistaken for an expired lease by the other worker
+            app.worker_id = "worker-2"
+            app.reclaim_expired_jobs()
+            self.assertEqual(app.claim_next_job(), (app.DEFAULT_CAMERA, "2026-02-07-10"))
+            self.assertIsNone(app.claim_next_job())
+            claimed_dir = os.path.join(archive, ".jobs", "claimed")
+            owners = {}
+            for name in sorted(os.listdir(claimed_dir)):
+                with open(os.path.join(claimed_dir, name)) as f:
+                    owners[name] = json.load(f)["worker"]
+            self.assertEqual(owners, {"2026-02-07-09.json": "worker-1", "2026-02-07-10.json": "worker-2"})
+
+            # A claim that vanishes right after the rename is skipped, not an error
+            app.claimed_jobs.clear()
+            app.enqueue_hour("2026-02-07-11")
+            real_rename = os.rename
+
+            def rename_then_lose(source, destination):
+                real_rename(source, destination)
+                os.remove(destination)
+
+            with patch('app.os.rename', side_effect=rename_then_lose):
+                self.assertIsNone(app.claim_next_job())
+            self.assertEqual(app.claimed_jobs, {})
+
+    @patch('app.os.getpgid', return_value=1234)
+    @patch('app.os.killpg')
+    @patch('app.subprocess.Popen')
+    def test_worker_stops_job_whose_lease_was_taken_over(self, mock_popen, mock_killpg, mock_getpgid):
+        with tempfile.TemporaryDirectory() as archive, patch('app.JOB_QUEUE_PATH', os.path.join(archive, ".jobs")):
+            app.ARCHIVE_PATH = archive
+            self._create_files(archive, ["2026-02-07-09_segment_00000.ts"])
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), [
+                ("2026-02-07-09_segment_00000.ts", 10.0),
+            ])
+            app.enqueue_hour("2026-02-07-09")
+            app.worker_id = "worker-1"
+            app.claim_next_job()
+            app.consolidate_hourly_archive("2026-02-07-09")
+            mock_popen.return_value.poll.return_value = None
+            mock_popen.return_value.communicate.return_value = (b"", b"")
+            temp_mp4 = app.consolidation_temp_path("2026-02-07-09")
+            self._create_files(archive, [os.path.basename(temp_mp4)])
+
+            # The lease ran out (e.g. a long pause) and worker-2 claimed the hour
+            claim_path = os.path.join(archive, ".jobs", "claimed", "2026-02-07-09.json")
+            with open(claim_path) as f:
+                self.assertEqual(json.load(f)["worker"], "worker-1")
+            with open(claim_path, "w") as f:
+                json.dump({"hour": "2026-02-07-09", "camera": None, "worker": "worker-2"}, f)
+            app.claimed_jobs["2026-02-07-09"] = (claim_path, 0)
+
+            # worker-1 stops its own encode and leaves worker-2's claim alone
+            app.renew_job_leases()
+            mock_killpg.assert_called_once_with(1234, app.signal.SIGKILL)
+            self.assertEqual(app.consolidation_processes, {})
+            self.assertEqual(app.claimed_jobs, {})
+            self.assertFalse(os.path.exists(temp_mp4))
+            app.release_finished_jobs()
+            app.return_claimed_jobs()
+            with open(claim_path) as f:
+                self.assertEqual(json.load(f)["worker"], "worker-2")
+
+    @patch('app.subprocess.Popen')
+    @patch('app.datetime')
+    def test_worker_temp_files_are_left_to_the_claim_holder(self, mock_datetime, mock_popen):
+        mock_datetime.utcnow.return_value = datetime(2026, 2, 7, 10, 0, 0)
+        with tempfile.TemporaryDirectory() as archive, patch('app.JOB_QUEUE_PATH', os.path.join(archive, ".jobs")):
+            app.ARCHIVE_PATH = archive
+            worker_files = [".consolidating_worker-1.2026-02-07-09.mp4", ".chunk_worker-1.2026-02-07-09_000.mp4"]
+            self._create_files(archive, ["2026-02-07-09_segment_00000.ts", ".compacting_2026-02-07-08.mp4"] + worker_files)
+            app.write_playlist(os.path.join(archive, "playlist_2026-02-07-09.m3u8"), [
+                ("2026-02-07-09_segment_00000.ts", 10.0),
+            ])
+
+            # A restarted recorder deletes its own temporaries but not those a worker may be writing
+            app.reconcile_archive()
+            mock_popen.assert_not_called()
+            self.assertFalse(os.path.exists(os.path.join(archive, ".compacting_2026-02-07-08.mp4")))
+            for name in worker_files:
+                self.assertTrue(os.path.exists(os.path.join(archive, name)))
+
+            # The worker that claims the hour next deletes what a dead worker left
+            app.worker_id = "worker-2"
+            app.claim_next_job()
+            for name in worker_files:
+                self.assertFalse(os.path.exists(os.path.join(archive, name)))
+
+    @patch('app.SEGMENT_FORMAT', "fmp4")
+    @patch('app.CONSOLIDATION_MODE', "copy")
+    @patch('app.RTSP_URL', "rtsp://test_url")
+    @patch('app.subprocess.Popen')
+    def test_fmp4_segments_are_appended_without_ffmpeg(self, mock_popen):
+        with tempfile.TemporaryDirectory() as archive:
+            app.ARCHIVE_PATH = archive
+            command = app.build_hourly_capture_command("2026-02-07-09")
+            self.assertEqual(command[command.index("-hls_segment_type") + 1], "fmp4")
+            self.assertEqual(command[command.index("-hls_fmp4_init_filename") + 1], "2026-02-07-09_segment_init.mp4")
+            self.assertTrue(command[command.index("-hls_segment_filename") + 1].endswith("_segment_%05d.m4s"))
+
+            names = ["2026-02-07-09_segment_init.mp4"] + [f"2026-02-07-09_segment_{i:05d}.m4s" for i in range(3)]
+            for index, name in enumerate(names):
+                with open(os.path.join(archive, name), "wb") as f:
+                    f.write(bytes([index]) * (1000 + index))
+                self.assertEqual(app.classify_archive_file(name), ("segment", "2026-02-07-09"))
+            playlist = os.path.join(archive, "playlist_2026-02-07-09.m3u8")
+            app.write_playlist(playlist, [(name, 10.0) for name in names[1:]], names[0])
+            self.assertEqual(app.read_playlist_map(playlist), names[0])
+
+            # The recorder was started at 09:25, so the first fragment was closed at 09:25:10
+            closed_at = app.hour_start_timestamp("2026-02-07-09") + 25 * 60 + 10
+            os.utime(os.path.join(archive, names[1]), (closed_at, closed_at))
+
+            app.consolidate_hourly_archive("2026-02-07-09")
+            command = mock_popen.call_args[0][0]
+            self.assertNotIn("ffmpeg", command)
+            output_mp4 = app.consolidation_temp_path("2026-02-07-09")
+            self.assertEqual(command[command.index("append-fragments"):], [
+                "append-fragments", "--input", playlist, "--output", output_mp4,
+                "--creation-time", f"{closed_at - 10:.3f}",
+            ])
+
+            # The child process concatenates the init segment and fragments in playlist order
+            self.assertEqual(app.append_fragments(playlist, output_mp4), 0)
+            with open(output_mp4, "rb") as f:
+                self.assertEqual(f.read(), b"".join(bytes([i]) * (1000 + i) for i in range(4)))
+
+            # With a real init segment, the movie header is dated to when the footage starts
+            mvhd = struct.pack(">I4sB3xII", 108, b"mvhd", 0, 0, 0) + bytes(88)
+            init_segment = (
+                struct.pack(">I4s4sI", 16, b"ftyp", b"iso5", 512)
+                + struct.pack(">I4s", 8 + len(mvhd), b"moov") + mvhd
+            )
+            with open(os.path.join(archive, names[0]), "wb") as f:
+                f.write(init_segment)
+            self.assertEqual(app.append_fragments(playlist, output_mp4, closed_at - 10), 0)
+            with open(output_mp4, "rb") as f:
+                data = f.read()
+            mp4_time = int(closed_at - 10) + app.MP4_EPOCH_OFFSET
+            self.assertEqual(struct.unpack_from(">II", data, 16 + 8 + 12), (mp4_time, mp4_time))
+            self.assertEqual(len(data), len(init_segment) + sum(1000 + i for i in range(1, 4)))
+
     def test_argument_parsing_purge(self):
         """Test that the purge command line argument is properly parsed."""
         import argparse